@@ -4,6 +4,7 @@ include {
     PREP_CACHE_FOR_DOCKING
     GENERATE_COMBINED_LIGAND_FILES
     GENERATE_SPLIT_LIGAND_FILES
+    INDEX_LIGAND_FILES
 } from "./modules.nf"
 
 workflow {
@@ -14,5 +15,5 @@ workflow {
     DEDUPLICATE_LIGANDS(frag_ch, cache_ch)
     PREP_CACHE_FOR_DOCKING(DEDUPLICATE_LIGANDS.out.fixed_cache)
     GENERATE_COMBINED_LIGAND_FILES(PREP_CACHE_FOR_DOCKING.out.fixed_cache)
-    GENERATE_SPLIT_LIGAND_FILES(GENERATE_COMBINED_LIGAND_FILES.out.ligandFile3d, GENERATE_COMBINED_LIGAND_FILES.out.ligandFile2d)
+    INDEX_LIGAND_FILES(GENERATE_COMBINED_LIGAND_FILES.out.ligandFile3d, GENERATE_COMBINED_LIGAND_FILES.out.ligandFile2d)
 }
@@ -12,15 +12,16 @@ process PREP_FRAGALYSIS {
 
     script:
     """
-    asap-cli protein-prep \
+    python3 "${params.scripts}"/incremental_protein_prep.py \
       --target SARS-CoV-2-Mpro \
       --fragalysis-dir "${curatedFragalysis}" \
+      --existing-cache "${params.fragalysisCache}" \
+      --output-dir output \
       --loop-db ${params.loopDB} \
       --ref-chain A \
       --active-site-chain A \
-      --use-dask \
       --dask-n-workers 32 \
-      --dask-type local \
+      --materialize-mode ${params.cacheMaterializeMode}
     """
 }
 process PREP_CACHE_FOR_DOCKING {
@@ -37,7 +38,7 @@ process PREP_CACHE_FOR_DOCKING {
 
     script:
     """
-    python3 "${params.scripts}"/prep_cache_for_docking.py --input_cache "${cache_dir}"
+    python3 "${params.scripts}"/prep_cache_for_docking.py --input_cache "${cache_dir}" --materialize_mode "${params.cacheMaterializeMode}"
     """
 }
 process GENERATE_COMBINED_LIGAND_FILES {
@@ -55,8 +56,7 @@ process GENERATE_COMBINED_LIGAND_FILES {
 
     script:
     """
-    python3 ${params.scripts}/combined_sdf_from_cache.py --input_cache "${cache_dir}"
-    python3 ${params.scripts}/combined_sdf_from_cache.py --input_cache "${cache_dir}" --flatten
+    python3 ${params.scripts}/combined_sdf_from_cache.py --input_cache "${cache_dir}" --outputs both
     """
 }
 process GENERATE_SPLIT_LIGAND_FILES {
@@ -79,12 +79,33 @@ process GENERATE_SPLIT_LIGAND_FILES {
     python3 ${params.scripts}/split_sdf.py --sdf_fn ${ligandFile2d} --out_dir ${params.split2dligandFiles} --chunk_size 1 --name_convention "integer"
     """
 }
+process INDEX_LIGAND_FILES {
+    publishDir "${params.ligandFiles}", mode: 'copy', overwrite: true
+    conda "${params.drugforge}"
+    tag "index-ligand-files"
+    label 'local'
+
+    input:
+    path(ligandFile3d)
+    path(ligandFile2d)
+
+    output:
+    path "${params.ligandFile3dIndex}", emit: ligandFile3dIndex
+    path "${params.ligandFile2dIndex}", emit: ligandFile2dIndex
+
+    script:
+    """
+    python3 ${params.scripts}/sdf_index.py build --sdf_fn ${ligandFile3d} --index_fn ${params.ligandFile3dIndex}
+    python3 ${params.scripts}/sdf_index.py build --sdf_fn ${ligandFile2d} --index_fn ${params.ligandFile2dIndex}
+    """
+}
 
 process DEDUPLICATE_LIGANDS {
     publishDir "${params.dataPath}", mode: 'copy', overwrite: true, saveAs: {fn -> "${params.fixedFragalysisCache}"}
     conda "${params.drugforge}"
     tag "deduplicate-ligands"
     label 'local'
+    cpus 8
 
     input:
     path fragalysis_dir
@@ -99,6 +120,9 @@ process DEDUPLICATE_LIGANDS {
     --fragalysis-dir ${fragalysis_dir} \
     --prepped-path ${prepped_path} \
     --output-dir deduped_cache \
+    --n-workers ${task.cpus} \
+    --materialize-mode ${params.cacheMaterializeMode} \
+    --metadata-cache ${params.fragalysisMetadataCache} \
     --remove-covalent
     """
 }
\ No newline at end of file
@@ -1,12 +1,15 @@
 """
-This script generates a combined 2D SDF file from a cache of moonshot data.
+This script generates the combined 3D and 2D SDF files from a cache of moonshot data.
+
+Only the ligands are read from the cache, via the ligand index written next to the prepped complexes
+(see ligand_cache_index.py), so no protein is ever loaded.
 """
 
 from pathlib import Path
-from asapdiscovery.modeling.protein_prep import ProteinPrepper
-from asapdiscovery.data.schema.ligand import Ligand, write_ligands_to_multi_sdf
 import argparse
+from asapdiscovery.data.backend.openeye import oechem
 from asapdiscovery.data.util.logging import FileLogger
+from ligand_cache_index import LigandCacheIndex
 
 
 def get_args():
@@ -17,11 +20,16 @@ def get_args():
         type=Path,
         help="Path to input cache generated by the asapdiscovery-data package. This shouldn't contain any json files except for the cache.json file.",
     )
+    parser.add_argument(
+        "--outputs",
+        choices=["both", "3d", "2d"],
+        default="both",
+        help="Which combined SDF files to write. Both are written in a single pass over the cache by default.",
+    )
     parser.add_argument(
         "--flatten",
         action="store_true",
-        help="If true, will flatten the molecules before saving them. "
-        "This is useful if the molecules have 3D coordinates but you want to save them as 2D",
+        help="Only write the flattened 2D SDF file. Equivalent to '--outputs 2d'.",
     )
     parser.add_argument(
         "-o", "--output_dir", type=Path, default="./", help="Path to output path"
@@ -33,32 +41,34 @@ def main():
     args = get_args()
     data_dir = args.input_cache
     output_dir = args.output_dir
+    outputs = "2d" if args.flatten else args.outputs
 
-    complexes = ProteinPrepper.load_cache(data_dir)
     logger = FileLogger(
         "combine_sdfs", output_dir, logfile="combine_sdfs.log"
     ).getLogger()
-    logger.info(f"Found {len(complexes)} complexes in the cache: '{data_dir}'")
-    if args.flatten:
+    index = LigandCacheIndex.from_cache(data_dir, logger=logger)
+    logger.info(f"Found {len(index)} complexes in the cache: '{data_dir}'")
+
+    streams = {}
+    if outputs in ["both", "3d"]:
+        streams["3d"] = oechem.oemolostream(str(output_dir / "combined_3d.sdf"))
+    if outputs in ["both", "2d"]:
         logger.info("Flattening the molecules before saving them")
-        ligands = [
-            Ligand.from_smiles(
-                complex.ligand.smiles,
-                tags=complex.ligand.tags,
-                compound_name=complex.ligand.compound_name,
-                ids=complex.ligand.ids,
+        streams["2d"] = oechem.oemolostream(str(output_dir / "combined_2d.sdf"))
+
+    for entry in index:
+        if "3d" in streams:
+            oechem.OEWriteMolecule(
+                streams["3d"], entry.to_3d_ligand(data_dir).to_oemol()
             )
-            for complex in complexes
-        ]
-    else:
-        ligands = []
-        for complex in complexes:
-            lig = complex.ligand
-            lig.set_SD_data({"xtal_name": complex.target.target_name})
-            ligands.append(lig)
-    out_name = f"combined_2d.sdf" if args.flatten else "combined_3d.sdf"
-    write_ligands_to_multi_sdf(output_dir / out_name, ligands)
-    logger.info(f"Combined {len(ligands)} ligands into {output_dir / out_name}")
+        if "2d" in streams:
+            oechem.OEWriteMolecule(streams["2d"], entry.to_2d_ligand().to_oemol())
+
+    for dim, ofs in streams.items():
+        ofs.close()
+        logger.info(
+            f"Combined {len(index)} ligands into {output_dir / f'combined_{dim}.sdf'}"
+        )
 
 
 if __name__ == "__main__":
@@ -11,51 +11,60 @@ python deduplicate_ligands.py \
 """
 from pathlib import Path
 import pandas as pd
-from datetime import datetime
-import shutil
-from asapdiscovery.modeling.protein_prep import PreppedComplex
+import numpy as np
 from harbor.analysis.utils import FileLogger
+from ligand_cache_index import LigandCacheIndex
+from materialize_cache import MaterializeMode, materialize_trees
+from fragalysis_metadata import (
+    get_covalent_compounds,
+    get_date_dict,
+    load_metadata_table,
+)
 
 
 def get_duplicates(df):
+    """
+    Find the values of each column that map to more than one distinct value of a later column.
+    Each column is factorized to integer codes once and every column pair is then checked with NumPy on the codes.
+    Missing values are ignored, as they are by groupby().nunique().
+    :param df: DataFrame to check
+    :return: Dictionary of '{col1}_to_{col2}' to a Series of the offending col1 values and their number of
+        distinct col2 values
+    """
     from itertools import combinations
 
+    factorized = {col: pd.factorize(df[col], sort=True) for col in df.columns}
+
     return_dict = {}
     for col1, col2 in combinations(df.columns, 2):
-        counts = df.groupby(col1).nunique()
-        return_dict[f"{col1}_to_{col2}"] = counts[(counts[col2] > 1)].index.unique()
+        codes1, uniques1 = factorized[col1]
+        codes2, uniques2 = factorized[col2]
+        valid = (codes1 >= 0) & (codes2 >= 0)
+        pairs = np.unique(
+            codes1[valid].astype(np.int64) * len(uniques2) + codes2[valid]
+        )
+        counts = np.bincount(pairs // len(uniques2), minlength=len(uniques1))
+        offending = np.flatnonzero(counts > 1)
+        return_dict[f"{col1}_to_{col2}"] = pd.Series(
+            counts[offending], index=uniques1[offending], name="Count"
+        )
     return return_dict
 
 
-def date_processor(date_string):
-    if isinstance(date_string, str) and date_string != "None":
-        try:
-            return datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return datetime.strptime(date_string, "%d/%m/%Y %H:%M")
-    return None
-
-
-def process_crystal_data(soaks):
-    ddf = soaks.loc[:, ["Sample Name", "Data Collection Date"]]
-    ddf["Sanitized_Date"] = ddf["Data Collection Date"].apply(date_processor)
-    ddf.columns = ["Structure_Name", "Data_Collection_Date", "Structure_Date"]
-    date_dict = ddf.set_index("Structure_Name").to_dict()["Structure_Date"]
-    date_dict = {k: str(v) for k, v in date_dict.items() if str(v) != "NaT"}
-    return date_dict
-
-
-def get_records_from_complexes(complexes):
-    records = []
-    for c in complexes:
-        records.append(
-            {
-                "SMILES": c.ligand.smiles,
-                "Compound_Name": c.ligand.compound_name,
-                "Target_Name": c.target.target_name,
-            }
-        )
-    return records
+def match_target_prefixes(names: pd.Series, targets) -> pd.Series:
+    """
+    Vectorized check of which names start with any of the target names.
+    Instead of comparing every name against every target, the names are truncated to each distinct target length
+    and looked up in a hash set, so the cost grows with the number of distinct lengths rather than targets.
+    :param names: Series of names to check, e.g. prepped complex directory names
+    :param targets: Target names to use as prefixes
+    :return: Boolean Series aligned with names
+    """
+    targets = set(targets)
+    matches = pd.Series(False, index=names.index)
+    for length in {len(target) for target in targets}:
+        matches |= names.str[:length].isin(targets)
+    return matches
 
 
 @click.command()
@@ -80,7 +89,33 @@ def get_records_from_complexes(complexes):
 @click.option(
     "--remove-covalent", is_flag=True, default=False, help="Remove covalent ligands"
 )
-def main(fragalysis_dir, prepped_path, output_dir, remove_covalent):
+@click.option(
+    "--n-workers",
+    type=int,
+    default=1,
+    help="Number of processes used to read the prepped complexes",
+)
+@click.option(
+    "--materialize-mode",
+    type=click.Choice([mode.value for mode in MaterializeMode]),
+    default=MaterializeMode.COPY.value,
+    help="How to materialize the kept structures in the output directory",
+)
+@click.option(
+    "--metadata-cache",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="Directory to cache the parsed Fragalysis metadata in",
+)
+def main(
+    fragalysis_dir,
+    prepped_path,
+    output_dir,
+    remove_covalent,
+    n_workers,
+    materialize_mode,
+    metadata_cache,
+):
     """Filter and copy protein structures based on deduplication criteria."""
     # Create output directory
     output_path = Path(output_dir)
@@ -97,21 +132,21 @@ def main(fragalysis_dir, prepped_path, output_dir, remove_covalent):
 
     logger.info(f"Found {len(pcs_to_load)} prepped complexes to load.")
 
-    # Load Fragalysis data
-    pcs = [PreppedComplex.from_json_file(f) for f in pcs_to_load]
+    # Read only the ligand and target name of each prepped complex
+    index = LigandCacheIndex.from_cache(
+        prepped_path, logger=logger, n_workers=n_workers
+    )
 
     # Create initial dataframe
-    df = pd.DataFrame.from_records(get_records_from_complexes(pcs))
+    df = index.to_dataframe()
+
+    metadata = load_metadata_table(fragalysis_dir, metadata_cache, logger=logger)
 
     # Remove covalent ligands if specified
     if remove_covalent:
-        data = pd.read_csv(
-            Path(fragalysis_dir) / "extra_files" / "Mpro_compound_tracker_csv.csv"
+        suspected_covalent = get_covalent_compounds(metadata).intersection(
+            df.Compound_Name.unique()
         )
-        relevant_data = data[data["Compound ID"].isin(df.Compound_Name.unique())]
-        suspected_covalent = relevant_data[
-            relevant_data.why_suspected_SMILES == "Covalent"
-        ]["Compound ID"].unique()
         noncovalent = df[~df.Compound_Name.isin(suspected_covalent)]
 
         covalent_target_names = set(df.Target_Name.unique()) - set(
@@ -122,13 +157,9 @@ def main(fragalysis_dir, prepped_path, output_dir, remove_covalent):
         )
         df = noncovalent
 
-    # Load and process dates
-    soaks_path = Path(fragalysis_dir) / "extra_files" / "Mpro_soaks.csv"
-    soaks = pd.read_csv(soaks_path)
-    date_dict = process_crystal_data(soaks)
-
-    # Add dates and find structures to keep
-    df["Date"] = df.Target_Name.apply(lambda x: date_dict.get(x[:-3], None))
+    # Add soak dates and find structures to keep
+    date_dict = get_date_dict(metadata, "soak")
+    df["Date"] = df.Target_Name.str[:-3].map(date_dict)
 
     duplicates = get_duplicates(df)
     for key, value in duplicates.items():
@@ -154,25 +185,38 @@ def main(fragalysis_dir, prepped_path, output_dir, remove_covalent):
         f"Keeping {len(all_targets_to_keep)} unique targets after deduplication."
     )
 
-    # Copy files, skipping removed targets
+    # Decide which structures to keep in a single pass over the cache
     prepped_path = Path(prepped_path)
-    copied = 0
-    skipped = 0
-
-    for src_path in prepped_path.glob("*/*.json"):
-        src_dir = src_path.parent
-        target_name = src_dir.name
-        # Check if the target should be removed (starts with any name in targets_to_remove)
-        if any(target_name.startswith(x) for x in all_targets_to_keep):
-            dest_dir = output_path / target_name
-            shutil.copytree(src_dir, dest_dir, dirs_exist_ok=True)
-            copied += 1
-        else:
-            skipped += 1
+    src_dirs = pd.Series(
+        [str(src_path.parent) for src_path in prepped_path.glob("*/*.json")],
+        dtype=object,
+    )
+    dir_names = src_dirs.str.rsplit("/", n=1).str[-1]
+    keep = match_target_prefixes(dir_names, all_targets_to_keep)
+    copied = int(keep.sum())
+    skipped = int((~keep).sum())
+
+    # Collect the directories to materialize so copying can be split between workers; the manifest is only kept
+    # in memory, since anything written to the output directory would be published as part of the cache
+    manifest = pd.DataFrame(
+        {
+            "Source_Dir": src_dirs[keep],
+            "Destination_Dir": str(output_path) + "/" + dir_names[keep],
+        }
+    ).drop_duplicates()
+    logger.info(f"Materializing {len(manifest)} directories")
+
+    mode_counts = materialize_trees(
+        zip(manifest.Source_Dir, manifest.Destination_Dir),
+        materialize_mode,
+        n_workers=n_workers,
+    )
 
     logger.info(f"Copied {copied} files")
     logger.info(f"Skipped {skipped} files")
     logger.info(f"Total files processed: {copied + skipped}")
+    for mode, count in mode_counts.items():
+        logger.info(f"Materialized {count} files with mode '{mode.value}'")
 
 
 if __name__ == "__main__":
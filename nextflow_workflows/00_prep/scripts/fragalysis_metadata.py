@@ -0,0 +1,186 @@
+"""
+Shared reader for the Fragalysis metadata csvs.
+
+Mpro_soaks.csv, Mpro_cocrystallisation.csv and Mpro_compound_tracker_csv.csv are read once into a single
+normalized table with one row per structure and the columns:
+    Structure_Name, Compound_ID, Structure_Date, Source, Covalent
+Compounds from the compound tracker without a structure are kept with an empty Structure_Name so that the covalent
+flag is available for every compound.
+
+If a cache directory is given, the table is stored there as parquet, keyed by a hash of the input csvs, so every
+stage that needs dates or compound IDs reads the same table instead of re-parsing the csvs.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+
+SOAKS_CSV = "Mpro_soaks.csv"
+COCRYSTALS_CSV = "Mpro_cocrystallisation.csv"
+COMPOUND_TRACKER_CSV = "Mpro_compound_tracker_csv.csv"
+
+# formats used by the Data Collection Date column, tried in order
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M"]
+
+# bump this whenever the table layout or parsing changes so that cached tables are rebuilt
+METADATA_VERSION = 1
+
+
+def get_metadata_paths(fragalysis_dir: Path) -> dict:
+    extra_files = Path(fragalysis_dir) / "extra_files"
+    return {
+        "soak": extra_files / SOAKS_CSV,
+        "cocrystal": extra_files / COCRYSTALS_CSV,
+        "compound_tracker": extra_files / COMPOUND_TRACKER_CSV,
+    }
+
+
+def parse_dates(dates: pd.Series) -> pd.Series:
+    """
+    Vectorized parsing of the Data Collection Date column.
+    Missing values and the string 'None' become NaT, any other value that matches none of DATE_FORMATS is an error.
+    :param dates: Series of date strings
+    :return: Series of datetimes
+    """
+    dates = dates.astype("string")
+    dates = dates.mask(dates == "None")
+    parsed = pd.Series(pd.NaT, index=dates.index, dtype="datetime64[ns]")
+    for date_format in DATE_FORMATS:
+        missing = parsed.isna() & dates.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(
+            dates[missing], format=date_format, errors="coerce"
+        )
+    unparsed = parsed.isna() & dates.notna()
+    if unparsed.any():
+        raise ValueError(f"Could not parse dates: {dates[unparsed].unique().tolist()}")
+    return parsed
+
+
+def _read_crystal_data(path: Path, source: str) -> pd.DataFrame:
+    df = pd.read_csv(
+        path, usecols=["Sample Name", "Compound ID", "Data Collection Date"]
+    )
+    return pd.DataFrame(
+        {
+            "Structure_Name": df["Sample Name"],
+            "Compound_ID": df["Compound ID"],
+            "Structure_Date": parse_dates(df["Data Collection Date"]),
+            "Source": source,
+        }
+    )
+
+
+def build_metadata_table(fragalysis_dir: Path) -> pd.DataFrame:
+    """
+    Read and normalize the Fragalysis metadata csvs.
+    Rows keep the order of the input files, soaks first, so later rows take precedence when building dictionaries.
+    :param fragalysis_dir: Path to the fragalysis directory
+    :return: Normalized metadata table
+    """
+    paths = get_metadata_paths(fragalysis_dir)
+    crystals = pd.concat(
+        [
+            _read_crystal_data(paths["soak"], "soak"),
+            _read_crystal_data(paths["cocrystal"], "cocrystal"),
+        ],
+        ignore_index=True,
+    )
+
+    tracker = pd.read_csv(
+        paths["compound_tracker"], usecols=["Compound ID", "why_suspected_SMILES"]
+    )
+    covalent = (
+        (tracker.why_suspected_SMILES == "Covalent")
+        .groupby(tracker["Compound ID"])
+        .any()
+        .rename("Covalent")
+        .rename_axis("Compound_ID")
+        .reset_index()
+    )
+
+    table = crystals.merge(covalent, on="Compound_ID", how="left")
+    tracker_only = covalent[~covalent.Compound_ID.isin(crystals.Compound_ID)].assign(
+        Source="compound_tracker"
+    )
+    table = pd.concat([table, tracker_only], ignore_index=True)
+    table["Covalent"] = table["Covalent"].fillna(False).astype(bool)
+    return table[
+        ["Structure_Name", "Compound_ID", "Structure_Date", "Source", "Covalent"]
+    ]
+
+
+def hash_metadata_files(fragalysis_dir: Path) -> str:
+    sha = hashlib.sha256(f"version={METADATA_VERSION}".encode())
+    for name, path in sorted(get_metadata_paths(fragalysis_dir).items()):
+        sha.update(name.encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def load_metadata_table(
+    fragalysis_dir: Path, cache_dir: Path = None, logger=None
+) -> pd.DataFrame:
+    """
+    Load the normalized metadata table, from the parquet cache if it has already been built for these csvs.
+    :param fragalysis_dir: Path to the fragalysis directory
+    :param cache_dir: Optional directory to cache the table in
+    :param logger: Optional logger
+    :return: Normalized metadata table
+    """
+    if cache_dir is None:
+        return build_metadata_table(fragalysis_dir)
+
+    cache_dir = Path(cache_dir)
+    cache_fn = (
+        cache_dir / f"fragalysis_metadata_{hash_metadata_files(fragalysis_dir)}.parquet"
+    )
+    if cache_fn.exists():
+        if logger:
+            logger.info(f"Reading cached Fragalysis metadata from {cache_fn}")
+        return pd.read_parquet(cache_fn)
+
+    table = build_metadata_table(fragalysis_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so concurrent readers never see a partial table
+    tmp_fn = cache_fn.with_name(f".{cache_fn.name}.{os.getpid()}")
+    table.to_parquet(tmp_fn, index=False)
+    os.replace(tmp_fn, cache_fn)
+    if logger:
+        logger.info(f"Cached Fragalysis metadata to {cache_fn}")
+    return table
+
+
+def _dated_structures(table: pd.DataFrame, source: str) -> pd.DataFrame:
+    structures = table[table.Source == source].drop_duplicates(
+        "Structure_Name", keep="last"
+    )
+    return structures[structures.Structure_Date.notna()]
+
+
+def get_date_dict(table: pd.DataFrame, source: str) -> dict:
+    """
+    Map each dated structure from one source to its date string.
+    """
+    structures = _dated_structures(table, source)
+    return dict(zip(structures.Structure_Name, structures.Structure_Date.map(str)))
+
+
+def get_structure_to_cmpd_dict(table: pd.DataFrame, source: str) -> dict:
+    """
+    Map each dated structure from one source to its compound ID.
+    """
+    structures = _dated_structures(table, source)
+    return dict(zip(structures.Structure_Name, structures.Compound_ID))
+
+
+def get_covalent_compounds(table: pd.DataFrame) -> set:
+    """
+    Compounds flagged as covalent in the compound tracker.
+    """
+    return set(table[table.Covalent].Compound_ID.unique())
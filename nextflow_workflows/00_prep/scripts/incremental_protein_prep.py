@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+Incremental wrapper around `asap-cli protein-prep` for a curated Fragalysis directory.
+
+Each structure's inputs (its PDB and ligand files, its metadata.csv row, the loop database and the prep settings)
+are hashed into a content key. The keys of the structures in a cache are stored in prep_keys.json at the top level
+of the cache. On the next run only structures whose key is missing or has changed are prepped, and the results are
+merged with the unchanged complexes of the existing cache into the output directory.
+
+Example usage:
+python incremental_protein_prep.py \
+    --fragalysis-dir /data1/choderaj/paynea/asap-datasets/full_cross_dock_v2/mpro_fragalysis-04-01-24_curated \
+    --existing-cache /data1/choderaj/paynea/asap-datasets/full_cross_dock_v2/mpro_fragalysis-04-01-24_curated_cache \
+    --loop-db /data1/choderaj/asap-playground/rcsb_spruce.loop_db \
+    --output-dir output
+"""
+
+import hashlib
+import json
+import shutil
+import subprocess
+from collections import defaultdict
+from pathlib import Path
+
+import click
+import pandas as pd
+from harbor.analysis.utils import FileLogger
+from materialize_cache import MaterializeMode, materialize_trees
+
+KEYS_FILENAME = "prep_keys.json"
+
+# files in each aligned structure directory that are inputs to protein prep
+INPUT_SUFFIXES = {".pdb", ".mol", ".sdf"}
+
+
+def hash_file(path: Path, sha):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+
+def get_settings_key(settings: dict, loop_db: Path) -> str:
+    """
+    Hash the prep settings and the contents of the loop database.
+    """
+    sha = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    hash_file(loop_db, sha)
+    return sha.hexdigest()
+
+
+def get_structure_keys(fragalysis_dir: Path, settings_key: str) -> dict:
+    """
+    Hash the prep inputs of every structure in the aligned directory.
+    :param fragalysis_dir: Path to the curated fragalysis directory
+    :param settings_key: Hash of the prep settings, included in every key
+    :return: Dictionary of structure name to content key
+    """
+    metadata = pd.read_csv(fragalysis_dir / "metadata.csv")
+    metadata_rows = {
+        record["crystal_name"]: json.dumps(record, sort_keys=True, default=str)
+        for record in metadata.to_dict("records")
+    }
+
+    keys = {}
+    for structure_dir in sorted((fragalysis_dir / "aligned").iterdir()):
+        if not structure_dir.is_dir():
+            continue
+        name = structure_dir.name
+        sha = hashlib.sha256(settings_key.encode())
+        sha.update(metadata_rows.get(name, "").encode())
+        for fn in sorted(structure_dir.iterdir()):
+            if fn.suffix in INPUT_SUFFIXES:
+                sha.update(fn.name.encode())
+                hash_file(fn, sha)
+        keys[name] = sha.hexdigest()
+    return keys
+
+
+def get_cached_complexes(cache_dir: Path, names: list, logger=None) -> dict:
+    """
+    Map each structure name to the complex directories prepped from it in a cache.
+    Complex directories are matched to the longest structure name they start with, as in deduplicate_ligands.py,
+    rather than by the target name in the complex json, which need not be the aligned directory name.
+    :param names: Names of the aligned structure directories
+    :return: Dictionary of structure name to complex directories
+    """
+    names = set(names)
+    lengths = sorted({len(name) for name in names}, reverse=True)
+    complexes = defaultdict(list)
+    unmatched = []
+    for complex_dir in sorted(
+        {json_file.parent for json_file in cache_dir.glob("*/*.json")}
+    ):
+        name = next(
+            (
+                complex_dir.name[:length]
+                for length in lengths
+                if complex_dir.name[:length] in names
+            ),
+            None,
+        )
+        if name is None:
+            unmatched.append(complex_dir.name)
+        else:
+            complexes[name].append(complex_dir)
+    if unmatched and logger is not None:
+        logger.warning(
+            f"{len(unmatched)} complexes in '{cache_dir}' match no aligned structure and are not reused: "
+            + ", ".join(unmatched[:20])
+            + (", ..." if len(unmatched) > 20 else "")
+        )
+    return complexes
+
+
+def make_fragalysis_subset(fragalysis_dir: Path, names: list, subset_dir: Path):
+    """
+    Build a fragalysis directory with only the given structures, made of symlinks to the original.
+    """
+    (subset_dir / "aligned").mkdir(parents=True)
+    for name in names:
+        (subset_dir / "aligned" / name).symlink_to(
+            (fragalysis_dir / "aligned" / name).resolve()
+        )
+    for path in fragalysis_dir.iterdir():
+        if path.name not in ["aligned", "metadata.csv"]:
+            (subset_dir / path.name).symlink_to(path.resolve())
+    metadata = pd.read_csv(fragalysis_dir / "metadata.csv")
+    metadata[metadata.crystal_name.isin(names)].to_csv(
+        subset_dir / "metadata.csv", index=False
+    )
+
+
+@click.command()
+@click.option(
+    "--fragalysis-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Curated Fragalysis directory",
+)
+@click.option(
+    "--existing-cache",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Previously prepped cache to reuse. Ignored if it doesn't exist.",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Output directory for the merged cache",
+)
+@click.option(
+    "--loop-db",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+)
+@click.option("--target", default="SARS-CoV-2-Mpro")
+@click.option("--ref-chain", default="A")
+@click.option("--active-site-chain", default="A")
+@click.option("--dask-n-workers", type=int, default=1)
+@click.option(
+    "--materialize-mode",
+    type=click.Choice([mode.value for mode in MaterializeMode]),
+    default=MaterializeMode.COPY.value,
+    help="How to materialize the reused complexes in the output directory",
+)
+def main(
+    fragalysis_dir,
+    existing_cache,
+    output_dir,
+    loop_db,
+    target,
+    ref_chain,
+    active_site_chain,
+    dask_n_workers,
+    materialize_mode,
+):
+    """Run protein prep only on the structures that aren't already in the cache."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    logger = FileLogger(
+        "incremental_protein_prep",
+        path=output_dir,
+        logfile="incremental_protein_prep.log",
+    ).getLogger()
+
+    settings = {
+        "target": target,
+        "ref_chain": ref_chain,
+        "active_site_chain": active_site_chain,
+    }
+    keys = get_structure_keys(fragalysis_dir, get_settings_key(settings, loop_db))
+    logger.info(f"Hashed {len(keys)} structures in '{fragalysis_dir}'")
+
+    old_keys = {}
+    cached = {}
+    if existing_cache is not None and existing_cache.exists():
+        if (existing_cache / KEYS_FILENAME).exists():
+            with open(existing_cache / KEYS_FILENAME, "r") as f:
+                old_keys = json.load(f)
+        cached = get_cached_complexes(existing_cache, list(keys), logger)
+    up_to_date = sorted(
+        name
+        for name, key in keys.items()
+        if old_keys.get(name) == key and name in cached
+    )
+    to_prep = sorted(set(keys) - set(up_to_date))
+    logger.info(
+        f"Reusing {len(up_to_date)} prepped structures, prepping {len(to_prep)} structures"
+    )
+
+    new_keys = {name: keys[name] for name in up_to_date}
+    if to_prep:
+        subset_dir = Path("fragalysis_subset")
+        run_dir = Path("protein_prep_run")
+        for path in [subset_dir, run_dir]:
+            if path.exists():
+                shutil.rmtree(path)
+        make_fragalysis_subset(fragalysis_dir, to_prep, subset_dir)
+        cmd = [
+            "asap-cli",
+            "protein-prep",
+            "--target",
+            target,
+            "--fragalysis-dir",
+            str(subset_dir),
+            "--loop-db",
+            str(loop_db),
+            "--ref-chain",
+            ref_chain,
+            "--active-site-chain",
+            active_site_chain,
+            "--output-dir",
+            str(run_dir),
+        ]
+        if dask_n_workers > 1:
+            cmd += [
+                "--use-dask",
+                "--dask-n-workers",
+                str(dask_n_workers),
+                "--dask-type",
+                "local",
+            ]
+        logger.info(f"Running: {' '.join(cmd)}")
+        subprocess.run(cmd, check=True)
+
+        prepped = get_cached_complexes(run_dir, to_prep, logger)
+        failed = set(to_prep) - set(prepped)
+        if failed:
+            logger.warning(
+                f"{len(failed)} structures failed to prep and will be retried next time: {sorted(failed)}"
+            )
+        new_keys.update({name: keys[name] for name in to_prep if name in prepped})
+        for path in run_dir.iterdir():
+            shutil.move(str(path), str(output_dir / path.name))
+
+    counts = materialize_trees(
+        [
+            (complex_dir, output_dir / complex_dir.name)
+            for name in up_to_date
+            for complex_dir in cached[name]
+        ],
+        materialize_mode,
+    )
+    for mode, count in counts.items():
+        logger.info(f"Materialized {count} reused files with mode '{mode.value}'")
+
+    with open(output_dir / KEYS_FILENAME, "w") as f:
+        json.dump(new_keys, f, indent=4, sort_keys=True)
+    logger.info(f"Wrote {len(new_keys)} structure keys to {output_dir / KEYS_FILENAME}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Ligand-only index over a cache of prepped complexes.
+
+`ProteinPrepper.load_cache` deserializes every prepped complex, protein and design unit included, even when a step
+only needs the ligands. This module reads the ligand and target name from each complex json once and records them
+in a small sidecar file at the top level of the cache, so that later steps can stream the ligands straight from
+the per-complex ligand SDF files without ever touching a protein.
+"""
+
+import json
+import multiprocessing as mp
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pandas as pd
+from pydantic import BaseModel, Field
+from asapdiscovery.data.schema.ligand import Ligand
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# not a .json file, which the cache loader would try to read as a prepped complex
+INDEX_FILENAME = "ligand_index.csv"
+# columns holding a serialized dictionary
+JSON_COLUMNS = ["tags", "ids"]
+
+
+def read_complex_header(json_file: Path) -> dict:
+    """
+    Read the ligand and target name from a serialized PreppedComplex without building the protein.
+    If ijson is available the file is streamed and the serialized design unit is never held in memory,
+    otherwise the whole json is parsed with the standard library.
+    :param json_file: Path to the PreppedComplex json file
+    :return: Dictionary with the target name and the serialized ligand
+    """
+    if ijson is None:
+        with open(json_file, "r") as f:
+            data = json.load(f)
+        return {"target_name": data["target"]["target_name"], "ligand": data["ligand"]}
+
+    target_name, ligand = None, None
+    with open(json_file, "rb") as f:
+        events = ijson.parse(f, use_float=True)
+        for prefix, event, value in events:
+            if prefix == "target.target_name":
+                target_name = value
+            elif prefix == "ligand" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                for prefix, event, value in events:
+                    builder.event(event, value)
+                    if prefix == "ligand" and event == "end_map":
+                        break
+                ligand = builder.value
+            if target_name is not None and ligand is not None:
+                break
+    if target_name is None or ligand is None:
+        raise ValueError(f"Could not find the target name and ligand in {json_file}")
+    return {"target_name": target_name, "ligand": ligand}
+
+
+class LigandIndexEntry(BaseModel):
+    """
+    One prepped complex in the cache, described only by its ligand.
+    """
+
+    compound_name: str = Field(..., description="Compound name of the ligand")
+    target_name: str = Field(..., description="Target name of the prepped complex")
+    smiles: str = Field(..., description="SMILES of the ligand")
+    tags: dict = Field(default_factory=dict, description="Ligand tags")
+    ids: Optional[dict] = Field(None, description="Serialized ligand identifiers")
+    complex_json: str = Field(
+        ..., description="Path to the complex json, relative to the cache"
+    )
+    ligand_sdf: Optional[str] = Field(
+        None, description="Path to the ligand SDF, relative to the cache"
+    )
+
+    @classmethod
+    def from_complex_json(cls, json_file: Path, cache_dir: Path) -> "LigandIndexEntry":
+        header = read_complex_header(json_file)
+        ligand = Ligand.parse_obj(header["ligand"])
+        ligand_sdf = json_file.parent / f"{ligand.compound_name}.sdf"
+        return cls(
+            compound_name=ligand.compound_name,
+            target_name=header["target_name"],
+            smiles=ligand.smiles,
+            tags=ligand.tags,
+            ids=ligand.ids.dict() if ligand.ids is not None else None,
+            complex_json=str(json_file.relative_to(cache_dir)),
+            ligand_sdf=(
+                str(ligand_sdf.relative_to(cache_dir)) if ligand_sdf.exists() else None
+            ),
+        )
+
+    def to_3d_ligand(self, cache_dir: Path) -> Ligand:
+        """
+        Load the posed ligand, from its SDF if the cache has one and from the complex json otherwise.
+        The indexed tags and identifiers are kept, as on the ligand of the complex, and the target name is added as
+        the 'xtal_name' SD tag.
+        """
+        if self.ligand_sdf is not None:
+            ligand = Ligand.from_sdf(
+                cache_dir / self.ligand_sdf,
+                compound_name=self.compound_name,
+                tags=self.tags,
+                ids=self.ids,
+            )
+        else:
+            ligand = Ligand.parse_obj(
+                read_complex_header(cache_dir / self.complex_json)["ligand"]
+            )
+        ligand.set_SD_data({"xtal_name": self.target_name})
+        return ligand
+
+    def to_2d_ligand(self) -> Ligand:
+        """
+        Build a flat ligand from the indexed SMILES.
+        """
+        return Ligand.from_smiles(
+            self.smiles,
+            tags=self.tags,
+            compound_name=self.compound_name,
+            ids=self.ids,
+        )
+
+
+def _index_complex(json_file: Path, cache_dir: Path) -> LigandIndexEntry:
+    return LigandIndexEntry.from_complex_json(json_file, cache_dir)
+
+
+class LigandCacheIndex(BaseModel):
+    """
+    Sidecar index of the ligands in a prepped complex cache.
+    """
+
+    entries: list[LigandIndexEntry] = Field(default_factory=list)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[LigandIndexEntry]:
+        return iter(self.entries)
+
+    def save(self, path):
+        df = pd.DataFrame(
+            [entry.dict() for entry in self.entries],
+            columns=list(LigandIndexEntry.__fields__),
+        )
+        for column in JSON_COLUMNS:
+            df[column] = df[column].map(json.dumps)
+        df.to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path):
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        for column in JSON_COLUMNS:
+            df[column] = df[column].map(json.loads)
+        records = df.to_dict("records")
+        for record in records:
+            # an empty cell is a complex without a ligand SDF
+            record["ligand_sdf"] = record["ligand_sdf"] or None
+        return cls(entries=records)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Columnar view of the index with the columns used for deduplication.
+        """
+        return pd.DataFrame(
+            {
+                "SMILES": [entry.smiles for entry in self.entries],
+                "Compound_Name": [entry.compound_name for entry in self.entries],
+                "Target_Name": [entry.target_name for entry in self.entries],
+            }
+        )
+
+    @classmethod
+    def build(cls, cache_dir: Path, n_workers: int = 1) -> "LigandCacheIndex":
+        """
+        Index every complex json in the cache.
+        :param cache_dir: Path to the prepped complex cache
+        :param n_workers: Number of processes to read the complex jsons with
+        :return: LigandCacheIndex
+        """
+        cache_dir = Path(cache_dir)
+        tasks = [(json_file, cache_dir) for json_file in cache_dir.glob("*/*.json")]
+        n_workers = min(n_workers, mp.cpu_count())
+        if n_workers > 1 and len(tasks) > 1:
+            with mp.Pool(n_workers) as pool:
+                entries = pool.starmap(
+                    _index_complex,
+                    tasks,
+                    chunksize=max(1, len(tasks) // (4 * n_workers)),
+                )
+        else:
+            entries = [_index_complex(*task) for task in tasks]
+        return cls(entries=entries)
+
+    @classmethod
+    def from_cache(
+        cls, cache_dir: Path, logger=None, n_workers: int = 1
+    ) -> "LigandCacheIndex":
+        """
+        Load the sidecar index of the cache if it is present and up to date, otherwise build it in memory.
+        :param cache_dir: Path to the prepped complex cache
+        :param logger: Optional logger
+        :param n_workers: Number of processes to use if the index has to be built
+        :return: LigandCacheIndex
+        """
+        cache_dir = Path(cache_dir)
+        index_path = cache_dir / INDEX_FILENAME
+        if index_path.exists():
+            index = cls.load(index_path)
+            indexed = {entry.complex_json for entry in index}
+            on_disk = {
+                str(json_file.relative_to(cache_dir))
+                for json_file in cache_dir.glob("*/*.json")
+            }
+            if indexed == on_disk:
+                if logger:
+                    logger.info(f"Using ligand index '{index_path}'")
+                return index
+            if logger:
+                logger.warning(
+                    f"Ligand index '{index_path}' does not match the cache contents, rebuilding it"
+                )
+        elif logger:
+            logger.info(f"No ligand index found in '{cache_dir}', building one")
+        return cls.build(cache_dir, n_workers=n_workers)
@@ -0,0 +1,129 @@
+"""
+Utilities to materialize a copy of a prepped complex cache without duplicating every receptor file.
+
+Three modes are supported:
+    copy: a regular copy of each file
+    hardlink: each file is hard linked to the source, so no data is duplicated
+    reflink: each file is cloned with the filesystem's copy-on-write support (e.g. btrfs, XFS)
+
+Hardlinked files share their data with the source cache, so any file that is going to be modified in the
+materialized cache must first be detached with `unshare_file`. Reflinked files are copy-on-write at the
+filesystem level and need no special handling. Whenever a hardlink or reflink can't be made (e.g. across
+filesystems) the file is copied instead.
+"""
+
+import multiprocessing as mp
+import os
+import shutil
+from enum import Enum
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number for FICLONE on Linux
+FICLONE = 0x40049409
+
+
+class MaterializeMode(str, Enum):
+    COPY = "copy"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+
+
+def _reflink(src: Path, dest: Path):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    try:
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        dest.unlink(missing_ok=True)
+        raise
+    shutil.copystat(src, dest)
+
+
+def materialize_file(src: Path, dest: Path, mode: MaterializeMode) -> MaterializeMode:
+    """
+    Materialize a single file, replacing dest if it already exists.
+    :param src: Source file
+    :param dest: Destination file
+    :param mode: Materialization mode
+    :return: The mode that was actually used, which is COPY if a link could not be made
+    """
+    mode = MaterializeMode(mode)
+    if dest.exists() or dest.is_symlink():
+        dest.unlink()
+    if mode == MaterializeMode.HARDLINK:
+        try:
+            os.link(src, dest)
+            return mode
+        except OSError:
+            pass
+    elif mode == MaterializeMode.REFLINK:
+        try:
+            _reflink(src, dest)
+            return mode
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return MaterializeMode.COPY
+
+
+def materialize_tree(src_dir: Path, dest_dir: Path, mode: MaterializeMode) -> dict:
+    """
+    Materialize a directory tree, merging into dest_dir if it already exists.
+    :param src_dir: Source directory
+    :param dest_dir: Destination directory
+    :param mode: Materialization mode
+    :return: Number of files materialized with each mode
+    """
+    src_dir, dest_dir = Path(src_dir), Path(dest_dir)
+    counts = {m: 0 for m in MaterializeMode}
+    for root, _, files in os.walk(src_dir):
+        root = Path(root)
+        out_root = dest_dir / root.relative_to(src_dir)
+        out_root.mkdir(parents=True, exist_ok=True)
+        for fn in files:
+            counts[materialize_file(root / fn, out_root / fn, mode)] += 1
+    return counts
+
+
+def _merge_counts(all_counts) -> dict:
+    total = {m: 0 for m in MaterializeMode}
+    for counts in all_counts:
+        for m, count in counts.items():
+            total[m] += count
+    return total
+
+
+def materialize_trees(pairs, mode: MaterializeMode, n_workers: int = 1) -> dict:
+    """
+    Materialize many directory trees, optionally split between worker processes.
+    :param pairs: Iterable of (source directory, destination directory) pairs
+    :param mode: Materialization mode
+    :param n_workers: Number of worker processes
+    :return: Number of files materialized with each mode
+    """
+    tasks = [(Path(src), Path(dest), mode) for src, dest in pairs]
+    n_workers = min(n_workers, mp.cpu_count())
+    if n_workers > 1 and len(tasks) > 1:
+        with mp.Pool(n_workers) as pool:
+            return _merge_counts(pool.starmap(materialize_tree, tasks))
+    return _merge_counts(materialize_tree(*task) for task in tasks)
+
+
+def unshare_file(path: Path):
+    """
+    Give a file its own copy of its data so that it can be modified without touching any other link to it.
+    Only hardlinked files need this; it is a no-op for files with a single link.
+    :param path: File that is about to be modified
+    """
+    path = Path(path)
+    if path.stat().st_nlink <= 1:
+        return
+    tmp = path.with_name(f".{path.name}.unshare")
+    shutil.copy2(path, tmp)
+    os.replace(tmp, path)
@@ -8,6 +8,11 @@ from asapdiscovery.data.schema.ligand import Ligand
 import argparse
 from asapdiscovery.data.util.logging import FileLogger
 import rdkit
+from ligand_cache_index import (
+    LigandCacheIndex,
+    INDEX_FILENAME,
+)
+from materialize_cache import MaterializeMode, materialize_tree, unshare_file
 
 
 def get_args():
@@ -25,6 +30,13 @@ def get_args():
         help="Path to output cache directory. If not provided, will create a copy with '_fixed' suffix.",
         default=None,
     )
+    parser.add_argument(
+        "--materialize_mode",
+        choices=[mode.value for mode in MaterializeMode],
+        default=MaterializeMode.COPY.value,
+        help="How to materialize the output cache. With 'hardlink' or 'reflink' only the files that are modified "
+        "are actually copied.",
+    )
     return parser.parse_args()
 
 
@@ -53,8 +65,10 @@ def main():
         )
         shutil.rmtree(output_cache)
 
-    shutil.copytree(input_cache, output_cache)
+    counts = materialize_tree(input_cache, output_cache, args.materialize_mode)
     logger.info(f"Copy created successfully at '{output_cache}'")
+    for mode, count in counts.items():
+        logger.info(f"Materialized {count} files with mode '{mode.value}'")
 
     # Now work on the copy instead of the original
     # Remove protein_prep.json and protein-prep.log from the copied cache as it confuses the cache loader
@@ -72,6 +86,9 @@ def main():
         ligand = prepped_directory / "MAT-POS-5d65ec79-1.sdf"
         if not ligand.exists():
             raise FileNotFoundError(f"Ligand file {ligand} not found")
+        # the files we modify must not share their data with the input cache
+        unshare_file(ligand)
+        unshare_file(list(prepped_directory.glob("*.json"))[0])
         ligand = Ligand.from_sdf(ligand)
         # get rid of 2nd ligand
         rdmol = ligand.to_rdkit()
@@ -106,6 +123,15 @@ def main():
         prepped_complex.ligand = ligand
         prepped_complex.to_json_file(json_file)
 
+    # write the ligand index so downstream steps don't need to load the proteins
+    # any index materialized from the input cache is replaced, not modified in place
+    (output_cache / INDEX_FILENAME).unlink(missing_ok=True)
+    index = LigandCacheIndex.build(output_cache)
+    index.save(output_cache / INDEX_FILENAME)
+    logger.info(
+        f"Wrote ligand index of {len(index)} complexes to '{output_cache / INDEX_FILENAME}'"
+    )
+
     logger.info(f"Processing complete. Modified data is in '{output_cache}'")
     # Mpro-P2243_0B
     # Mpro-P2214_0B
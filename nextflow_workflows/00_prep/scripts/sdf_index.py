@@ -0,0 +1,181 @@
+"""
+Byte-offset index for multi-molecule SDF files.
+
+Instead of splitting a combined SDF file into one file per ligand, a small index is written next to it that maps
+each record number (starting at 1, as for the files written by split_sdf.py) and compound name to the byte range
+of the record. Single records or ranges of records can then be read with one seek, without any intermediate files.
+
+Example usage:
+python sdf_index.py build --sdf_fn combined_2d.sdf
+python sdf_index.py extract --sdf_fn combined_2d.sdf --record 12 --output 12.sdf
+"""
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+INDEX_SUFFIX = ".index.csv"
+RECORD_TERMINATOR = b"$$$$"
+
+
+def get_index_fn(sdf_fn: Path) -> Path:
+    sdf_fn = Path(sdf_fn)
+    return sdf_fn.with_name(sdf_fn.name + INDEX_SUFFIX)
+
+
+def build_sdf_index(sdf_fn: Path) -> pd.DataFrame:
+    """
+    Scan an SDF file once and record the byte range of every record.
+    The compound name is taken from the 'compound_name' SD tag if present and from the title line otherwise.
+    :param sdf_fn: Path to the SDF file
+    :return: DataFrame with the columns Record, Compound_Name, Start and End
+    """
+    records = []
+    start = 0
+    offset = 0
+    title = None
+    compound_name = None
+    read_name = False
+    with open(sdf_fn, "rb") as f:
+        for line in f:
+            if title is None:
+                title = line.strip().decode()
+            elif read_name:
+                compound_name = line.strip().decode()
+                read_name = False
+            elif line.startswith(b">") and b"<compound_name>" in line:
+                read_name = True
+            offset += len(line)
+            if line.rstrip(b"\r\n") == RECORD_TERMINATOR:
+                records.append(
+                    {
+                        "Record": len(records) + 1,
+                        "Compound_Name": compound_name or title,
+                        "Start": start,
+                        "End": offset,
+                    }
+                )
+                start = offset
+                title = None
+                compound_name = None
+    return pd.DataFrame.from_records(
+        records, columns=["Record", "Compound_Name", "Start", "End"]
+    )
+
+
+def write_sdf_index(sdf_fn: Path, index_fn: Path = None) -> Path:
+    index_fn = index_fn or get_index_fn(sdf_fn)
+    build_sdf_index(sdf_fn).to_csv(index_fn, index=False)
+    return index_fn
+
+
+def load_sdf_index(sdf_fn: Path, index_fn: Path = None) -> pd.DataFrame:
+    """
+    Load the index of an SDF file, building it if it doesn't exist yet.
+    """
+    index_fn = Path(index_fn or get_index_fn(sdf_fn))
+    if not index_fn.exists():
+        return build_sdf_index(sdf_fn)
+    return pd.read_csv(index_fn, dtype={"Compound_Name": str})
+
+
+def read_sdf_records(
+    sdf_fn: Path, index: pd.DataFrame, first: int, last: int = None
+) -> bytes:
+    """
+    Read a contiguous range of records from an indexed SDF file.
+    :param sdf_fn: Path to the SDF file
+    :param index: Index of the SDF file
+    :param first: First record number to read, starting at 1
+    :param last: Last record number to read, inclusive. Defaults to first.
+    :return: The raw SDF text of the records
+    """
+    last = first if last is None else last
+    rows = index[(index.Record >= first) & (index.Record <= last)]
+    if len(rows) != last - first + 1:
+        raise IndexError(
+            f"Records {first}-{last} are not all in the index of {sdf_fn} ({len(index)} records)"
+        )
+    start, end = int(rows.Start.min()), int(rows.End.max())
+    with open(sdf_fn, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def read_sdf_record_by_name(sdf_fn: Path, index: pd.DataFrame, name: str) -> bytes:
+    """
+    Read the first record with the given compound name from an indexed SDF file.
+    """
+    rows = index[index.Compound_Name == name]
+    if rows.empty:
+        raise KeyError(f"{name} is not in the index of {sdf_fn}")
+    return read_sdf_records(sdf_fn, index, int(rows.Record.iloc[0]))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Index and read multi-molecule SDF files"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser(
+        "build", help="Write the byte-offset index of an SDF file"
+    )
+    build.add_argument(
+        "-i", "--sdf_fn", type=Path, required=True, help="Path to the SDF file"
+    )
+    build.add_argument(
+        "--index_fn",
+        type=Path,
+        default=None,
+        help=f"Path to the output index. Defaults to the SDF path with '{INDEX_SUFFIX}' appended",
+    )
+
+    extract = subparsers.add_parser(
+        "extract", help="Write records of an indexed SDF file to a new file"
+    )
+    extract.add_argument(
+        "-i", "--sdf_fn", type=Path, required=True, help="Path to the SDF file"
+    )
+    extract.add_argument(
+        "--index_fn",
+        type=Path,
+        default=None,
+        help=f"Path to the index. Defaults to the SDF path with '{INDEX_SUFFIX}' appended",
+    )
+    selection = extract.add_mutually_exclusive_group(required=True)
+    selection.add_argument(
+        "--record", type=int, help="Record number to extract, starting at 1"
+    )
+    selection.add_argument(
+        "--compound_name", help="Compound name of the record to extract"
+    )
+    extract.add_argument(
+        "--last_record",
+        type=int,
+        default=None,
+        help="If given with --record, extract all records from --record to this one, inclusive",
+    )
+    extract.add_argument(
+        "-o", "--output", type=Path, required=True, help="Path to the output SDF file"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.command == "build":
+        index_fn = write_sdf_index(args.sdf_fn, args.index_fn)
+        print(f"Wrote index of '{args.sdf_fn}' to '{index_fn}'")
+    elif args.command == "extract":
+        index = load_sdf_index(args.sdf_fn, args.index_fn)
+        if args.compound_name is not None:
+            data = read_sdf_record_by_name(args.sdf_fn, index, args.compound_name)
+        else:
+            data = read_sdf_records(args.sdf_fn, index, args.record, args.last_record)
+        args.output.write_bytes(data)
+
+
+if __name__ == "__main__":
+    main()
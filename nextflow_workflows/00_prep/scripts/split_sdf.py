@@ -7,10 +7,9 @@ Taken from: https://github.com/choderalab/asapdiscovery/blob/0.2.0/asapdiscovery
 
 import argparse
 import os
-from math import floor
+from concurrent.futures import ThreadPoolExecutor
 
 from asapdiscovery.data.backend.openeye import (
-    load_openeye_sdfs,
     oechem,
     save_openeye_sdfs,
 )
@@ -54,69 +53,95 @@ def get_args():
         help="If true, will flatten the molecules before saving them. "
         "This is useful if the molecules have 3D coordinates but you want to save them as 2D",
     )
+    parser.add_argument(
+        "--n_writers",
+        default=4,
+        type=int,
+        help="Number of threads used to write the chunk files",
+    )
     return parser.parse_args()
 
 
+def iter_sdf(sdf_fn, flatten=False):
+    """
+    Read the molecules of an SDF file one at a time.
+    :param sdf_fn: Path to the SDF file
+    :param flatten: If true, generate 2D coordinates for each molecule as it is read
+    :return: Generator of molecules
+    """
+    ifs = oechem.oemolistream()
+    if not ifs.open(str(sdf_fn)):
+        raise FileNotFoundError(f"Unable to open {sdf_fn}")
+    for mol in ifs.GetOEMols():
+        # the stream reuses the same molecule, so hand out a copy
+        mol = oechem.OEMol(mol)
+        if flatten and not oechem.OEGenerate2DCoordinates(mol):
+            raise RuntimeError(
+                f"Failed to generate 2D coordinates for {mol.GetTitle()}"
+            )
+        yield mol
+    ifs.close()
+
+
+def iter_chunks(mols, chunk_size):
+    """
+    Group molecules into chunks of chunk_size, with a smaller final chunk if they don't divide evenly.
+    Only the chunk being filled is held in memory.
+    """
+    chunk = []
+    for mol in mols:
+        chunk.append(mol)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_chunk_fn(out_dir, i, mols_chunk, name_convention):
+    if name_convention == "integer":
+        return os.path.join(out_dir, f"{i+1}.sdf")
+    elif name_convention == "name":
+        if len(mols_chunk) > 1:
+            raise ValueError(
+                "When using name convention, only one molecule can be in the chunk"
+            )
+        return os.path.join(
+            out_dir, f"{oechem.OEGetSDData(mols_chunk[0], 'compound_name')}.sdf"
+        )
+
+
 def main():
     args = get_args()
     print(f"Reading '{args.sdf_fn}'")
-
-    mols = load_openeye_sdfs(args.sdf_fn)
-
     if args.flatten:
-        success = [oechem.OEGenerate2DCoordinates(mol) for mol in mols]
-        if not all(success):
-            raise RuntimeError("Failed to generate 2D coordinates for all molecules")
-        print("Flattened molecules to 2D")
-
-    print(f"Saving {len(mols)} SDF files to '{args.out_dir}'")
-
-    # If the number of molecules is not evenly divisible by the chunk size, we will have a remainder
-    # So using the floor function will get the number of evenly sized files we will make
-    # And then we can separately save a remainder file
-    n_chunks = floor(
-        len(mols) / args.chunk_size,
-    )
-    remainder = len(mols) % args.chunk_size
-    print(f"Saving {n_chunks} files of {args.chunk_size} molecules each")
+        print("Flattening molecules to 2D")
 
     if not os.path.exists(args.out_dir):
         os.makedirs(args.out_dir)
 
-    for i in range(n_chunks):
-        start = i * args.chunk_size
-        end = (i + 1) * args.chunk_size
-
-        # List slicing is smart enough to handle out of bounds endpoints
-        # So this will work even if end > len(mols), although it shouldn't need to
-        mols_chunk = mols[start:end]
-
-        if not len(mols_chunk) == args.chunk_size:
-            # I don't know how this could happen but just in case
-            raise ValueError(
-                f"In trying to slice the molecules into sets of {args.chunk_size}, we have an error:\n"
-                f"len(mols[{start}:{end}]) = {len(mols_chunk)} != {args.chunk_size} = args.chunk_size\n"
-                "Did something happen to the molecule list?"
-            )
-        if args.name_convention == "integer":
-            save_openeye_sdfs(mols_chunk, os.path.join(args.out_dir, f"{i+1}.sdf"))
-        elif args.name_convention == "name":
-            if len(mols_chunk) > 1:
-                raise ValueError(
-                    "When using name convention, only one molecule can be in the chunk"
-                )
-            mol = mols_chunk[0]
-            save_openeye_sdfs(
-                mols_chunk,
-                os.path.join(
-                    args.out_dir, f"{oechem.OEGetSDData(mol, 'compound_name')}.sdf"
-                ),
-            )
-
-    if remainder:
-        print(f"Saving {remainder} remainder molecules to {n_chunks+1}.sdf")
-        mols_chunk = mols[-remainder:]
-        save_openeye_sdfs(mols_chunk, os.path.join(args.out_dir, f"{n_chunks+1}.sdf"))
+    # Finished chunks are handed to the writer threads, but we wait on the oldest write once too many are
+    # pending so that memory stays bounded no matter how large the input is
+    max_pending = 2 * args.n_writers
+    pending = []
+    n_mols = 0
+    n_chunks = 0
+    with ThreadPoolExecutor(max_workers=args.n_writers) as executor:
+        for i, mols_chunk in enumerate(
+            iter_chunks(iter_sdf(args.sdf_fn, args.flatten), args.chunk_size)
+        ):
+            fn = get_chunk_fn(args.out_dir, i, mols_chunk, args.name_convention)
+            pending.append(executor.submit(save_openeye_sdfs, mols_chunk, fn))
+            n_mols += len(mols_chunk)
+            n_chunks += 1
+            if len(pending) >= max_pending:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+    print(
+        f"Saved {n_mols} molecules to {n_chunks} files of up to {args.chunk_size} molecules each in '{args.out_dir}'"
+    )
 
 
 if __name__ == "__main__":
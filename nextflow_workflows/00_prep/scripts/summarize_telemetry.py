@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Fit resource models to the telemetry of previous runs and recommend per-process requests.
+
+For each script, the peak RSS and wall time of its completed runs are fitted as linear functions of the size of
+its inputs. The recommendation is the fit at the largest input seen, plus the largest underestimate of the fit,
+times a safety factor. Scripts with too few runs, or inputs of a single size, fall back to the largest value seen.
+
+Example usage:
+python summarize_telemetry.py /data1/.../telemetry --output resource_recommendations.csv
+"""
+
+import json
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+MIN_RUNS_TO_FIT = 3
+
+
+def get_telemetry_files(paths: list) -> list:
+    """
+    Expand directories, such as $PIPELINE_TELEMETRY_DIR with one file per run, into their telemetry files.
+    """
+    files = []
+    for path in paths:
+        path = Path(path)
+        files.extend(sorted(path.glob("*.jsonl")) if path.is_dir() else [path])
+    return files
+
+
+def load_telemetry(paths: list) -> pd.DataFrame:
+    """
+    Read telemetry records, skipping lines that aren't valid json.
+    :param paths: Telemetry files, or directories of them
+    """
+    records = []
+    for path in get_telemetry_files(paths):
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame.from_records(records)
+
+
+def fit_upper_bound(x: np.ndarray, y: np.ndarray) -> float:
+    """
+    Predict an upper bound of y at the largest x from a linear fit and its largest underestimate.
+    """
+    if len(y) < MIN_RUNS_TO_FIT or np.unique(x).size < 2:
+        return float(y.max())
+    slope, intercept = np.polyfit(x, y, 1)
+    slope = max(slope, 0.0)
+    intercept = float(np.median(y - slope * x))
+    residual = float(np.max(y - (intercept + slope * x)))
+    return max(float(y.max()), intercept + slope * x.max() + residual)
+
+
+def summarize(df: pd.DataFrame, safety_factor: float) -> pd.DataFrame:
+    records = []
+    for script, runs in df.groupby("script"):
+        completed = runs[runs.status == "completed"]
+        if completed.empty:
+            continue
+        x = completed.input_bytes.to_numpy(dtype=float)
+        memory = fit_upper_bound(x, completed.peak_rss_bytes.to_numpy(dtype=float))
+        wall = fit_upper_bound(x, completed.wall_seconds.to_numpy(dtype=float))
+        phases = pd.DataFrame.from_records(completed.phases.tolist())
+        records.append(
+            {
+                "Script": script,
+                "N_Runs": len(runs),
+                "N_Failed": int((runs.status != "completed").sum()),
+                "Max_Input_GB": x.max() / (1 << 30),
+                "Max_Peak_RSS_GB": completed.peak_rss_bytes.max() / (1 << 30),
+                "Max_Wall_Hours": completed.wall_seconds.max() / 3600,
+                "Mean_CPU_Utilization": float(
+                    (
+                        completed.cpu_seconds
+                        / (completed.wall_seconds * completed.n_cpus)
+                    ).mean()
+                ),
+                "Recommended_Memory_GB": int(
+                    np.ceil(memory * safety_factor / (1 << 30))
+                ),
+                "Recommended_Time_Hours": float(
+                    np.ceil(wall * safety_factor / 360) / 10
+                ),
+                **{
+                    f"Median_{name}_Seconds": float(phases[name].median())
+                    for name in phases.columns
+                },
+            }
+        )
+    return pd.DataFrame.from_records(records)
+
+
+@click.command()
+@click.argument(
+    "telemetry-files",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, path_type=Path),
+)
+@click.option(
+    "--safety-factor",
+    type=float,
+    default=1.5,
+    help="Factor applied to the predicted peak memory and wall time",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default="resource_recommendations.csv",
+)
+def main(telemetry_files, safety_factor, output):
+    """Recommend memory and time requests for each script from TELEMETRY_FILES, files or directories of them."""
+    df = load_telemetry(telemetry_files)
+    summary = summarize(df, safety_factor)
+    summary.to_csv(output, index=False)
+    click.echo(
+        summary[
+            ["Script", "N_Runs", "Recommended_Memory_GB", "Recommended_Time_Hours"]
+        ].to_string(index=False)
+    )
+    click.echo(f"Wrote recommendations for {len(summary)} scripts to '{output}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Lightweight resource telemetry for pipeline scripts.
+
+Decorating a script's main() with `profile_main` records one json line per run with the wall time, CPU time and
+peak RSS of the script and its subprocesses, the size of its input files and the time spent in each phase marked
+with `phase`. A background thread samples the RSS of the process tree while the script runs, which catches the
+peak of subprocesses that are still running when the script exits. The inputs are the click parameters declared
+as existing paths, or the parameters named by `profile_main(inputs=[...])`, and are measured when the script
+starts.
+
+Records are appended to telemetry.jsonl in the working directory, next to the outputs. If $PIPELINE_TELEMETRY_DIR
+is set, each run also writes its record to a file of its own there, since appends from many hosts to one file on a
+network filesystem can interleave, and summarize_telemetry.py fits resource models from all the files.
+
+Example usage:
+@click.command()
+@profile_main
+def main(...):
+    with phase("load"):
+        ...
+"""
+
+import functools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+TELEMETRY_FILENAME = "telemetry.jsonl"
+TELEMETRY_DIR_ENV = "PIPELINE_TELEMETRY_DIR"
+SAMPLE_INTERVAL = 1.0
+
+_active = None
+
+
+def get_tree_rss() -> int:
+    """
+    Current RSS in bytes of this process and all of its descendants.
+    Without psutil only this process is measured.
+    """
+    if psutil is None:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def get_input_bytes(paths: list) -> int:
+    """
+    Total size of the existing files and directories in paths.
+    """
+    total = 0
+    for path in paths:
+        path = Path(path)
+        try:
+            if path.is_file():
+                total += path.stat().st_size
+            elif path.is_dir():
+                total += sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+        except OSError:
+            pass
+    return total
+
+
+def get_input_paths(kwargs: dict, inputs: list = None) -> list:
+    """
+    Paths passed to the declared input parameters of a click command.
+    :param kwargs: Keyword arguments the command was called with
+    :param inputs: Names of the input parameters, by default those declared as click.Path(exists=True)
+    """
+    if inputs is None:
+        try:
+            import click
+        except ImportError:
+            return []
+        context = click.get_current_context(silent=True)
+        if context is None:
+            return []
+        inputs = [
+            param.name
+            for param in context.command.params
+            if isinstance(param.type, click.Path) and param.type.exists
+        ]
+    paths = []
+    for name in inputs:
+        value = kwargs.get(name)
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            paths.extend(value)
+        else:
+            paths.append(value)
+    return paths
+
+
+class TelemetryRecorder:
+    """
+    Resource usage of one script run.
+    """
+
+    def __init__(self, script: str, interval: float = SAMPLE_INTERVAL):
+        self.script = script
+        self.interval = interval
+        self.phases = {}
+        self.peak_tree_rss = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            try:
+                self.peak_tree_rss = max(self.peak_tree_rss, get_tree_rss())
+            except OSError:
+                pass
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self, input_paths: list = ()):
+        self.start_time = time.time()
+        # measured before the script runs, so outputs written next to the inputs aren't counted
+        self.input_bytes = get_input_bytes(input_paths)
+        self._wall_start = time.perf_counter()
+        self._sampler.start()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def stop(self, status: str) -> dict:
+        wall = time.perf_counter() - self._wall_start
+        self._stop.set()
+        self._sampler.join()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux
+        return {
+            "script": self.script,
+            "argv": sys.argv[1:],
+            "status": status,
+            "hostname": socket.gethostname(),
+            "workdir": os.getcwd(),
+            "slurm_job_id": os.environ.get("SLURM_JOB_ID"),
+            "start_time": self.start_time,
+            "n_cpus": len(os.sched_getaffinity(0)),
+            "input_bytes": self.input_bytes,
+            "wall_seconds": wall,
+            "cpu_seconds": own.ru_utime
+            + own.ru_stime
+            + children.ru_utime
+            + children.ru_stime,
+            "peak_rss_bytes": max(
+                own.ru_maxrss * 1024, children.ru_maxrss * 1024, self.peak_tree_rss
+            ),
+            "phases": self.phases,
+        }
+
+
+def get_run_filename(record: dict) -> str:
+    """
+    Name of the file of one run in $PIPELINE_TELEMETRY_DIR, unique across hosts and processes.
+    """
+    return f"{Path(record['script']).stem}-{record['hostname']}-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+
+
+def write_record(record: dict):
+    line = json.dumps(record) + "\n"
+    path = Path(TELEMETRY_FILENAME)
+    try:
+        # only this task writes to its working directory
+        with open(path, "a") as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Could not write telemetry to {path}: {e}", file=sys.stderr)
+    if os.environ.get(TELEMETRY_DIR_ENV):
+        path = Path(os.environ[TELEMETRY_DIR_ENV]) / get_run_filename(record)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # written under a hidden name and renamed, so readers never see a partial record
+            tmp = path.with_name(f".{path.name}")
+            with open(tmp, "w") as f:
+                f.write(line)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not write telemetry to {path}: {e}", file=sys.stderr)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a phase of the running script, e.g. 'load', 'compute' or 'write'. A no-op outside `profile_main`.
+    """
+    if _active is None:
+        yield
+        return
+    with _active.phase(name):
+        yield
+
+
+def profile_main(func=None, *, inputs: list = None):
+    """
+    Record the resource usage of a script's main function.
+    :param inputs: Names of the parameters holding the input files and directories whose size is recorded,
+        by default those declared as click.Path(exists=True)
+    """
+    if func is None:
+        return functools.partial(profile_main, inputs=inputs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _active
+        recorder = TelemetryRecorder(Path(sys.argv[0]).name)
+        _active = recorder
+        recorder.start(get_input_paths(kwargs, inputs))
+        status = "failed"
+        try:
+            result = func(*args, **kwargs)
+            status = "completed"
+            return result
+        finally:
+            _active = None
+            write_record(recorder.stop(status))
+
+    return wrapper
@@ -2,6 +2,9 @@
 include {
     CROSS_DOCK_BY_LIGAND
     CROSS_DOCK_BY_LIGAND_MULTIPOSE
+    CROSS_DOCK_BATCH
+    SCHEDULE_DOCKING_BATCHES
+    DERIVE_SINGLE_POSE
 } from "./modules.nf"
 params.take = -1
 params.test_cache = "/data1/choderaj/paynea/asap-datasets/full_cross_dock_v2/mpro_fragalysis-04-01-24_curated_cache_fixed"
@@ -20,13 +23,13 @@ workflow RUN_LIGAND_DOCKING {
     //     cache_dir = Channel.fromPath("${params.dataPath}/${params.fixedFragalysisCache}", type: 'dir')
         cache_dir = Channel.fromPath("${params.test_cache}", type: 'dir')
 
-        // Create a channel for each ligand file and flatten it
+        // Create a channel with one entry per record of the indexed combined ligand file
+        ligand_file = file("${params.ligandFiles}/${params.ligandFile2d}")
+        ligand_index = file("${params.ligandFiles}/${params.ligandFile2dIndex}")
         ligand_files = Channel
-            .fromPath("${params.ligandFiles}/${params.split2dligandFiles}/*.sdf")
-            .map { file ->
-                def id = file.name.toString().find(/([a-zA-Z0-9_-]+)\.sdf/) { match, code -> code }
-                return tuple(id, file)
-            }
+            .fromPath("${params.ligandFiles}/${params.ligandFile2dIndex}")
+            .splitCsv(header: true)
+            .map { row -> tuple(row.Record, row.Record, ligand_file, ligand_index) }
 
         // Count ligand_files
         ligand_files.count().view { count -> "Total ligand files found: $count" }
@@ -60,13 +63,13 @@ workflow RUN_LIGAND_DOCKING_MULTIPOSE {
     //     cache_dir = Channel.fromPath("${params.dataPath}/${params.fixedFragalysisCache}", type: 'dir')
         cache_dir = Channel.fromPath("${params.test_cache}", type: 'dir')
 
-        // Create a channel for each ligand file and flatten it
+        // Create a channel with one entry per record of the indexed combined ligand file
+        ligand_file = file("${params.ligandFiles}/${params.ligandFile2d}")
+        ligand_index = file("${params.ligandFiles}/${params.ligandFile2dIndex}")
         ligand_files = Channel
-            .fromPath("${params.ligandFiles}/${params.split2dligandFiles}/*.sdf")
-            .map { file ->
-                def id = file.name.toString().find(/([a-zA-Z0-9_-]+)\.sdf/) { match, code -> code }
-                return tuple(id, file)
-            }
+            .fromPath("${params.ligandFiles}/${params.ligandFile2dIndex}")
+            .splitCsv(header: true)
+            .map { row -> tuple(row.Record, row.Record, ligand_file, ligand_index) }
 
         // Count ligand_files
         ligand_files.count().view { count -> "Total ligand files found: $count" }
@@ -86,15 +89,75 @@ workflow RUN_LIGAND_DOCKING_MULTIPOSE {
             pairwise_selector,
             num_poses
     )
+
+    emit:
+        docked = CROSS_DOCK_BY_LIGAND_MULTIPOSE.out.docked
 }
+workflow RUN_LIGAND_DOCKING_BATCHED {
+    take:
+        num_poses
+        posit_method
+        pairwise_selector
+        extra_args
 
-workflow POSIT_MULTIPOSE {
-    RUN_LIGAND_DOCKING_MULTIPOSE(
-        50,
-        'ALL',
-        'PairwiseSelector'
+    main:
+        input_dir = Channel.fromPath("${params.test_dir}", type: 'dir')
+        cache_dir = Channel.fromPath("${params.test_cache}", type: 'dir')
+
+        ligand_file = file("${params.ligandFiles}/${params.ligandFile2d}")
+        ligand_index = file("${params.ligandFiles}/${params.ligandFile2dIndex}")
+        if (params.costAwareBatching) {
+            // Cut the records into contiguous batches of about equal predicted cost, with per-batch resource hints
+            traces = params.dockingTraces ? Channel.fromPath(params.dockingTraces).collect() : Channel.value([])
+            SCHEDULE_DOCKING_BATCHES(Channel.of(tuple(ligand_file, ligand_index)), traces)
+            ligand_batches = SCHEDULE_DOCKING_BATCHES.out.schedule
+                .splitCsv(header: true)
+                .map { row -> tuple(
+                    row.First_Record as Integer,
+                    row.Last_Record as Integer,
+                    ligand_file,
+                    ligand_index,
+                    row.Time_Minutes ? row.Time_Minutes as Integer : null,
+                    row.Memory_GB ? row.Memory_GB as Integer : null
+                ) }
+        } else {
+            // Group consecutive records of the indexed combined ligand file into batches,
+            // so that each task loads the receptor cache once per worker rather than once per ligand
+            ligand_batches = Channel
+                .fromPath("${params.ligandFiles}/${params.ligandFile2dIndex}")
+                .splitCsv(header: true)
+                .take(params.take)
+                .map { row -> row.Record as Integer }
+                .buffer(size: params.dockingBatchSize, remainder: true)
+                .map { records -> tuple(records.min(), records.max(), ligand_file, ligand_index, null, null) }
+        }
+
+        ligand_batches.count().view { count -> "Total ligand batches: $count" }
+
+        docking_combinations = input_dir
+            .combine(cache_dir)
+            .combine(ligand_batches)
+
+        CROSS_DOCK_BATCH(
+            docking_combinations,
+            posit_method,
+            pairwise_selector,
+            num_poses,
+            extra_args
     )
 }
+
+workflow POSIT_MULTIPOSE {
+    main:
+        RUN_LIGAND_DOCKING_MULTIPOSE(
+            50,
+            'ALL',
+            'PairwiseSelector'
+        )
+
+    emit:
+        docked = RUN_LIGAND_DOCKING_MULTIPOSE.out.docked
+}
 workflow FRED_MULTIPOSE {
     RUN_LIGAND_DOCKING_MULTIPOSE(
         50,
@@ -119,9 +182,63 @@ workflow FRED_SINGLE_POSE {
     )
 }
 
+workflow POSIT_MULTIPOSE_BATCHED {
+    RUN_LIGAND_DOCKING_BATCHED(
+        50,
+        'ALL',
+        'PairwiseSelector',
+        '--allow-final-clash'
+    )
+}
+
+workflow POSIT_SINGLE_POSE_BATCHED {
+    RUN_LIGAND_DOCKING_BATCHED(
+        1,
+        'ALL',
+        'PairwiseSelector',
+        '--allow-retries --allow-final-clash --relax-mode clash'
+    )
+}
+
+workflow FRED_SINGLE_POSE_BATCHED {
+    RUN_LIGAND_DOCKING_BATCHED(
+        1,
+        'FRED',
+        'PairwiseSelector',
+        '--allow-retries --allow-final-clash --relax-mode clash'
+    )
+}
+
+// Single pose datasets derived from the published multipose runs by keeping the top ranked pose of each pair.
+// They are published as *_1_poses_derived rather than replacing the docked single pose datasets: the POSIT multipose
+// run docks without --allow-retries and --relax-mode clash (see CROSS_DOCK_BY_LIGAND_MULTIPOSE), so its top poses
+// come from a different protocol than POSIT_SINGLE_POSE until COMPARE_DERIVED_SINGLE_POSE shows that they agree.
+def docked_dirs(dataset_name) {
+    return Channel.fromPath("${params.dockedFiles}/${dataset_name}/*_docked", type: 'dir').collect()
+}
+
+workflow POSIT_SINGLE_POSE_FROM_MULTIPOSE {
+    DERIVE_SINGLE_POSE(docked_dirs('ALL_50_poses').map { dirs -> tuple('ALL_1_poses_derived', '', dirs, []) })
+}
+
+workflow FRED_SINGLE_POSE_FROM_MULTIPOSE {
+    DERIVE_SINGLE_POSE(docked_dirs('FRED_50_poses').map { dirs -> tuple('FRED_1_poses_derived', '', dirs, []) })
+}
+
+// Derive single pose datasets next to existing single pose runs and report where they disagree
+workflow COMPARE_DERIVED_SINGLE_POSE {
+    posit = docked_dirs('ALL_50_poses').map { dirs -> [dirs] }
+        .combine(docked_dirs('ALL_1_poses').map { dirs -> [dirs] })
+        .map { multipose, compare -> tuple('ALL_1_poses_derived', 'ALL_1_poses', multipose, compare) }
+    fred = docked_dirs('FRED_50_poses').map { dirs -> [dirs] }
+        .combine(docked_dirs('FRED_1_poses').map { dirs -> [dirs] })
+        .map { multipose, compare -> tuple('FRED_1_poses_derived', 'FRED_1_poses', multipose, compare) }
+    DERIVE_SINGLE_POSE(posit.mix(fred))
+}
+
 workflow {
     // Run workflows
     POSIT_MULTIPOSE()
     POSIT_SINGLE_POSE()
     FRED_SINGLE_POSE()
-}
\ No newline at end of file
+}
@@ -7,7 +7,7 @@ process CROSS_DOCK_BY_LIGAND {
     time 100.h
 
     input:
-    tuple path(input_dir), path(prepped_dir), val(compound_name), path(ligandFile2d)
+    tuple path(input_dir), path(prepped_dir), val(compound_name), val(record), path(ligandFile2d), path(ligandIndex2d)
     val posit_method
     val selector
     val num_poses
@@ -17,6 +17,12 @@ process CROSS_DOCK_BY_LIGAND {
 
     script:
     """
+    python3 "${params.prepScripts}"/sdf_index.py extract \
+    --sdf_fn "${ligandFile2d}" \
+    --index_fn "${ligandIndex2d}" \
+    --record ${record} \
+    --output "${compound_name}.sdf"
+
     asap-docking cross-docking \
     --target SARS-CoV-2-Mpro \
     --use-omega \
@@ -27,7 +33,7 @@ process CROSS_DOCK_BY_LIGAND {
     --posit-method "${posit_method}" \
     --structure-selector "${selector}" \
     --fragalysis-dir ${input_dir} \
-    --ligands "${ligandFile2d}" \
+    --ligands "${compound_name}.sdf" \
     --cache-dir "${prepped_dir}" \
     --output-dir "${compound_name}_docked" \
     --overwrite \
@@ -46,7 +52,7 @@ process CROSS_DOCK_BY_LIGAND_MULTIPOSE {
     time 100.h
 
     input:
-    tuple path(input_dir), path(prepped_dir), val(compound_name), path(ligandFile2d)
+    tuple path(input_dir), path(prepped_dir), val(compound_name), val(record), path(ligandFile2d), path(ligandIndex2d)
     val posit_method
     val selector
     val num_poses
@@ -56,6 +62,12 @@ process CROSS_DOCK_BY_LIGAND_MULTIPOSE {
 
     script:
     """
+    python3 "${params.prepScripts}"/sdf_index.py extract \
+    --sdf_fn "${ligandFile2d}" \
+    --index_fn "${ligandIndex2d}" \
+    --record ${record} \
+    --output "${compound_name}.sdf"
+
     asap-docking cross-docking \
     --target SARS-CoV-2-Mpro \
     --use-omega \
@@ -64,7 +76,7 @@ process CROSS_DOCK_BY_LIGAND_MULTIPOSE {
     --posit-method "${posit_method}" \
     --structure-selector "${selector}" \
     --fragalysis-dir ${input_dir} \
-    --ligands "${ligandFile2d}" \
+    --ligands "${compound_name}.sdf" \
     --cache-dir "${prepped_dir}" \
     --output-dir "${compound_name}_docked" \
     --overwrite \
@@ -72,4 +84,94 @@ process CROSS_DOCK_BY_LIGAND_MULTIPOSE {
     --use-only-cache \
     --num-poses "${num_poses}" \
     """
-}
\ No newline at end of file
+}
+process CROSS_DOCK_BATCH {
+    publishDir "${params.dockedFiles}/${posit_method}_${num_poses}_poses", mode: 'link', overwrite: true
+    conda "${params.drugforge}"
+    tag "cross-dock records ${first_record}-${last_record}"
+    // a preempted or timed out batch is retried; only docking from the receptor store keeps a ledger and
+    // resumes from it, a batch docked through asap-docking starts over
+    errorStrategy { task.exitStatus in [137,140,143,247] ? 'retry' : 'finish' }
+    maxRetries 3
+    cpus params.dockingWorkers
+    clusterOptions "--partition \"cpu\" --cpus-per-task=${params.dockingWorkers}"
+    // per-batch hints from SCHEDULE_DOCKING_BATCHES, scaled up on each retry
+    memory { memory_gb ? "${memory_gb * task.attempt} GB" : params.dockingMemoryPerWorker * params.dockingWorkers }
+    time { time_minutes ? "${time_minutes * task.attempt} min" : 100.h }
+
+    input:
+    tuple path(input_dir), path(prepped_dir), val(first_record), val(last_record), path(ligandFile2d), path(ligandIndex2d), val(time_minutes), val(memory_gb)
+    val posit_method
+    val selector
+    val num_poses
+    val extra_args
+
+    output:
+    path("*_docked/*"), emit: docked
+
+    script:
+    """
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/batch_cross_docking.py \
+    --ligand-file "${ligandFile2d}" \
+    --index-file "${ligandIndex2d}" \
+    --first-record ${first_record} \
+    --last-record ${last_record} \
+    --fragalysis-dir ${input_dir} \
+    --cache-dir "${prepped_dir}" \
+    --posit-method "${posit_method}" \
+    --structure-selector "${selector}" \
+    --num-poses ${num_poses} \
+    --n-workers ${task.cpus} \
+    ${params.receptorStoreDir ? "--receptor-store-dir ${params.receptorStoreDir} --receptor-store-parity-report ${params.receptorStoreParityReport} --conformer-cache-dir ${params.omegaConformerCache} --ledger-dir ${params.dockingLedgers}/${posit_method}_${num_poses}_poses" : ''} \
+    ${extra_args}
+    """
+}
+
+process SCHEDULE_DOCKING_BATCHES {
+    conda "${params.drugforge}"
+    tag "schedule-docking-batches"
+    label 'cpushort'
+
+    input:
+    tuple path(ligandFile2d), path(ligandIndex2d)
+    path(traces)
+
+    output:
+    path("docking_batches.csv"), emit: schedule
+
+    script:
+    def trace_args = traces.collect { "--trace ${it}" }.join(' ')
+    """
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/schedule_docking_batches.py \
+    --ligand-file "${ligandFile2d}" \
+    --index-file "${ligandIndex2d}" \
+    --batch-size ${params.dockingBatchSize} \
+    --max-records ${params.take} \
+    --n-workers ${params.dockingWorkers} \
+    ${trace_args} \
+    --output docking_batches.csv
+    """
+}
+
+process DERIVE_SINGLE_POSE {
+    publishDir "${params.dockedFiles}", mode: 'copy', overwrite: true
+    conda "${params.drugforge}"
+    tag "derive-single-pose ${output_name}"
+    label 'cpushort'
+
+    input:
+    tuple val(output_name), val(compare_name), path(multipose_dirs, stageAs: 'multipose/*'), path(compare_dirs, stageAs: 'compare/*')
+
+    output:
+    path("${output_name}"), emit: derived
+    path("*.csv"), emit: report, optional: true
+
+    script:
+    def compare = compare_name ? "--compare-dir compare --report \"${output_name}_vs_${compare_name}.csv\"" : ''
+    """
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/subset_poses.py \
+    --multipose-dir multipose \
+    --output-dir "${output_name}" \
+    ${compare}
+    """
+}
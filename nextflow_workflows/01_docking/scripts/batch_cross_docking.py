@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+"""
+Dock a batch of ligands from the indexed combined SDF file against the prepped receptor cache.
+
+Running `asap-docking cross-docking` once per ligand means every job deserializes the whole receptor cache for a
+single ligand. Here a contiguous range of records is split into one sub-batch per worker, and each worker runs a
+single `asap-docking cross-docking` call on a multi-ligand SDF file, so the receptor cache is loaded once per
+worker instead of once per ligand.
+
+With --receptor-store-dir the workers don't call asap-docking at all. The cache is packed once per node into a
+memory-mapped receptor store (see receptor_store.py) and each worker docks its ligands in process, one reference
+structure at a time, so it only ever holds the receptor it is docking against. This path reimplements the
+asap-docking outputs, so it requires a passing report of check_receptor_store_parity.py.
+
+Results are written to one '<first>-<last>_docked' directory per sub-batch, with the same layout as the
+'<compound_name>_docked' directories of the single ligand processes.
+
+Example usage:
+python batch_cross_docking.py \
+    --ligand-file combined_2d.sdf \
+    --first-record 1 \
+    --last-record 64 \
+    --fragalysis-dir mpro_fragalysis-04-01-24_curated \
+    --cache-dir mpro_fragalysis-04-01-24_curated_cache_fixed \
+    --posit-method ALL \
+    --allow-retries \
+    --relax-mode clash \
+    --n-workers 4
+"""
+
+import multiprocessing as mp
+import subprocess
+from pathlib import Path
+
+import click
+import pandas as pd
+from asapdiscovery.data.util.logging import FileLogger
+from conformer_cache import ConformerCache
+from docking_ledger import DockingLedger, get_ledger_key
+from receptor_store import ReceptorStore, check_parity_report, get_cache_key
+from sdf_index import load_sdf_index, read_sdf_records
+from telemetry import phase, profile_main
+
+
+def split_records(first: int, last: int, n_batches: int) -> list:
+    """
+    Split an inclusive range of record numbers into at most n_batches contiguous (first, last) ranges.
+    """
+    n_records = last - first + 1
+    n_batches = max(1, min(n_batches, n_records))
+    size, extra = divmod(n_records, n_batches)
+    batches = []
+    start = first
+    for i in range(n_batches):
+        end = start + size + (1 if i < extra else 0) - 1
+        batches.append((start, end))
+        start = end + 1
+    return batches
+
+
+def extract_batch(first: int, last: int, ligand_file: Path, index_file: Path) -> Path:
+    batch_sdf = Path(f"{first}-{last}.sdf")
+    index = load_sdf_index(ligand_file, index_file)
+    batch_sdf.write_bytes(read_sdf_records(ligand_file, index, first, last))
+    return batch_sdf
+
+
+def get_cli_args(settings: dict) -> list:
+    """
+    Translate the docking settings into asap-docking cross-docking arguments.
+    """
+    args = [
+        "--target",
+        "SARS-CoV-2-Mpro",
+        "--use-omega",
+        "--omega-dense",
+        "--posit-method",
+        settings["posit_method"],
+        "--structure-selector",
+        settings["structure_selector"],
+        "--fragalysis-dir",
+        str(settings["fragalysis_dir"]),
+        "--cache-dir",
+        str(settings["cache_dir"]),
+        "--overwrite",
+        "--no-save-to-cache",
+        "--use-only-cache",
+        "--num-poses",
+        str(settings["num_poses"]),
+    ]
+    if settings["allow_retries"]:
+        args.append("--allow-retries")
+    if settings["allow_final_clash"]:
+        args.append("--allow-final-clash")
+    if settings["relax_mode"] is not None:
+        args += ["--relax-mode", settings["relax_mode"]]
+    return args + list(settings["extra_args"])
+
+
+def dock_batch(
+    first: int,
+    last: int,
+    ligand_file: Path,
+    index_file: Path,
+    settings: dict,
+    log_dir: Path,
+) -> tuple:
+    """
+    Extract a range of records and dock them with a single asap-docking call.
+    :return: The record range and the return code of asap-docking
+    """
+    batch_sdf = extract_batch(first, last, ligand_file, index_file)
+    cmd = [
+        "asap-docking",
+        "cross-docking",
+        "--ligands",
+        str(batch_sdf),
+        "--output-dir",
+        f"{first}-{last}_docked",
+        *get_cli_args(settings),
+    ]
+    with open(log_dir / f"{first}-{last}.log", "w") as log:
+        result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+    return first, last, result.returncode
+
+
+def get_docker(settings: dict, use_omega: bool = True):
+    from asapdiscovery.docking.openeye import (
+        POSIT_METHOD,
+        POSIT_RELAX_MODE,
+        POSITDocker,
+    )
+
+    return POSITDocker(
+        posit_method=POSIT_METHOD[settings["posit_method"]],
+        relax_mode=POSIT_RELAX_MODE[(settings["relax_mode"] or "none").upper()],
+        use_omega=use_omega,
+        omega_dense=True,
+        num_poses=settings["num_poses"],
+        allow_retries=settings["allow_retries"],
+        allow_final_clash=settings["allow_final_clash"],
+    )
+
+
+def dock_against_complex(docker, prepped_complex, ligands: list) -> tuple:
+    """
+    Dock ligands against one prepped complex and score the poses.
+    The docking results hold on to the receptor, so only the posed ligands and scores are returned.
+    :return: List of posed ligands and DataFrame of scores
+    """
+    from asapdiscovery.docking.docking import DockingInputPair
+    from asapdiscovery.docking.scorer import ChemGauss4Scorer, MetaScorer
+
+    pairs = [
+        DockingInputPair(complex=prepped_complex, ligand=ligand) for ligand in ligands
+    ]
+    results = docker.dock(pairs, use_dask=False)
+    posed = []
+    for result in results:
+        posed_ligand = result.posed_ligand
+        posed_ligand.set_SD_data(
+            {
+                "ReferenceStructureName": prepped_complex.target.target_name,
+                "ReferenceLigandName": prepped_complex.ligand.compound_name,
+            }
+        )
+        posed.append(posed_ligand)
+    if not results:
+        return posed, pd.DataFrame()
+    scores = MetaScorer(scorers=[ChemGauss4Scorer()]).score(results, return_df=True)
+    return posed, scores
+
+
+def get_ledger_path(first: int, last: int, settings: dict, batch_sdf: Path) -> Path:
+    ledger_dir = settings["ledger_dir"] or Path(".")
+    key = get_ledger_key(
+        settings, get_cache_key(settings["cache_dir"]), batch_sdf.read_bytes()
+    )
+    return Path(ledger_dir) / f"{first}-{last}_{key[:16]}.jsonl"
+
+
+def dock_batch_from_store(
+    first: int,
+    last: int,
+    ligand_file: Path,
+    index_file: Path,
+    settings: dict,
+    log_dir: Path,
+) -> tuple:
+    """
+    Dock a range of records in process against every complex in the receptor store,
+    rebuilding one receptor at a time. Each finished pair is committed to the batch's ledger,
+    and pairs that are already in the ledger are skipped. With a conformer cache, each ligand's
+    Omega ensemble is looked up or built once and docked without running Omega again.
+    :return: The record range and 0 on success or 1 on failure
+    """
+    from asapdiscovery.data.backend.openeye import oemol_to_sdf_string
+    from asapdiscovery.data.readers.molfile import MolFileFactory
+
+    logger = FileLogger(
+        f"dock_{first}-{last}", path=log_dir, logfile=f"{first}-{last}.log"
+    ).getLogger()
+    try:
+        batch_sdf = extract_batch(first, last, ligand_file, index_file)
+        ligands = MolFileFactory(filename=batch_sdf).load()
+        ledger = DockingLedger(get_ledger_path(first, last, settings, batch_sdf))
+        logger.info(f"Resuming from {len(ledger)} docked pairs in {ledger.path}")
+        store = ReceptorStore.from_cache(
+            settings["cache_dir"], settings["receptor_store_dir"]
+        )
+        docker = get_docker(settings)
+        conformer_cache = None
+        if settings["conformer_cache_dir"] is not None:
+            conformer_cache = ConformerCache(settings["conformer_cache_dir"])
+            conformer_docker = get_docker(settings, use_omega=False)
+        prepared = {}
+
+        def prepare(ligand) -> tuple:
+            # the docker and input ligand to dock a ligand with, falling back to
+            # running Omega in the docker if the conformers can't be built
+            if conformer_cache is None:
+                return docker, ligand
+            if ligand.compound_name not in prepared:
+                conformers = conformer_cache.get_conformers(ligand)
+                if conformers is None:
+                    logger.warning(
+                        f"Omega failed for {ligand.compound_name}, docking with POSIT's own Omega"
+                    )
+                    prepared[ligand.compound_name] = (docker, ligand)
+                else:
+                    prepared[ligand.compound_name] = (conformer_docker, conformers)
+            return prepared[ligand.compound_name]
+
+        for name in store.names:
+            todo = [
+                ligand
+                for ligand in ligands
+                if not ledger.is_done(ligand.compound_name, name)
+            ]
+            if not todo:
+                continue
+            prepped_complex = store.get_complex(name)
+            for ligand in todo:
+                ligand_docker, ligand_input = prepare(ligand)
+                posed, scores = dock_against_complex(
+                    ligand_docker, prepped_complex, [ligand_input]
+                )
+                ledger.append(
+                    ligand.compound_name,
+                    name,
+                    [oemol_to_sdf_string(pose.to_oemol()) for pose in posed],
+                    scores,
+                )
+            logger.info(f"Docked {len(todo)} ligands against {name}")
+        ledger.write_results(
+            Path(f"{first}-{last}_docked"),
+            [ligand.compound_name for ligand in ligands],
+            store.names,
+        )
+        store.close()
+        ledger.close()
+    except Exception:
+        logger.exception(f"Docking failed for records {first}-{last}")
+        return first, last, 1
+    return first, last, 0
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "--ligand-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+    help="Combined 2D ligand SDF file",
+)
+@click.option(
+    "--index-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Byte-offset index of the ligand file. Defaults to the ligand file path with '.index.csv' appended.",
+)
+@click.option("--first-record", type=int, required=True, help="First record to dock")
+@click.option(
+    "--last-record", type=int, required=True, help="Last record to dock, inclusive"
+)
+@click.option(
+    "--fragalysis-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Prepped receptor cache",
+)
+@click.option("--posit-method", default="ALL")
+@click.option("--structure-selector", default="PairwiseSelector")
+@click.option("--num-poses", type=int, default=1)
+@click.option("--allow-retries", is_flag=True, default=False)
+@click.option("--allow-final-clash", is_flag=True, default=False)
+@click.option(
+    "--relax-mode",
+    type=click.Choice(["none", "clash", "all"]),
+    default=None,
+    help="POSIT relax mode. Defaults to the asap-docking default.",
+)
+@click.option(
+    "--n-workers",
+    type=int,
+    default=1,
+    help="Number of docking worker processes, each of which loads the receptor cache once",
+)
+@click.option(
+    "--receptor-store-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Node-local directory for the memory-mapped receptor store. If given, ligands are docked in process "
+    "against every complex in the cache, which only supports the PairwiseSelector.",
+)
+@click.option(
+    "--receptor-store-parity-report",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Passing report of check_receptor_store_parity.py for the installed asapdiscovery release. "
+    "Required with --receptor-store-dir.",
+)
+@click.option(
+    "--ledger-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Persistent directory for the completion ledgers of docking from the receptor store, so that a restarted job "
+    "skips the pairs that are already docked. Defaults to the working directory.",
+)
+@click.option(
+    "--conformer-cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Persistent Omega conformer cache shared between campaigns. Only used with --receptor-store-dir.",
+)
+@click.argument("extra_args", nargs=-1, type=click.UNPROCESSED)
+# the fragalysis and prepped complex caches are shared by every batch, so only the ligands are measured
+@profile_main(inputs=["ligand_file"])
+def main(
+    ligand_file,
+    index_file,
+    first_record,
+    last_record,
+    fragalysis_dir,
+    cache_dir,
+    posit_method,
+    structure_selector,
+    num_poses,
+    allow_retries,
+    allow_final_clash,
+    relax_mode,
+    n_workers,
+    receptor_store_dir,
+    receptor_store_parity_report,
+    ledger_dir,
+    conformer_cache_dir,
+    extra_args,
+):
+    """Dock a range of records from an indexed ligand file. Extra arguments are passed on to asap-docking."""
+    log_dir = Path("logs")
+    log_dir.mkdir(exist_ok=True)
+    logger = FileLogger(
+        "batch_cross_docking", path=log_dir, logfile="batch_cross_docking.log"
+    ).getLogger()
+
+    settings = {
+        "posit_method": posit_method,
+        "structure_selector": structure_selector,
+        "fragalysis_dir": fragalysis_dir,
+        "cache_dir": cache_dir,
+        "num_poses": num_poses,
+        "allow_retries": allow_retries,
+        "allow_final_clash": allow_final_clash,
+        "relax_mode": relax_mode,
+        "receptor_store_dir": receptor_store_dir,
+        "ledger_dir": ledger_dir,
+        "conformer_cache_dir": conformer_cache_dir,
+        "extra_args": extra_args,
+    }
+    if receptor_store_dir is not None:
+        if structure_selector != "PairwiseSelector":
+            raise ValueError(
+                "Docking from the receptor store only supports the PairwiseSelector"
+            )
+        if extra_args:
+            raise ValueError(
+                f"Extra asap-docking arguments are not supported with the receptor store: {extra_args}"
+            )
+        if receptor_store_parity_report is None:
+            raise ValueError(
+                "Docking from the receptor store requires --receptor-store-parity-report, "
+                "see check_receptor_store_parity.py"
+            )
+        check_parity_report(
+            receptor_store_parity_report,
+            conformer_cache=conformer_cache_dir is not None,
+        )
+        # build the store before the workers start so they only ever map it
+        with phase("load"):
+            ReceptorStore.from_cache(
+                cache_dir, receptor_store_dir, logger=logger
+            ).close()
+        dock_fn = dock_batch_from_store
+    else:
+        if conformer_cache_dir is not None:
+            logger.warning(
+                "The conformer cache is only used with --receptor-store-dir, asap-docking will run Omega itself"
+            )
+        if ledger_dir is not None:
+            logger.warning(
+                "The ledger is only kept with --receptor-store-dir, a restarted batch docks every record again"
+            )
+        dock_fn = dock_batch
+
+    batches = split_records(first_record, last_record, n_workers)
+    logger.info(
+        f"Docking records {first_record}-{last_record} in {len(batches)} batches"
+    )
+    tasks = [
+        (first, last, ligand_file, index_file, settings, log_dir)
+        for first, last in batches
+    ]
+    with phase("compute"), mp.Pool(len(batches)) as pool:
+        results = pool.starmap(dock_fn, tasks)
+
+    failed = [(first, last) for first, last, returncode in results if returncode != 0]
+    for first, last in failed:
+        logger.error(f"Docking failed for records {first}-{last}")
+    logger.info(f"Docked {len(results) - len(failed)} of {len(results)} batches")
+    if failed:
+        # fail the task so that the workflow's error strategy retries it instead of publishing partial results
+        raise RuntimeError(
+            f"Docking failed for {len(failed)} of {len(results)} batches: "
+            + ", ".join(f"{first}-{last}" for first, last in failed)
+        )
+
+
+if __name__ == "__main__":
+    main()
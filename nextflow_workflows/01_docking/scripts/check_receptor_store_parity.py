@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Check that in-process docking from the receptor store gives the same results as asap-docking.
+
+The in-process path of batch_cross_docking.py rebuilds the docker, the scorer and the SD tags that
+`asap-docking cross-docking` would have written, so it can drift from the CLI whenever asapdiscovery changes. This
+script docks the same few records both ways against a small cache and compares the results pose by pose: the poses
+present, the SD tags the collection and analysis stages read, and every score column of the raw scores.
+
+With --conformer-cache-dir the in-process path docks prebuilt Omega ensembles from the conformer cache, see
+conformer_cache.py, instead of letting POSIT run Omega. It is then run twice, once building the ensembles and once
+reading them back from the cache, and both runs are compared to asap-docking.
+
+The outcome is written to a json report along with the installed asapdiscovery release and whether the conformer
+cache was used. batch_cross_docking.py only docks from the receptor store when given a passing report for the
+installed release that covers the conformer cache if it uses one, see receptor_store.check_parity_report.
+
+Example usage:
+python check_receptor_store_parity.py \
+    --ligand-file combined_2d.sdf \
+    --first-record 1 \
+    --last-record 2 \
+    --fragalysis-dir mpro_fragalysis-04-01-24_curated_small \
+    --cache-dir mpro_fragalysis-04-01-24_curated_small_cache \
+    --posit-method ALL \
+    --num-poses 5 \
+    --conformer-cache-dir omega_conformer_cache \
+    --report receptor_store_parity.json
+"""
+
+import json
+import os
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from batch_cross_docking import dock_batch, dock_batch_from_store
+from receptor_store import PARITY_TAGS, get_asapdiscovery_release, get_cache_key
+from subset_poses import RESULTS_SDF, SCORES_CSV, iter_sdf_records
+
+SCORE_KEYS = ["docking-structure-POSIT", "ligand_id", "pose_id"]
+
+
+def load_poses(docked_dir: Path) -> dict:
+    """
+    Read the parity tags of every pose in a docked directory.
+    :return: Dictionary of (ligand, reference structure, Pose_ID) to the parity tags of the pose
+    """
+    poses = {}
+    for name, tags, _ in iter_sdf_records(docked_dir / RESULTS_SDF):
+        key = (name, tags.get("ReferenceStructureName"), tags.get("Pose_ID"))
+        poses[key] = {tag: tags.get(tag) for tag in PARITY_TAGS}
+    return poses
+
+
+def values_match(a, b, rtol: float) -> bool:
+    try:
+        return bool(np.isclose(float(a), float(b), rtol=rtol, equal_nan=True))
+    except (TypeError, ValueError):
+        return a == b
+
+
+def compare_poses(cli: dict, store: dict, rtol: float) -> list:
+    mismatches = []
+    for key in sorted(set(cli) | set(store), key=str):
+        if key not in store:
+            mismatches.append({"pose": key, "problem": "only_cli"})
+        elif key not in cli:
+            mismatches.append({"pose": key, "problem": "only_store"})
+        else:
+            for tag in PARITY_TAGS:
+                if not values_match(cli[key][tag], store[key][tag], rtol):
+                    mismatches.append(
+                        {
+                            "pose": key,
+                            "problem": f"tag {tag}",
+                            "cli": cli[key][tag],
+                            "store": store[key][tag],
+                        }
+                    )
+    return mismatches
+
+
+def compare_scores(cli: pd.DataFrame, store: pd.DataFrame, rtol: float) -> list:
+    mismatches = []
+    for scores in [cli, store]:
+        scores["pose_id"] = scores["pose_id"].astype(int)
+    for column in sorted(set(cli.columns) ^ set(store.columns)):
+        mismatches.append(
+            {
+                "column": column,
+                "problem": "only_cli" if column in cli.columns else "only_store",
+            }
+        )
+    merged = cli.merge(store, on=SCORE_KEYS, how="outer", suffixes=("_cli", "_store"))
+    for column in sorted((set(cli.columns) & set(store.columns)) - set(SCORE_KEYS)):
+        for _, row in merged.iterrows():
+            if not values_match(row[f"{column}_cli"], row[f"{column}_store"], rtol):
+                mismatches.append(
+                    {
+                        "pose": tuple(row[key] for key in SCORE_KEYS),
+                        "problem": f"score {column}",
+                        "cli": row[f"{column}_cli"],
+                        "store": row[f"{column}_store"],
+                    }
+                )
+    return mismatches
+
+
+def run_in(
+    run_dir: Path,
+    dock_fn,
+    first: int,
+    last: int,
+    ligand_file: Path,
+    index_file,
+    settings: dict,
+) -> Path:
+    """
+    Dock a range of records with one docking function in its own directory.
+    :return: The docked directory
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        log_dir = Path("logs")
+        log_dir.mkdir(exist_ok=True)
+        _, _, returncode = dock_fn(
+            first, last, ligand_file, index_file, settings, log_dir
+        )
+    finally:
+        os.chdir(cwd)
+    if returncode != 0:
+        raise RuntimeError(
+            f"Docking records {first}-{last} failed in '{run_dir}', see '{run_dir / 'logs'}'"
+        )
+    return run_dir / f"{first}-{last}_docked"
+
+
+@click.command()
+@click.option(
+    "--ligand-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+    help="Combined 2D ligand SDF file",
+)
+@click.option(
+    "--index-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Byte-offset index of the ligand file. Defaults to the ligand file path with '.index.csv' appended.",
+)
+@click.option("--first-record", type=int, default=1, help="First record to dock")
+@click.option(
+    "--last-record", type=int, default=2, help="Last record to dock, inclusive"
+)
+@click.option(
+    "--fragalysis-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Prepped receptor cache, ideally a few complexes",
+)
+@click.option("--posit-method", default="ALL")
+@click.option("--num-poses", type=int, default=1)
+@click.option("--allow-retries", is_flag=True, default=False)
+@click.option("--allow-final-clash", is_flag=True, default=False)
+@click.option(
+    "--relax-mode",
+    type=click.Choice(["none", "clash", "all"]),
+    default=None,
+    help="POSIT relax mode. Defaults to the asap-docking default.",
+)
+@click.option(
+    "--conformer-cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Omega conformer cache to dock from in process, as batch_cross_docking.py does with the same option",
+)
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=Path("receptor_store_parity"),
+    help="Directory for the docking runs of both paths",
+)
+@click.option(
+    "--rtol",
+    type=float,
+    default=1e-4,
+    help="Relative tolerance of numeric tags and scores",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False, path_type=Path),
+    required=True,
+    help="Json report to write",
+)
+def main(
+    ligand_file,
+    index_file,
+    first_record,
+    last_record,
+    fragalysis_dir,
+    cache_dir,
+    posit_method,
+    num_poses,
+    allow_retries,
+    allow_final_clash,
+    relax_mode,
+    conformer_cache_dir,
+    work_dir,
+    rtol,
+    report,
+):
+    """Dock a few records through asap-docking and from the receptor store, and compare the results."""
+    work_dir = work_dir.resolve()
+    settings = {
+        "posit_method": posit_method,
+        "structure_selector": "PairwiseSelector",
+        "fragalysis_dir": fragalysis_dir.resolve(),
+        "cache_dir": cache_dir.resolve(),
+        "num_poses": num_poses,
+        "allow_retries": allow_retries,
+        "allow_final_clash": allow_final_clash,
+        "relax_mode": relax_mode,
+        "receptor_store_dir": work_dir / "receptor_store",
+        "ledger_dir": None,
+        "conformer_cache_dir": (
+            conformer_cache_dir.resolve() if conformer_cache_dir is not None else None
+        ),
+        "extra_args": (),
+    }
+    ligand_file = ligand_file.resolve()
+    index_file = index_file.resolve() if index_file is not None else None
+    cli_dir = run_in(
+        work_dir / "cli",
+        dock_batch,
+        first_record,
+        last_record,
+        ligand_file,
+        index_file,
+        settings,
+    )
+    # with the conformer cache, the second run docks the ensembles the first one cached
+    store_runs = ["store"] if conformer_cache_dir is None else ["store", "store_cached"]
+    cli_poses = load_poses(cli_dir)
+    mismatches = []
+    for store_run in store_runs:
+        store_dir = run_in(
+            work_dir / store_run,
+            dock_batch_from_store,
+            first_record,
+            last_record,
+            ligand_file,
+            index_file,
+            {**settings, "ledger_dir": work_dir / store_run / "ledgers"},
+        )
+        run_mismatches = compare_poses(
+            cli_poses, load_poses(store_dir), rtol
+        ) + compare_scores(
+            pd.read_csv(cli_dir / SCORES_CSV),
+            pd.read_csv(store_dir / SCORES_CSV),
+            rtol,
+        )
+        mismatches += [{"run": store_run, **m} for m in run_mismatches]
+    passed = bool(cli_poses) and not mismatches
+    report.parent.mkdir(parents=True, exist_ok=True)
+    with open(report, "w") as f:
+        json.dump(
+            {
+                "passed": passed,
+                "asapdiscovery_release": get_asapdiscovery_release(),
+                "cache_key": get_cache_key(settings["cache_dir"]),
+                "conformer_cache": conformer_cache_dir is not None,
+                "records": [first_record, last_record],
+                "n_poses": len(cli_poses),
+                "mismatches": mismatches,
+            },
+            f,
+            indent=4,
+            default=str,
+        )
+    print(
+        f"{'Passed' if passed else 'Failed'}: {len(cli_poses)} poses, {len(mismatches)} mismatches, see '{report}'"
+    )
+    if not passed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Persistent cache of Omega conformer ensembles shared between docking campaigns.
+
+Every campaign docks the same ligands with `--use-omega --omega-dense`, so identical dense ensembles are built for
+the POSIT and FRED runs, the single and multipose runs, and again on every retry. Here each ensemble is stored as a
+multi-conformer OEB file keyed by the canonical isomeric SMILES of the ligand, the Omega sampling mode and the
+Omega release, so it is only ever built once.
+
+Files are sharded by the first two characters of the key and written under a temporary name before being renamed,
+so concurrent workers can share one cache directory.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def get_settings(dense: bool) -> dict:
+    from asapdiscovery.data.backend.openeye import oeomega
+
+    return {
+        "sampling": "dense" if dense else "default",
+        "omega_release": oeomega.OEOmegaGetRelease(),
+    }
+
+
+def get_omega(dense: bool):
+    """
+    Build Omega with the same options as POSITDocker.
+    """
+    from asapdiscovery.data.backend.openeye import oeomega
+
+    if dense:
+        options = oeomega.OEOmegaOptions(oeomega.OEOmegaSampling_Dense)
+    else:
+        options = oeomega.OEOmegaOptions()
+    return oeomega.OEOmega(options)
+
+
+class ConformerCache:
+    """
+    Directory of Omega conformer ensembles keyed by canonical isomeric SMILES and Omega settings.
+    """
+
+    def __init__(self, cache_dir: Path, dense: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.dense = dense
+        self.settings = get_settings(dense)
+        self._omega = None
+
+    def get_key(self, smiles: str) -> str:
+        return hashlib.sha256(
+            json.dumps({"smiles": smiles, **self.settings}, sort_keys=True).encode()
+        ).hexdigest()
+
+    def get_path(self, smiles: str) -> Path:
+        key = self.get_key(smiles)
+        return self.cache_dir / key[:2] / f"{key}.oeb"
+
+    def _read(self, path: Path):
+        from asapdiscovery.data.backend.openeye import oechem
+
+        mol = oechem.OEMol()
+        ifs = oechem.oemolistream(str(path))
+        success = oechem.OEReadMolecule(ifs, mol)
+        ifs.close()
+        return mol if success else None
+
+    def _write(self, path: Path, mol):
+        from asapdiscovery.data.backend.openeye import oechem
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # keep the .oeb extension so the stream picks the format from the name
+        tmp = path.with_name(f".{os.getpid()}.{path.name}")
+        ofs = oechem.oemolostream(str(tmp))
+        oechem.OEWriteMolecule(ofs, mol)
+        ofs.close()
+        os.replace(tmp, path)
+
+    def get_conformers(self, ligand):
+        """
+        Get the conformer ensemble of a ligand, building and caching it with Omega if it isn't cached yet.
+        :param ligand: Ligand to get conformers for
+        :return: Multi-conformer Ligand with the compound name and tags of the input, or None if Omega failed
+        """
+        from asapdiscovery.data.backend.openeye import oechem, oeomega
+        from asapdiscovery.data.schema.ligand import Ligand
+
+        oemol = ligand.to_oemol()
+        path = self.get_path(oechem.OECreateIsoSmiString(oemol))
+        mol = self._read(path) if path.exists() else None
+        if mol is None:
+            if self._omega is None:
+                self._omega = get_omega(self.dense)
+            mol = oechem.OEMol(oemol)
+            if self._omega.Build(mol) != oeomega.OEOmegaReturnCode_Success:
+                return None
+            self._write(path, mol)
+        return Ligand.from_oemol(
+            mol, compound_name=ligand.compound_name, tags=ligand.tags
+        )
@@ -0,0 +1,135 @@
+"""
+Append-only completion ledger for in-process cross-docking.
+
+Every finished (ligand, reference structure) pair is written as one json line holding the posed ligands as SDF
+text and the scores as records. Each line is flushed and fsynced before the next pair is docked, so an
+interrupted job loses at most the pair it was working on. A partial last line left by a crash is ignored, and
+truncated away when the ledger is reopened.
+
+Pairs that docked without a pose are recorded too, so they aren't retried on restart.
+
+A ledger is keyed by the docking settings, the receptor cache and the content of the batch's ligands, so a ledger
+kept in a persistent directory is only resumed by a task that would dock exactly the same pairs.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+def get_settings_key(settings: dict) -> str:
+    """
+    Hash the docking settings that change the results, so that a ledger is never resumed with different settings.
+    """
+    keys = [
+        "posit_method",
+        "structure_selector",
+        "num_poses",
+        "allow_retries",
+        "allow_final_clash",
+        "relax_mode",
+    ]
+    return hashlib.sha256(
+        json.dumps({key: settings[key] for key in keys}, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def get_ledger_key(settings: dict, cache_key: str, ligand_sdf: bytes) -> str:
+    """
+    Hash everything the recorded results depend on.
+    :param settings: Docking settings, see get_settings_key
+    :param cache_key: Key of the receptor cache, see receptor_store.get_cache_key
+    :param ligand_sdf: SDF text of the batch's ligands
+    """
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "settings": get_settings_key(settings),
+                "cache": cache_key,
+                "ligands": hashlib.sha256(ligand_sdf).hexdigest(),
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+class DockingLedger:
+    """
+    Durable record of the docked pairs of one batch of ligands.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.records = {}
+        if self.path.exists():
+            self._load()
+        self._file = open(self.path, "a")
+
+    def _load(self):
+        valid_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial line from an interrupted write, everything after it is discarded
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.records[(record["ligand"], record["reference"])] = record
+                valid_bytes += len(line)
+        if valid_bytes < self.path.stat().st_size:
+            os.truncate(self.path, valid_bytes)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def is_done(self, ligand: str, reference: str) -> bool:
+        return (ligand, reference) in self.records
+
+    def append(self, ligand: str, reference: str, poses: list, scores: pd.DataFrame):
+        """
+        Commit one finished pair.
+        :param ligand: Compound name of the ligand
+        :param reference: Name of the reference complex
+        :param poses: SDF text of each posed ligand
+        :param scores: Scores of the poses
+        """
+        record = {
+            "ligand": ligand,
+            "reference": reference,
+            "poses": poses,
+            "scores": json.loads(scores.to_json(orient="records")),
+        }
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records[(ligand, reference)] = record
+
+    def write_results(self, output_dir: Path, ligands: list, references: list):
+        """
+        Write the recorded poses and scores of the requested pairs in the layout of asap-docking cross-docking.
+        :param ligands: Compound names of the ligands of this batch
+        :param references: Names of the reference complexes docked against
+        """
+        records = [
+            self.records[(ligand, reference)]
+            for reference in references
+            for ligand in ligands
+            if (ligand, reference) in self.records
+        ]
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with open(output_dir / "docking_results.sdf", "w") as f:
+            for record in records:
+                for pose in record["poses"]:
+                    f.write(pose)
+        pd.DataFrame.from_records(
+            [score for record in records for score in record["scores"]]
+        ).to_csv(output_dir / "docking_scores_raw.csv", index=False)
+
+    def close(self):
+        self._file.close()
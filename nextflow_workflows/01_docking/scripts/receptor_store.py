@@ -0,0 +1,233 @@
+"""
+Node-local, memory-mapped store of the prepped complexes in a cache.
+
+Loading a cache with `--cache-dir` deserializes every prepped complex, design unit included, in every docking
+process, so each process holds all of the receptors at once. Here the serialized complexes are packed once per
+node into a single file next to a byte-offset index. Docking workers map the file read-only and only rebuild the
+complex they are currently docking against. The mapped pages live in the shared page cache, so each worker only
+holds the receptors it has rebuilt.
+
+The store is keyed by the names, sizes and modification times of the complex jsons, so it is rebuilt whenever
+the cache changes. Concurrent workers on one node wait on a file lock while the first one builds it.
+
+Docking from the store bypasses asap-docking, so batch_cross_docking.py only uses it once
+check_receptor_store_parity.py has shown that it gives the same poses, tags and scores with the installed release.
+
+Example usage:
+python receptor_store.py --cache-dir mpro_fragalysis-04-01-24_curated_cache_fixed --store-dir /tmp/receptor_store
+"""
+
+import hashlib
+import json
+import mmap
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import click
+import pandas as pd
+from ligand_cache_index import read_complex_header
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STORE_SUFFIX = ".bin"
+INDEX_SUFFIX = ".index.csv"
+# SD tags of the posed ligands that later stages read, compared by check_receptor_store_parity.py
+PARITY_TAGS = [
+    "Pose_ID",
+    "docking-confidence-POSIT",
+    "_POSIT_method",
+    "ReferenceStructureName",
+]
+
+
+def get_asapdiscovery_release():
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("asapdiscovery-docking")
+    except PackageNotFoundError:
+        return None
+
+
+def check_parity_report(report_fn: Path, conformer_cache: bool = False):
+    """
+    Check that in-process docking from the store was shown to match asap-docking with the installed release.
+    :param report_fn: Report written by check_receptor_store_parity.py
+    :param conformer_cache: Whether docking uses prebuilt ensembles from the conformer cache
+    :raises ValueError: If the check failed, was run with another asapdiscovery release or didn't cover the
+    conformer cache
+    """
+    with open(report_fn, "r") as f:
+        report = json.load(f)
+    if not report["passed"]:
+        raise ValueError(
+            f"The receptor store parity check in '{report_fn}' failed with {len(report['mismatches'])} mismatches"
+        )
+    if report["asapdiscovery_release"] != get_asapdiscovery_release():
+        raise ValueError(
+            f"The receptor store parity check in '{report_fn}' was run with asapdiscovery-docking "
+            f"{report['asapdiscovery_release']}, not the installed {get_asapdiscovery_release()}"
+        )
+    if conformer_cache and not report.get("conformer_cache", False):
+        raise ValueError(
+            f"The receptor store parity check in '{report_fn}' was run without the conformer cache, "
+            "rerun it with --conformer-cache-dir"
+        )
+
+
+def get_cache_key(cache_dir: Path) -> str:
+    """
+    Hash the names, sizes and modification times of the complex jsons in a cache.
+    """
+    sha = hashlib.sha256()
+    for json_file in sorted(Path(cache_dir).glob("*/*.json")):
+        stat = json_file.stat()
+        sha.update(
+            f"{json_file.relative_to(cache_dir)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return sha.hexdigest()
+
+
+def get_store_paths(store_dir: Path, cache_key: str) -> tuple:
+    store_fn = Path(store_dir) / f"receptor_store_{cache_key[:16]}{STORE_SUFFIX}"
+    return store_fn, store_fn.with_name(store_fn.name + INDEX_SUFFIX)
+
+
+def build_receptor_store(cache_dir: Path, store_fn: Path, index_fn: Path):
+    """
+    Pack the serialized complexes of a cache into one file and write its index.
+    Both files are written under temporary names and renamed, so a partial store is never visible.
+    :param cache_dir: Cache of prepped complexes
+    :param store_fn: Path to the packed store
+    :param index_fn: Path to the index, with the columns Target_Name, Complex_Dir, Start and End
+    """
+    records = []
+    tmp_store = store_fn.with_name(f".{store_fn.name}.{os.getpid()}")
+    tmp_index = index_fn.with_name(f".{index_fn.name}.{os.getpid()}")
+    with open(tmp_store, "wb") as out:
+        for json_file in sorted(Path(cache_dir).glob("*/*.json")):
+            start = out.tell()
+            with open(json_file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    out.write(block)
+            records.append(
+                {
+                    "Target_Name": read_complex_header(json_file)["target_name"],
+                    "Complex_Dir": json_file.parent.name,
+                    "Start": start,
+                    "End": out.tell(),
+                }
+            )
+    pd.DataFrame.from_records(
+        records, columns=["Target_Name", "Complex_Dir", "Start", "End"]
+    ).to_csv(tmp_index, index=False)
+    os.replace(tmp_store, store_fn)
+    os.replace(tmp_index, index_fn)
+
+
+def ensure_receptor_store(cache_dir: Path, store_dir: Path, logger=None) -> tuple:
+    """
+    Build the store for a cache in store_dir unless an up-to-date store is already there.
+    :return: Paths to the store and its index
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    store_fn, index_fn = get_store_paths(store_dir, get_cache_key(cache_dir))
+    if store_fn.exists() and index_fn.exists():
+        return store_fn, index_fn
+
+    with open(store_dir / ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # another worker may have built the store while we were waiting for the lock
+        if not (store_fn.exists() and index_fn.exists()):
+            if logger:
+                logger.info(
+                    f"Building receptor store for '{cache_dir}' in '{store_fn}'"
+                )
+            build_receptor_store(cache_dir, store_fn, index_fn)
+    return store_fn, index_fn
+
+
+class ReceptorStore:
+    """
+    Read-only view of a packed store that rebuilds prepped complexes on demand.
+    """
+
+    def __init__(self, store_fn: Path, index_fn: Path, max_cached: int = 1):
+        """
+        :param store_fn: Path to the packed store
+        :param index_fn: Path to the index of the store
+        :param max_cached: Number of rebuilt complexes to keep in memory
+        """
+        self.index = pd.read_csv(index_fn, dtype={"Target_Name": str})
+        self.max_cached = max_cached
+        self._cached = OrderedDict()
+        with open(store_fn, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def from_cache(
+        cls, cache_dir: Path, store_dir: Path, max_cached: int = 1, logger=None
+    ) -> "ReceptorStore":
+        return cls(*ensure_receptor_store(cache_dir, store_dir, logger), max_cached)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def names(self) -> list:
+        return self.index.Complex_Dir.tolist()
+
+    def read_bytes(self, name: str) -> bytes:
+        rows = self.index[self.index.Complex_Dir == name]
+        if rows.empty:
+            raise KeyError(f"{name} is not in the receptor store")
+        start, end = int(rows.Start.iloc[0]), int(rows.End.iloc[0])
+        return self._map[start:end]
+
+    def get_complex(self, name: str):
+        """
+        Rebuild the prepped complex stored under a complex directory name.
+        """
+        from asapdiscovery.modeling.protein_prep import PreppedComplex
+
+        if name in self._cached:
+            self._cached.move_to_end(name)
+            return self._cached[name]
+        prepped_complex = PreppedComplex.parse_raw(self.read_bytes(name))
+        self._cached[name] = prepped_complex
+        while len(self._cached) > self.max_cached:
+            self._cached.popitem(last=False)
+        return prepped_complex
+
+    def close(self):
+        self._cached.clear()
+        self._map.close()
+
+
+@click.command()
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Cache of prepped complexes",
+)
+@click.option(
+    "--store-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Node-local directory for the store",
+)
+def main(cache_dir, store_dir):
+    """Build the receptor store for a cache ahead of the docking workers."""
+    store_fn, index_fn = ensure_receptor_store(cache_dir, store_dir)
+    print(f"Receptor store for '{cache_dir}' is at '{store_fn}'")
+
+
+if __name__ == "__main__":
+    main()
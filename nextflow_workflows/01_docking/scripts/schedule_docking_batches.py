@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Cost-aware batching of the indexed combined ligand file for batched docking.
+
+The docking cost of a ligand grows with its size and flexibility, so batches with the same number of ligands can
+take very different times. Here the cost of each record is estimated from cheap descriptors (heavy atoms,
+rotatable bonds and macrocycles) with a linear model. The model is calibrated against the runtimes of previous
+docking tasks, read from Nextflow trace files. The records are then cut into contiguous batches of about equal
+cost, which is what batch_cross_docking.py can read with a single seek.
+
+Each batch gets a time and memory hint for the CROSS_DOCK_BATCH process. Without trace files the costs are only
+relative, and the hints are left empty so the process defaults apply.
+
+Example usage:
+python schedule_docking_batches.py \
+    --ligand-file combined_2d.sdf \
+    --n-batches 200 \
+    --n-workers 4 \
+    --trace trace_2025-06-04.txt \
+    --output docking_batches.csv
+"""
+
+import re
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from batch_cross_docking import split_records
+from sdf_index import load_sdf_index
+from telemetry import phase, profile_main
+
+DESCRIPTORS = ["Heavy_Atoms", "Rotatable_Bonds", "Macrocycle"]
+
+# relative costs used when there are no previous runtimes to calibrate against
+DEFAULT_WEIGHTS = {
+    "Intercept": 0.0,
+    "Heavy_Atoms": 1.0,
+    "Rotatable_Bonds": 2.0,
+    "Macrocycle": 20.0,
+}
+
+MACROCYCLE_SIZE = 12
+
+DURATION_UNITS = {"d": 86400, "h": 3600, "m": 60, "s": 1, "ms": 0.001}
+MEMORY_UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30, "TB": 1 << 40}
+
+
+def get_descriptors(sdf_fn: Path) -> pd.DataFrame:
+    """
+    Compute the cost descriptors of every record in an SDF file.
+    Records that RDKit can't read get the median descriptors of the others.
+    :return: DataFrame with a Record column (starting at 1) and one column per descriptor
+    """
+    from rdkit import Chem
+    from rdkit.Chem import rdMolDescriptors
+
+    records = []
+    with open(sdf_fn, "rb") as f:
+        for i, mol in enumerate(Chem.ForwardSDMolSupplier(f), start=1):
+            if mol is None:
+                records.append({"Record": i})
+                continue
+            rings = mol.GetRingInfo().AtomRings()
+            records.append(
+                {
+                    "Record": i,
+                    "Heavy_Atoms": mol.GetNumHeavyAtoms(),
+                    "Rotatable_Bonds": rdMolDescriptors.CalcNumRotatableBonds(mol),
+                    "Macrocycle": int(
+                        any(len(ring) >= MACROCYCLE_SIZE for ring in rings)
+                    ),
+                }
+            )
+    df = pd.DataFrame.from_records(records, columns=["Record", *DESCRIPTORS])
+    return df.fillna(df[DESCRIPTORS].median())
+
+
+def parse_duration(value) -> float:
+    """
+    Parse a Nextflow trace duration such as '1h 2m 3s' or '450ms' into seconds.
+    Raw traces (trace.raw = true) are in milliseconds.
+    """
+    if pd.isna(value) or value == "-":
+        return np.nan
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value) / 1000
+    parts = re.findall(r"([\d.]+)\s*(ms|d|h|m|s)", value)
+    if not parts:
+        return np.nan
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_memory(value) -> float:
+    """
+    Parse a Nextflow trace memory value such as '1.5 GB' into bytes.
+    """
+    if pd.isna(value) or value == "-":
+        return np.nan
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    match = re.fullmatch(r"([\d.]+)\s*([KMGT]?B)", value)
+    if match is None:
+        return np.nan
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2)]
+
+
+def read_docking_traces(trace_files: list, index: pd.DataFrame) -> pd.DataFrame:
+    """
+    Read the completed docking tasks from Nextflow trace files.
+    Single ligand tasks are tagged 'cross-dock <record>', with the record number of the split ligand file, and
+    batches 'cross-dock records <first>-<last>'. Tags holding a compound name instead are looked up in the index.
+    Tasks that can't be mapped to records, or have no runtime, are discarded and counted.
+    :param trace_files: Paths to Nextflow trace files
+    :param index: Index of the ligand file, to map compound names to records
+    :return: DataFrame with the columns First_Record, Last_Record, CPU_Seconds and Peak_RSS_Per_CPU
+    """
+    traces = pd.concat(
+        [pd.read_csv(fn, sep="\t") for fn in trace_files], ignore_index=True
+    )
+    traces = traces[
+        (traces.status == "COMPLETED") & traces.tag.str.startswith("cross-dock ")
+    ]
+    record_of = dict(zip(index.Compound_Name, index.Record))
+    n_unmapped = 0
+    rows = []
+    for tag, realtime, cpus, peak_rss in zip(
+        traces.tag, traces.realtime, traces.cpus, traces.peak_rss
+    ):
+        name = tag[len("cross-dock ") :]
+        match = re.fullmatch(r"records (\d+)-(\d+)", name)
+        if match is not None:
+            first, last = int(match.group(1)), int(match.group(2))
+        elif name.isdigit():
+            first = last = int(name)
+        elif name in record_of:
+            first = last = record_of[name]
+        else:
+            n_unmapped += 1
+            continue
+        cpus = int(cpus) if not pd.isna(cpus) else 1
+        rows.append(
+            {
+                "First_Record": first,
+                "Last_Record": last,
+                "CPU_Seconds": parse_duration(realtime) * cpus,
+                "Peak_RSS_Per_CPU": parse_memory(peak_rss) / cpus,
+            }
+        )
+    tasks = pd.DataFrame.from_records(
+        rows,
+        columns=["First_Record", "Last_Record", "CPU_Seconds", "Peak_RSS_Per_CPU"],
+    )
+    n_records = len(index)
+    out_of_range = (tasks.First_Record < 1) | (tasks.Last_Record > n_records)
+    no_runtime = tasks.CPU_Seconds.isna()
+    print(
+        f"Read {len(traces)} completed docking tasks from the traces, discarded {n_unmapped} with unknown tags, "
+        f"{(out_of_range & ~no_runtime).sum()} outside the {n_records} records of the ligand file "
+        f"and {no_runtime.sum()} without a runtime"
+    )
+    return tasks[~(out_of_range | no_runtime)].reset_index(drop=True)
+
+
+def fit_cost_model(descriptors: pd.DataFrame, tasks: pd.DataFrame) -> dict:
+    """
+    Fit the per-ligand cost weights to the CPU time of previous tasks.
+    Each task contributes the summed descriptors of its records, so single ligand and batched tasks can be mixed.
+    Negative weights are clipped to zero so that no ligand gets a negative cost.
+    :return: Dictionary of weights in CPU seconds, including the per-ligand Intercept
+    """
+    cumulative = np.vstack(
+        [
+            np.zeros(len(DESCRIPTORS) + 1),
+            np.cumsum(
+                np.column_stack(
+                    [np.ones(len(descriptors)), descriptors[DESCRIPTORS].to_numpy()]
+                ),
+                axis=0,
+            ),
+        ]
+    )
+    positions = pd.Series(np.arange(len(descriptors)), index=descriptors.Record)
+    first = positions.reindex(tasks.First_Record).to_numpy()
+    last = positions.reindex(tasks.Last_Record).to_numpy()
+    valid = ~(np.isnan(first) | np.isnan(last))
+    first, last = first[valid].astype(int), last[valid].astype(int)
+    features = cumulative[last + 1] - cumulative[first]
+    weights, *_ = np.linalg.lstsq(
+        features, tasks.CPU_Seconds.to_numpy()[valid], rcond=None
+    )
+    weights = np.clip(weights, 0, None)
+    return dict(zip(["Intercept", *DESCRIPTORS], weights))
+
+
+def predict_costs(descriptors: pd.DataFrame, weights: dict) -> np.ndarray:
+    costs = weights["Intercept"] + sum(
+        weights[name] * descriptors[name].to_numpy() for name in DESCRIPTORS
+    )
+    # a ligand never costs nothing, even if the fit says so
+    return np.maximum(costs, np.mean(costs) * 0.01 if np.mean(costs) > 0 else 1.0)
+
+
+def partition_costs(costs: np.ndarray, n_batches: int) -> list:
+    """
+    Cut a sequence of costs into at most n_batches contiguous ranges of about equal total cost.
+    :return: List of (start, stop) positions, with stop exclusive
+    """
+    cumulative = np.cumsum(costs)
+    targets = cumulative[-1] * np.arange(1, n_batches) / n_batches
+    cuts = np.unique(np.searchsorted(cumulative, targets, side="right"))
+    bounds = [0, *[cut for cut in cuts if 0 < cut < len(costs)], len(costs)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+@click.command()
+@click.option(
+    "--ligand-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+    help="Combined 2D ligand SDF file",
+)
+@click.option(
+    "--index-file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Byte-offset index of the ligand file. Defaults to the ligand file path with '.index.csv' appended.",
+)
+@click.option(
+    "--n-batches",
+    type=int,
+    default=None,
+    help="Number of batches. Defaults to one batch per --batch-size ligands.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=16,
+    help="Average number of ligands per batch if --n-batches isn't given",
+)
+@click.option(
+    "--max-records", type=int, default=-1, help="Only schedule the first records"
+)
+@click.option(
+    "--n-workers", type=int, default=1, help="Number of workers per batch task"
+)
+@click.option(
+    "--trace",
+    "trace_files",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    multiple=True,
+    help="Nextflow trace files of previous docking runs to calibrate the cost model with",
+)
+@click.option(
+    "--safety-factor",
+    type=float,
+    default=2.0,
+    help="Factor applied to the predicted time and memory of each batch",
+)
+@click.option(
+    "--min-minutes", type=int, default=60, help="Minimum time hint of a batch"
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default="docking_batches.csv",
+)
+@profile_main
+def main(
+    ligand_file,
+    index_file,
+    n_batches,
+    batch_size,
+    max_records,
+    n_workers,
+    trace_files,
+    safety_factor,
+    min_minutes,
+    output,
+):
+    """Cut the ligand file into batches of about equal predicted docking cost."""
+    with phase("load"):
+        index = load_sdf_index(ligand_file, index_file)
+        descriptors = get_descriptors(ligand_file)
+    if max_records > 0:
+        descriptors = descriptors[descriptors.Record <= max_records]
+
+    tasks = read_docking_traces(trace_files, index) if trace_files else pd.DataFrame()
+    calibrated = len(tasks) > len(DESCRIPTORS)
+    weights = fit_cost_model(descriptors, tasks) if calibrated else DEFAULT_WEIGHTS
+    print(f"Cost weights ({'CPU seconds' if calibrated else 'relative'}): {weights}")
+
+    costs = predict_costs(descriptors, weights)
+    n_batches = n_batches or int(np.ceil(len(descriptors) / batch_size))
+    records = descriptors.Record.to_numpy()
+    batches = []
+    for start, stop in partition_costs(costs, n_batches):
+        first, last = int(records[start]), int(records[stop - 1])
+        batch = {
+            "First_Record": first,
+            "Last_Record": last,
+            "N_Ligands": stop - start,
+            "Predicted_Cost": float(costs[start:stop].sum()),
+            "Time_Minutes": None,
+            "Memory_GB": None,
+        }
+        if calibrated:
+            # workers share the batch evenly by count, so the slowest worker sets the wall time
+            worker_costs = [
+                costs[start + a - first : start + b - first + 1].sum()
+                for a, b in split_records(first, last, n_workers)
+            ]
+            batch["Time_Minutes"] = max(
+                min_minutes, int(np.ceil(max(worker_costs) * safety_factor / 60))
+            )
+            peak_rss = tasks.Peak_RSS_Per_CPU.max()
+            if not np.isnan(peak_rss):
+                batch["Memory_GB"] = int(
+                    np.ceil(peak_rss * n_workers * safety_factor / (1 << 30))
+                )
+        batches.append(batch)
+
+    # start the most expensive batches first so they don't end up as stragglers
+    schedule = pd.DataFrame.from_records(batches).sort_values(
+        "Predicted_Cost", ascending=False
+    )
+    schedule.to_csv(output, index=False)
+    print(
+        f"Wrote {len(schedule)} batches of {len(descriptors)} ligands to '{output}', "
+        f"largest/mean predicted cost {schedule.Predicted_Cost.max() / schedule.Predicted_Cost.mean():.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Derive a single pose docking dataset from a multipose run instead of redocking.
+
+For every (ligand, reference structure) pair the pose with the lowest Pose_ID is kept, the same rule as the
+PoseSelector(variable="Pose_ID", ascending=True) of the multipose evaluators. The selected records
+are written verbatim, along with their rows of the raw scores, into a dataset with the same '*_docked' layout as
+the input, so the collection stage can run on it unchanged.
+
+If a single pose run is given with --compare-dir, a report is written with one row per pair found in either
+dataset. The report compares the derived pose with the docked single pose and flags the pairs where they disagree.
+
+Example usage:
+python subset_poses.py \
+    --multipose-dir docked_files/ALL_50_poses \
+    --output-dir docked_files/ALL_1_poses_derived \
+    --compare-dir docked_files/ALL_1_poses \
+    --report ALL_1_poses_derived_comparison.csv
+"""
+
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from asapdiscovery.data.util.logging import FileLogger
+from telemetry import phase, profile_main
+
+RESULTS_SDF = "docking_results.sdf"
+SCORES_CSV = "docking_scores_raw.csv"
+RECORD_TERMINATOR = "$$$$"
+
+
+def iter_sdf_records(sdf_fn: Path):
+    """
+    Yield the compound name, SD tags and raw text of every record in an SDF file.
+    The compound name is taken from the 'compound_name' SD tag if present and from the title line otherwise.
+    """
+    lines = []
+    with open(sdf_fn, "r") as f:
+        for line in f:
+            lines.append(line)
+            if line.rstrip("\r\n") != RECORD_TERMINATOR:
+                continue
+            tags = {}
+            for i, tag_line in enumerate(lines):
+                if tag_line.startswith(">") and "<" in tag_line:
+                    tag = tag_line[tag_line.index("<") + 1 : tag_line.rindex(">")]
+                    tags[tag] = lines[i + 1].strip() if i + 1 < len(lines) else ""
+            title = lines[0].strip()
+            yield tags.get("compound_name", title), tags, "".join(lines)
+            lines = []
+
+
+def select_top_poses(sdf_fn: Path) -> dict:
+    """
+    Select the top ranked pose of every (ligand, reference structure) pair in a docking results file.
+    :param sdf_fn: Path to a docking_results.sdf file
+    :return: Dictionary of (ligand, reference structure) to (Pose_ID, confidence, record text)
+    """
+    selected = {}
+    for name, tags, record in iter_sdf_records(sdf_fn):
+        key = (name, tags.get("ReferenceStructureName"))
+        pose_id = int(tags.get("Pose_ID", 0))
+        confidence = float(tags.get("docking-confidence-POSIT", np.nan))
+        if key not in selected or pose_id < selected[key][0]:
+            selected[key] = (pose_id, confidence, record)
+    return selected
+
+
+def subset_docked_dir(docked_dir: Path, output_dir: Path) -> dict:
+    """
+    Write the top ranked poses of one docked directory and their scores to output_dir.
+    :return: The selected poses, as returned by select_top_poses
+    """
+    selected = select_top_poses(docked_dir / RESULTS_SDF)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / RESULTS_SDF, "w") as f:
+        for _, _, record in selected.values():
+            f.write(record)
+
+    if (docked_dir / SCORES_CSV).exists():
+        scores = pd.read_csv(docked_dir / SCORES_CSV)
+        keep = pd.MultiIndex.from_tuples(
+            [(ref, name, pose_id) for (name, ref), (pose_id, _, _) in selected.items()]
+        )
+        rows = pd.MultiIndex.from_arrays(
+            [
+                scores["docking-structure-POSIT"],
+                scores["ligand_id"],
+                scores["pose_id"].astype(int),
+            ]
+        ).isin(keep)
+        scores[rows].to_csv(output_dir / SCORES_CSV, index=False)
+    return selected
+
+
+def load_top_poses(dataset_dir: Path) -> dict:
+    selected = {}
+    for sdf_fn in sorted(dataset_dir.glob(f"*docked/{RESULTS_SDF}")):
+        selected.update(select_top_poses(sdf_fn))
+    return selected
+
+
+def pose_rmsd(record: str, other: str) -> float:
+    """
+    Heavy atom RMSD between two poses of the same ligand, without superposition.
+    """
+    from asapdiscovery.data.backend.openeye import oechem
+
+    mols = []
+    for text in [record, other]:
+        ifs = oechem.oemolistream()
+        ifs.SetFormat(oechem.OEFormat_SDF)
+        ifs.openstring(text)
+        mol = oechem.OEGraphMol()
+        oechem.OEReadMolecule(ifs, mol)
+        mols.append(mol)
+    return oechem.OERMSD(mols[0], mols[1], True, True, False)
+
+
+def compare_poses(derived: dict, docked: dict, cutoff: float) -> pd.DataFrame:
+    """
+    Compare the derived single poses with the poses of a single pose run.
+    :param derived: Selected poses of the derived dataset
+    :param docked: Selected poses of the single pose run
+    :param cutoff: RMSD above which two poses of a pair are considered different
+    :return: DataFrame with one row per pair in either dataset
+    """
+    records = []
+    for key in sorted(set(derived) | set(docked), key=str):
+        record = {"Query_Ligand": key[0], "Reference_Structure": key[1]}
+        for label, poses in [("Derived", derived), ("Docked", docked)]:
+            pose_id, confidence, _ = poses.get(key, (np.nan, np.nan, None))
+            record[f"{label}_Pose_ID"] = pose_id
+            record[f"{label}_Confidence"] = confidence
+        if key in derived and key in docked:
+            record["Pose_RMSD"] = pose_rmsd(derived[key][2], docked[key][2])
+            record["Disagreement"] = (
+                "different_pose" if record["Pose_RMSD"] > cutoff else ""
+            )
+        else:
+            record["Pose_RMSD"] = np.nan
+            record["Disagreement"] = "only_derived" if key in derived else "only_docked"
+        records.append(record)
+    return pd.DataFrame.from_records(records)
+
+
+@click.command()
+@click.option(
+    "--multipose-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Multipose dataset directory containing '*_docked' directories",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    required=True,
+    help="Output directory for the derived single pose dataset",
+)
+@click.option(
+    "--compare-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Single pose dataset to compare the derived poses with",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default="single_pose_comparison.csv",
+    help="Output csv of the comparison with --compare-dir",
+)
+@click.option(
+    "--rmsd-cutoff",
+    type=float,
+    default=2.0,
+    help="RMSD between the derived and docked poses above which a pair is reported as disagreeing",
+)
+@profile_main
+def main(multipose_dir, output_dir, compare_dir, report, rmsd_cutoff):
+    """Keep the top ranked pose of every (ligand, reference structure) pair of a multipose run."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    logger = FileLogger(
+        "subset_poses", path=output_dir, logfile="subset_poses.log"
+    ).getLogger()
+
+    derived = {}
+    docked_dirs = sorted(multipose_dir.glob("*docked"))
+    with phase("compute"):
+        for docked_dir in docked_dirs:
+            derived.update(subset_docked_dir(docked_dir, output_dir / docked_dir.name))
+    logger.info(
+        f"Selected {len(derived)} poses from {len(docked_dirs)} docked directories in '{multipose_dir}'"
+    )
+
+    if compare_dir is not None:
+        with phase("compare"):
+            df = compare_poses(derived, load_top_poses(compare_dir), rmsd_cutoff)
+        df.to_csv(report, index=False)
+        for disagreement, count in df.Disagreement.value_counts().items():
+            logger.info(f"{disagreement or 'agree'}: {count} pairs")
+        logger.info(f"Wrote comparison with '{compare_dir}' to '{report}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,27 +13,27 @@ workflow {
     ligand_file_3d = Channel.fromPath("${params.ligandFiles}/${params.ligandFile3d}")
     ligand_file_2d = Channel.fromPath("${params.ligandFiles}/${params.ligandFile2d}")
 
-    // Run calculation processes and collect their CSV outputs
+    // Run calculation processes and collect their similarity matrices
     ecfp_results = CALCULATE_ECFP_TANIMOTO(ligand_file_3d)
         .ecfp_tanimoto
-        .map { dir -> dir.listFiles().find { it.name.endsWith('.csv') } }
+        .map { dir -> dir.resolve('similarity_matrix') }
 
     mcs_results = CALCULATE_MCS_TANIMOTO(ligand_file_3d)
         .mcs_tanimoto
-        .map { dir -> dir.listFiles().find { it.name.endsWith('.csv') } }
+        .map { dir -> dir.resolve('similarity_matrix') }
 
     tanimoto_combo_results = CALCULATE_TANIMOTO_COMBO(ligand_file_3d)
         .tanimoto_combo
-        .map { dir -> dir.listFiles().find { it.name.endsWith('.csv') } }
+        .map { dir -> dir.resolve('similarity_matrix') }
 
-    // Combine all CSV files into a single channel
-    all_csv_files = ecfp_results
+    // Combine all similarity matrices into a single channel
+    all_similarity_data = ecfp_results
         .mix(mcs_results)
         .mix(tanimoto_combo_results)
         .collect()
 
-    // Pass collected CSV files to combine process
-    COMBINE_CHEMICAL_SIMILARITY_DATA(all_csv_files)
+    // Pass collected similarity matrices to combine process
+    COMBINE_CHEMICAL_SIMILARITY_DATA(all_similarity_data)
 
     // Generate date dictionary
     GENERATE_DATE_DICTIONARY()
@@ -48,10 +48,10 @@ workflow ECFP_ANALYSIS {
     CALCULATE_ECFP_TANIMOTO(ligand_file_3d)
 }
 
-// Entry point: Combine existing CSV files (assumes CSV files already exist)
+// Entry point: Combine existing similarity matrices (assumes they already exist)
 workflow COMBINE_SIMILARITY_DATA {
-    // This assumes CSV files already exist in the expected locations
+    // This assumes the similarity matrices already exist in the expected locations
     // You might need to adjust paths based on your directory structure
-    csv_files = Channel.fromPath("${params.chemicalSimilarityData}/*/*.csv").collect()
-    COMBINE_CHEMICAL_SIMILARITY_DATA(csv_files)
+    similarity_data = Channel.fromPath("${params.chemicalSimilarityData}/*/similarity_matrix", type: 'dir').collect()
+    COMBINE_CHEMICAL_SIMILARITY_DATA(similarity_data)
 }
\ No newline at end of file
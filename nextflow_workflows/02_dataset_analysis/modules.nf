@@ -10,13 +10,17 @@ process GENERATE_DATE_DICTIONARY {
 
     script:
     """
-    python3 "${params.scripts}"/generate_date_dict.py --fragalysis-dir "${params.curatedFragalysis}" --output-dir cmpd_date_dict
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/generate_date_dict.py \
+    --fragalysis-dir "${params.curatedFragalysis}" \
+    --output-dir cmpd_date_dict \
+    --metadata-cache "${params.fragalysisMetadataCache}"
     """
 }
 process CALCULATE_ECFP_TANIMOTO {
     publishDir "${params.chemicalSimilarityData}", mode: 'copy', overwrite: true
     conda "${params.asap}"
     tag "calculate-ecfp-tanimoto"
+    clusterOptions '--partition "cpu" --time=02:00:00 --mem=32GB --cpus-per-task=8'
 
     input:
     path(ligand_file_3d)
@@ -26,13 +30,16 @@ process CALCULATE_ECFP_TANIMOTO {
 
     script:
     """
-    python3 "${params.scripts}"/calculate_ecfp_tanimoto.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir ecfp_tanimoto
+    python3 "${params.scripts}"/calculate_ecfp_tanimoto.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir ecfp_tanimoto --n-threads 8 --fingerprint-store "${params.fingerprintStore}"
     """
 }
 process CALCULATE_MCS_TANIMOTO {
     publishDir "${params.chemicalSimilarityData}", mode: 'copy', overwrite: true
     conda "${params.asap}"
     tag "calculate-mcs-tanimoto"
+    // finished tiles are kept in the ledger, so a timed out run is retried and resumes
+    errorStrategy { task.exitStatus in [137,140,143,247] ? 'retry' : 'finish' }
+    maxRetries 3
     clusterOptions '--partition "cpu" --time=24:00:00 --mem=64GB --cpus-per-task=32'
 
     input:
@@ -43,7 +50,7 @@ process CALCULATE_MCS_TANIMOTO {
 
     script:
     """
-    python3 "${params.scripts}"/calculate_mcs_tanimoto.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir mcs_tanimoto --ncpus 32
+    python3 "${params.scripts}"/calculate_mcs_tanimoto.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir mcs_tanimoto --ncpus 32 --ledger-dir "${params.mcsTileLedgers}" --cache "${params.similarityCache}/mcs_tanimoto.sqlite" ${params.mcsPairTimeout ? "--pair-timeout ${params.mcsPairTimeout}" : ''}
     """
 }
 process CALCULATE_TANIMOTO_COMBO {
@@ -60,7 +67,7 @@ process CALCULATE_TANIMOTO_COMBO {
 
     script:
     """
-    python3 "${params.scripts}"/calculate_tanimoto_combo.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir tanimoto_combo
+    python3 "${params.scripts}"/calculate_tanimoto_combo.py --ref-ligand-sdf "${ligand_file_3d}" --output-dir tanimoto_combo --cache "${params.similarityCache}/tanimoto_combo.sqlite" --shape-prep "${params.ligandFiles}/${params.ligandFile3dShapePrep}"
     """
 }
 process COMBINE_CHEMICAL_SIMILARITY_DATA {
@@ -69,14 +76,15 @@ process COMBINE_CHEMICAL_SIMILARITY_DATA {
     tag "combine-chemical-similarity-data"
 
     input:
-    path csv_files
+    // every metric writes a directory named similarity_matrix, so each is staged in a directory of its own
+    path similarity_data, stageAs: 'similarity_?/*'
 
     output:
     path "combined_chemical_similarity_data.csv", emit: combined_chemical_similarity_data
 
     script:
     """
-    python3 "${params.scripts}/combine_chemical_similarity_data.py" ${csv_files.join(' ')}
+    python3 "${params.scripts}/combine_chemical_similarity_data.py" ${similarity_data.join(' ')}
     """
 }
 process RUN_BEMIS_MURCKO_CLUSTERING {
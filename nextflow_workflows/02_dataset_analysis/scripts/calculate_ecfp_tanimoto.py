@@ -1,15 +1,32 @@
 """
 Script to generate ECFP fingerprint similarity analysis between reference and query ligands.
+
+Fingerprints are packed into bit matrices and the full reference x query Tanimoto matrix is computed at once for
+each radius and bit size, see fingerprint_tanimoto.py. Each molecule is perceived once, and the fingerprints of
+every radius and bit size are folded from its unfolded features, see fingerprint_store.py. With --fingerprint-store
+the features are kept between runs. The matrices are written as they are, see similarity_matrix.py.
 """
 
 from openeye import oegraphsim
 from asapdiscovery.data.readers.molfile import MolFileFactory
+import numpy as np
 import pandas as pd
 import itertools
 import argparse
+import os
 from pathlib import Path
 from asapdiscovery.data.util.logging import FileLogger
 from chemical_similarity_schema import ECFPSimilarity
+from fingerprint_store import (
+    FingerprintStore,
+    ensure_fingerprint_store,
+    get_smiles,
+    verify_folding,
+)
+from fingerprint_tanimoto import tanimoto_matrix
+from similarity_matrix import MATRIX_DIRNAME, SimilarityMatrices
+
+N_VERIFY_MOLECULES = 32
 
 
 def parse_args():
@@ -34,6 +51,37 @@ def parse_args():
     parser.add_argument(
         "--settings", type=Path, required=False, help="Path to settings json file"
     )
+    parser.add_argument(
+        "--radii",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3, 4, 5],
+        help="Fingerprint radii to calculate, i.e. ECFP2 to ECFP10 by default.",
+    )
+    parser.add_argument(
+        "--bit-sizes",
+        type=int,
+        nargs="+",
+        default=[1024, 2048],
+        help="Fingerprint bit sizes to calculate.",
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of threads used to calculate the similarity matrices.",
+    )
+    parser.add_argument(
+        "--fingerprint-store",
+        type=Path,
+        required=False,
+        help="Path to a persistent fingerprint store to read and update. If not given, fingerprints are not kept.",
+    )
+    parser.add_argument(
+        "--write-csv",
+        action="store_true",
+        help="Also write the long-form CSV next to the similarity matrices.",
+    )
     return parser.parse_args()
 
 
@@ -55,6 +103,22 @@ def calculate_tanimoto(fp1, fp2):
     return oegraphsim.OETanimoto(fp1, fp2)
 
 
+def similarity_matrix_to_dataframe(
+    matrix: np.ndarray, ref_names: list, query_names: list, radius: int, bit_size: int
+) -> pd.DataFrame:
+    """
+    Convert a reference x query similarity matrix into the long form written by ECFPSimilarity.construct_dataframe.
+    """
+    n_ref, n_query = matrix.shape
+    return ECFPSimilarity.construct_dataframe_from_arrays(
+        Reference_Ligand=np.repeat(np.asarray(ref_names, dtype=object), n_query),
+        Query_Ligand=np.tile(np.asarray(query_names, dtype=object), n_ref),
+        Tanimoto=matrix.ravel(),
+        radius=radius,
+        bitsize=bit_size,
+    )
+
+
 def main():
     args = parse_args()
     output_dir = args.output_dir
@@ -76,48 +140,94 @@ def main():
     logger.info(f"Loaded {len(references)} reference molecules.")
     logger.info(f"Loaded {len(queries)} query molecules.")
 
-    # Create or load settings
-    # radii = [2, 3, 4, 5]
-    radii = [2, 5]
-    # bit_sizes = [1024, 2048]
-    bit_sizes = [2048]
-    dfs = []
-    for radius, bit_size in itertools.product(radii, bit_sizes):
+    ref_names = [mol.compound_name for mol in references]
+    query_names = [mol.compound_name for mol in queries]
+    ref_mols = [mol.to_oemol() for mol in references]
+    query_mols = (
+        [mol.to_oemol() for mol in queries] if args.query_ligand_sdf else ref_mols
+    )
+    logger.info(f"Using {args.n_threads} threads.")
+
+    all_mols = ref_mols + query_mols if args.query_ligand_sdf else ref_mols
+    logger.info("Calculating fingerprints...")
+    if args.fingerprint_store:
+        store = ensure_fingerprint_store(
+            args.fingerprint_store,
+            all_mols,
+            max(args.radii),
+            logger=logger,
+        )
+    else:
+        store = FingerprintStore.from_molecules(
+            all_mols,
+            max(args.radii),
+        )
+    ref_smiles = [get_smiles(mol) for mol in ref_mols]
+    query_smiles = (
+        [get_smiles(mol) for mol in query_mols] if args.query_ligand_sdf else ref_smiles
+    )
+
+    # folding is checked against OEMakeCircularFP on a fixed sample of the molecules
+    rng = np.random.default_rng(0)
+    verify_mols = [
+        all_mols[i]
+        for i in rng.choice(
+            len(all_mols), min(N_VERIFY_MOLECULES, len(all_mols)), replace=False
+        )
+    ]
+
+    matrices = SimilarityMatrices(
+        ref_names, query_names, metadata={"script": "calculate_ecfp_tanimoto.py"}
+    )
+    for radius, bit_size in itertools.product(args.radii, args.bit_sizes):
         logger.info(
             f"Calculating similarities for radius {radius} and bit size {bit_size}"
         )
-
-        # Create all pairs and calculate similarities
-        logger.info("Calculating fingerprints...")
-        ref_fps = {
-            mol.compound_name: get_fp(mol.to_oemol(), bit_size, radius)
-            for mol in references
-        }
-        query_fps = {
-            mol.compound_name: get_fp(mol.to_oemol(), bit_size, radius)
-            for mol in queries
-        }
+        if not verify_folding(store, verify_mols, radius, bit_size):
+            raise ValueError(
+                f"Folded fingerprints of radius {radius} and bit size {bit_size} don't match OEMakeCircularFP"
+            )
+        ref_fps = store.fold(ref_smiles, radius, bit_size)
+        query_fps = (
+            store.fold(query_smiles, radius, bit_size)
+            if args.query_ligand_sdf
+            else ref_fps
+        )
 
         logger.info("Calculating similarities...")
-        similarities = [
-            ECFPSimilarity(
-                Reference_Ligand=ref,
-                Query_Ligand=query,
-                Tanimoto=calculate_tanimoto(ref_fps[ref], query_fps[query]),
-                radius=radius,
-                bitsize=bit_size,
-            )
-            for ref, query in itertools.product(ref_fps.keys(), query_fps.keys())
-        ]
-        df = ECFPSimilarity.construct_dataframe(similarities)
-        dfs.append(df)
+        matrix = tanimoto_matrix(ref_fps, query_fps, n_threads=args.n_threads)
+        matrices.add(
+            {
+                "Type": "ECFP",
+                "Tanimoto": matrix,
+                "radius": radius,
+                "bitsize": bit_size,
+                # same as ECFPSimilarity.Fingerprint
+                "fingerprint": f"ECFP{radius * 2}_{bit_size}",
+            }
+        )
 
     # Save results
     logger.info("Saving results...")
-    df = pd.concat(dfs, ignore_index=True)
-    output_path = output_dir / "fingerprint_similarities.csv"
-    df.to_csv(output_path, index=False)
-    logger.info(f"Results saved to {output_path}")
+    matrices.save(output_dir / MATRIX_DIRNAME)
+    logger.info(f"Similarity matrices saved to {output_dir / MATRIX_DIRNAME}")
+    if args.write_csv:
+        df = pd.concat(
+            [
+                similarity_matrix_to_dataframe(
+                    entry["Tanimoto"],
+                    ref_names,
+                    query_names,
+                    entry["radius"],
+                    entry["bitsize"],
+                )
+                for entry in matrices.entries
+            ],
+            ignore_index=True,
+        )
+        output_path = output_dir / "fingerprint_similarities.csv"
+        df.to_csv(output_path, index=False)
+        logger.info(f"Results saved to {output_path}")
 
 
 if __name__ == "__main__":
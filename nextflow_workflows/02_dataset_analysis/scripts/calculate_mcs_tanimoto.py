@@ -1,17 +1,68 @@
 """
 Script to calculate the Maximum Common Substructure between reference and query ligands.
+
+The similarity matrix is cut into tiles of one reference against a block of queries. The tiles are scheduled
+largest estimated cost first, and each finished tile is committed to a ledger as soon as it comes back, see
+tile_ledger.py. A restarted job skips the pairs in the ledger.
+
+With --threshold or --top-k, only the pairs that can matter are calculated. Atoms only match when their atomic
+number, aromaticity and formal charge agree, so the MCS can hold no more atoms of each such type than the smaller of
+the two molecules has. This gives a cheap upper bound of the MCS Tanimoto, and the exact search is skipped for pairs
+whose bound is below the threshold, or can't beat the k-th best Tanimoto of the query found so far. Top-k pairs
+are calculated in rounds, each taking the k highest bounds that can still enter the top k of every query. Every
+pair that is calculated gets its exact value; the others are NaN in the Tanimoto matrix and -1 in the atom counts.
+
+With --cache, pairs are first looked up in a persistent similarity cache keyed by their SMILES, see
+similarity_cache.py, and every calculated tile is added to it, so a dataset refresh only searches the new pairs.
+With --pair-timeout, a search that takes longer is given up on. The pair is stored as timed out in the ledger and
+the cache along with the timeout, so it is only tried again when given longer, and is NaN in the Tanimoto matrix
+and -2 in the atom counts. The matrices are then incomplete: the timed out pairs are reported in the log, listed in
+the metadata of the matrices, and missing from the long-form CSV.
 """
 
+from collections import Counter
 from openeye import oechem
 from asapdiscovery.data.readers.molfile import MolFileFactory
-from asapdiscovery.data.schema.ligand import Ligand
-import pandas as pd
 import argparse
+import functools
+import itertools
+import os
+import select
+import signal
+import struct
+import traceback
 from pathlib import Path
 from asapdiscovery.data.util.logging import FileLogger
 import numpy as np
 import multiprocessing as mp
 from chemical_similarity_schema import MCSSimilarity
+from molecule_pool import MoleculePool, get_queries, get_reference, get_worker_logger
+from similarity_cache import SimilarityCache, get_molecule_key
+from similarity_cache import CALCULATED as CACHE_CALCULATED
+from similarity_cache import TIMED_OUT as CACHE_TIMED_OUT
+from similarity_matrix import MATRIX_DIRNAME, SimilarityMatrices
+from tile_ledger import TileLedger, get_ledger_key, get_tiles
+
+ATOM_EXPR = (
+    oechem.OEExprOpts_Aromaticity
+    | oechem.OEExprOpts_AtomicNumber
+    | oechem.OEExprOpts_FormalCharge
+)
+BOND_EXPR = oechem.OEExprOpts_Aromaticity | oechem.OEExprOpts_BondOrder
+
+# everything besides the molecules and the OEChem release that changes the MCS, for the ledger key and cache parameters
+MCS_SETTINGS = {
+    "atom_expr": ATOM_EXPR,
+    "bond_expr": BOND_EXPR,
+    "mcs_func": "OEMCSMaxAtomsCompleteCycles",
+}
+
+# atom counts of the pairs that haven't been calculated and of those whose search timed out
+NOT_CALCULATED = -1
+MCS_TIMED_OUT = -2
+
+# (query index, MCS atom count, union atom count) sent back by the search process of one_to_many_mcs_with_timeout
+PAIR_RECORD = struct.Struct("qqq")
 
 
 def parse_args():
@@ -39,9 +90,65 @@ def parse_args():
         default=1,
         help="Number of CPUs to use for parallelization.",
     )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=256,
+        help="Number of query molecules compared with one reference in each task.",
+    )
+    parser.add_argument(
+        "--ledger-dir",
+        type=Path,
+        required=False,
+        help="Directory of the ledgers of finished tiles, kept between runs to resume from. Defaults to the output directory.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        required=False,
+        help="Only calculate the pairs whose MCS Tanimoto can be at least this high.",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        required=False,
+        help="Only calculate the pairs that can be among the k most similar references of each query.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        required=False,
+        help="SQLite file of the persistent similarity cache to read pairs from and add calculated pairs to.",
+    )
+    parser.add_argument(
+        "--pair-timeout",
+        type=float,
+        required=False,
+        help="Give up on the MCS search of a pair after this many seconds.",
+    )
+    parser.add_argument(
+        "--write-csv",
+        action="store_true",
+        help="Also write the long-form CSV next to the similarity matrices.",
+    )
     return parser.parse_args()
 
 
+def get_mcs_search(refmol: oechem.OEMol) -> oechem.OEMCSSearch:
+    pattern_query = oechem.OEQMol(refmol)
+    pattern_query.BuildExpressions(ATOM_EXPR, BOND_EXPR)
+    mcss = oechem.OEMCSSearch(pattern_query)
+    mcss.SetMCSFunc(oechem.OEMCSMaxAtomsCompleteCycles())
+    return mcss
+
+
+def get_mcs_num_atoms(mcss: oechem.OEMCSSearch, querymol: oechem.OEMol) -> int:
+    try:
+        return next(iter(mcss.Match(querymol, True))).NumAtoms()
+    except StopIteration:
+        return 0
+
+
 def one_to_many_mcs(refmol: oechem.OEMol, querymols: list[oechem.OEMol]):
     """
     Get the number of atoms in the maximum common substructure and union between each pair of molecules.
@@ -49,61 +156,208 @@ def one_to_many_mcs(refmol: oechem.OEMol, querymols: list[oechem.OEMol]):
     :param querymols: List of query molecules to compare against
     :return: Arrays of MCS atom counts and union atom counts
     """
-    atomexpr = (
-        oechem.OEExprOpts_Aromaticity
-        | oechem.OEExprOpts_AtomicNumber
-        | oechem.OEExprOpts_FormalCharge
-    )
-    bondexpr = oechem.OEExprOpts_Aromaticity | oechem.OEExprOpts_BondOrder
-
     mcs_num_atoms = np.zeros(len(querymols), dtype=int)
     union_num_atoms = np.zeros(len(querymols), dtype=int)
-    pattern_query = oechem.OEQMol(refmol)
-    pattern_query.BuildExpressions(atomexpr, bondexpr)
-    mcss = oechem.OEMCSSearch(pattern_query)
-    mcss.SetMCSFunc(oechem.OEMCSMaxAtomsCompleteCycles())
+    mcss = get_mcs_search(refmol)
 
     for j, querymol in enumerate(querymols):
-        try:
-            mcs = next(iter(mcss.Match(querymol, True)))
-            mcs_num_atoms[j] = mcs.NumAtoms()
-        except StopIteration:
-            mcs_num_atoms[j] = 0
+        mcs_num_atoms[j] = get_mcs_num_atoms(mcss, querymol)
         # Union = Total atoms - Overlap
         union_num_atoms[j] = refmol.NumAtoms() + querymol.NumAtoms() - mcs_num_atoms[j]
 
     return mcs_num_atoms, union_num_atoms
 
 
-def parallelize(ref: Ligand, query_ligands: list[Ligand], logger):
-    """
-    Calculate the MCS between a reference ligand and a list of query ligands.
-    :param ref: Reference ligand
-    :param query_ligands: List of query ligands
-    :return: Dataframe with MCS results
-    """
-    logger.info(f"Calculating MCS for {ref.compound_name}...")
-    refmol = ref.to_oemol()
-    query_mols = [query.to_oemol() for query in query_ligands]
-    num_atoms_mcs_array, num_atoms_union_array = one_to_many_mcs(refmol, query_mols)
-    tanimoto_array = num_atoms_mcs_array / num_atoms_union_array
-    return MCSSimilarity.construct_dataframe(
-        [
-            MCSSimilarity(
-                Reference_Ligand=ref.compound_name,
-                Query_Ligand=query.compound_name,
-                Tanimoto=tanimoto,
-                N_Atoms_in_MCS=mcs,
-                N_Atoms_in_Union=union,
-            )
-            for (query, tanimoto, mcs, union) in zip(
-                query_ligands,
-                tanimoto_array,
-                num_atoms_mcs_array,
-                num_atoms_union_array,
-            )
-        ]
+def one_to_many_mcs_with_timeout(
+    refmol: oechem.OEMol, querymols: list[oechem.OEMol], timeout: float
+):
+    """
+    Like one_to_many_mcs, but give up on a pair after timeout seconds.
+    A running OEMCSSearch can't be interrupted, so the searches run in a forked process that sends back the result
+    of each pair as it finishes. When a pair takes too long the process is killed, the pair is marked as
+    MCS_TIMED_OUT, and a new process continues with the next pair.
+    :return: Arrays of MCS atom counts and union atom counts, MCS_TIMED_OUT for the pairs that timed out
+    """
+    mcs_num_atoms = np.full(len(querymols), MCS_TIMED_OUT, dtype=int)
+    union_num_atoms = np.full(len(querymols), MCS_TIMED_OUT, dtype=int)
+    start = 0
+    while start < len(querymols):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            exit_code = 0
+            try:
+                mcss = get_mcs_search(refmol)
+                for j in range(start, len(querymols)):
+                    num_atoms = get_mcs_num_atoms(mcss, querymols[j])
+                    union = refmol.NumAtoms() + querymols[j].NumAtoms() - num_atoms
+                    # records are smaller than PIPE_BUF, so each write is atomic
+                    os.write(write_fd, PAIR_RECORD.pack(j, num_atoms, union))
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        os.close(write_fd)
+        try:
+            while start < len(querymols):
+                ready, _, _ = select.select([read_fd], [], [], timeout)
+                if not ready:
+                    os.kill(pid, signal.SIGKILL)
+                    # the pair being searched keeps its MCS_TIMED_OUT values
+                    start += 1
+                    break
+                record = os.read(read_fd, PAIR_RECORD.size)
+                if len(record) != PAIR_RECORD.size:
+                    raise RuntimeError(
+                        f"MCS search process stopped at query {start} of {refmol.GetTitle()}"
+                    )
+                j, mcs_num_atoms[j], union_num_atoms[j] = PAIR_RECORD.unpack(record)
+                start = j + 1
+        finally:
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+
+    return mcs_num_atoms, union_num_atoms
+
+
+def run_tile(tile: tuple, timeout: float = None):
+    """
+    Calculate the MCS between one reference and a block of the query molecules held by the worker.
+    :param tile: (reference index, query indices)
+    :param timeout: Seconds after which the search of a pair is given up on
+    :return: The tile and its arrays of MCS atom counts and union atom counts
+    """
+    ref_index, query_indices = tile
+    refmol = get_reference(ref_index)
+    logger = get_worker_logger()
+    logger.debug(
+        f"Calculating MCS for reference {ref_index} ({refmol.GetTitle()}) and {len(query_indices)} queries..."
+    )
+    queries = get_queries()
+    querymols = [queries[j] for j in query_indices]
+    if timeout is None:
+        return tile, *one_to_many_mcs(refmol, querymols)
+    mcs_num_atoms, union_num_atoms = one_to_many_mcs_with_timeout(
+        refmol, querymols, timeout
+    )
+    for j in np.flatnonzero(mcs_num_atoms == MCS_TIMED_OUT):
+        logger.warning(
+            f"MCS search of {refmol.GetTitle()} and {querymols[j].GetTitle()} timed out after {timeout} s"
+        )
+    return tile, mcs_num_atoms, union_num_atoms
+
+
+def get_tile_costs(tiles: list, ref_sizes: np.ndarray, query_sizes: np.ndarray):
+    """
+    Estimate the relative cost of each tile as the product of the reference and query atom counts.
+    """
+    return np.array(
+        [ref_sizes[ref] * query_sizes[queries].sum() for ref, queries in tiles]
+    )
+
+
+def get_atom_compositions(mols: list, atom_types: dict) -> np.ndarray:
+    """
+    Count the atoms of every molecule by the properties that ATOM_EXPR matches on.
+    :param atom_types: Column of every (atomic number, aromatic, formal charge) type, extended with new types
+    :return: Array of shape (n_molecules, n_types) with the columns in the order of atom_types
+    """
+    counts = [
+        Counter(
+            (atom.GetAtomicNum(), atom.IsAromatic(), atom.GetFormalCharge())
+            for atom in mol.GetAtoms()
+        )
+        for mol in mols
+    ]
+    for count in counts:
+        for atom_type in count:
+            atom_types.setdefault(atom_type, len(atom_types))
+    compositions = np.zeros((len(mols), len(atom_types)), dtype=np.int64)
+    for i, count in enumerate(counts):
+        for atom_type, n in count.items():
+            compositions[i, atom_types[atom_type]] = n
+    return compositions
+
+
+def mcs_tanimoto_upper_bounds(
+    ref_compositions: np.ndarray, query_compositions: np.ndarray, block_size: int = 64
+) -> np.ndarray:
+    """
+    Upper bound of the MCS Tanimoto of every pair from the overlap of their atom compositions.
+    The Tanimoto mcs / (n_ref + n_query - mcs) grows with the MCS size, so the bound on the MCS size bounds it too.
+    :return: Array of shape (n_ref, n_query)
+    """
+    ref_sizes = ref_compositions.sum(axis=1)
+    # the union counts every atom of the query, including those of types the references don't have
+    query_sizes = query_compositions.sum(axis=1)
+    # types only seen in the queries have no column in the reference compositions, and can't overlap
+    query_compositions = query_compositions[:, : ref_compositions.shape[1]]
+    bounds = np.zeros((len(ref_compositions), len(query_compositions)))
+    for start in range(0, len(ref_compositions), block_size):
+        stop = min(start + block_size, len(ref_compositions))
+        overlap = np.minimum(
+            ref_compositions[start:stop, None, :], query_compositions[None, :, :]
+        ).sum(axis=2)
+        union = ref_sizes[start:stop, None] + query_sizes[None, :] - overlap
+        np.divide(overlap, union, out=bounds[start:stop], where=union > 0)
+    return bounds
+
+
+def select_top_k_candidates(
+    bounds: np.ndarray, tanimoto: np.ndarray, eligible: np.ndarray, k: int
+) -> np.ndarray:
+    """
+    Pick the next pairs to calculate for the k most similar references of every query.
+    A pair can only enter the top k of its query if its bound beats the k-th best Tanimoto calculated so far. Of
+    those, the k pairs with the highest bounds are taken for each query, so the k-th best rises quickly.
+    :param tanimoto: Calculated Tanimoto of every pair, NaN if it hasn't been calculated
+    :param eligible: Uncalculated pairs that may be calculated
+    :return: Boolean mask of the pairs to calculate in this round
+    """
+    k = min(k, len(bounds))
+    calculated = np.where(np.isnan(tanimoto), -np.inf, tanimoto)
+    # -inf for queries with fewer than k calculated pairs, which leaves all their pairs as candidates
+    kth_best = -np.partition(-calculated, k - 1, axis=0)[k - 1]
+    candidate_bounds = np.where(
+        eligible & (bounds > kth_best[None, :]), bounds, -np.inf
+    )
+    best = np.argsort(-candidate_bounds, axis=0, kind="stable")[:k]
+    selected = np.zeros(bounds.shape, dtype=bool)
+    np.put_along_axis(
+        selected,
+        best,
+        np.isfinite(np.take_along_axis(candidate_bounds, best, axis=0)),
+        axis=0,
     )
+    return selected
+
+
+def calculate_tiles(
+    pool,
+    tiles: list,
+    ref_sizes: np.ndarray,
+    query_sizes: np.ndarray,
+    logger,
+    timeout: float = None,
+):
+    """
+    Calculate tiles in the pool, yielding each tile and its atom counts as it finishes.
+    """
+    # start the most expensive tiles first so they don't end up as stragglers
+    costs = get_tile_costs(tiles, ref_sizes, query_sizes)
+    tiles = [tiles[i] for i in np.argsort(-costs, kind="stable")]
+    for i, result in enumerate(
+        pool.imap_unordered(
+            functools.partial(run_tile, timeout=timeout), tiles, chunksize=1
+        ),
+        start=1,
+    ):
+        yield result
+        if i % max(1, len(tiles) // 20) == 0:
+            logger.info(f"Finished {i} of {len(tiles)} tiles")
 
 
 def main():
@@ -122,27 +376,202 @@ def main():
     queries = (
         MolFileFactory(filename=args.query_ligand_sdf).load()
         if args.query_ligand_sdf
-        else references.copy()
+        else references
     )
 
     logger.info(f"Loaded {len(references)} reference molecules.")
     logger.info(f"Loaded {len(queries)} query molecules.")
 
+    ref_mols = [ref.to_oemol() for ref in references]
+    query_mols = (
+        [query.to_oemol() for query in queries] if args.query_ligand_sdf else ref_mols
+    )
+    ref_names = [ref.compound_name for ref in references]
+    query_names = [query.compound_name for query in queries]
+
+    ref_keys = [get_molecule_key(mol) for mol in ref_mols]
+    query_keys = (
+        [get_molecule_key(mol) for mol in query_mols]
+        if args.query_ligand_sdf
+        else ref_keys
+    )
+    settings = {**MCS_SETTINGS, "oechem_release": oechem.OEChemGetRelease()}
+    ledger_key = get_ledger_key(ref_keys, query_keys, settings)
+    ledger_dir = (args.ledger_dir or output_dir / "mcs_tiles") / ledger_key[:16]
+    ledger = TileLedger(ledger_dir)
+    shape = (len(ref_mols), len(query_mols))
+    num_atoms_mcs = ledger.assemble(*shape, "N_Atoms_in_MCS", NOT_CALCULATED)
+    num_atoms_union = ledger.assemble(*shape, "N_Atoms_in_Union", NOT_CALCULATED)
+    # pairs that timed out with a shorter timeout than this run's are tried again
+    pair_timeout = args.pair_timeout if args.pair_timeout is not None else np.inf
+    retry = (num_atoms_union == MCS_TIMED_OUT) & (
+        ledger.assemble(*shape, "Pair_Timeout", np.inf) < pair_timeout
+    )
+    num_atoms_mcs[retry] = NOT_CALCULATED
+    num_atoms_union[retry] = NOT_CALCULATED
+    logger.info(
+        f"{(num_atoms_union != NOT_CALCULATED).sum()} of {num_atoms_union.size} pairs already calculated in "
+        f"'{ledger_dir}', retrying {retry.sum()} that timed out with a shorter timeout"
+    )
+
+    cache = None
+    if args.cache:
+        cache = SimilarityCache(args.cache)
+        status, values = cache.lookup(
+            "MCS",
+            settings,
+            ref_keys,
+            query_keys,
+            ["N_Atoms_in_MCS", "N_Atoms_in_Union"],
+            timeout=args.pair_timeout,
+        )
+        hits = (status == CACHE_CALCULATED) & (num_atoms_union == NOT_CALCULATED)
+        num_atoms_mcs[hits] = values["N_Atoms_in_MCS"][hits]
+        num_atoms_union[hits] = values["N_Atoms_in_Union"][hits]
+        timed_out = (status == CACHE_TIMED_OUT) & (num_atoms_union == NOT_CALCULATED)
+        num_atoms_mcs[timed_out] = MCS_TIMED_OUT
+        num_atoms_union[timed_out] = MCS_TIMED_OUT
+        logger.info(
+            f"Found {hits.sum()} calculated and {timed_out.sum()} timed out pairs in the cache '{args.cache}'"
+        )
+
+    def record(tile, mcs, union):
+        ledger.append(
+            tile,
+            {
+                "N_Atoms_in_MCS": mcs,
+                "N_Atoms_in_Union": union,
+                "Pair_Timeout": np.full(len(mcs), pair_timeout),
+            },
+        )
+        ref_index, query_indices = tile
+        num_atoms_mcs[ref_index, query_indices] = mcs
+        num_atoms_union[ref_index, query_indices] = union
+        if cache is not None:
+            cache.store(
+                "MCS",
+                settings,
+                [(ref_keys[ref_index], query_keys[j]) for j in query_indices],
+                {"N_Atoms_in_MCS": mcs, "N_Atoms_in_Union": union},
+                timed_out=mcs == MCS_TIMED_OUT,
+                timeout=args.pair_timeout,
+            )
+
+    eligible = num_atoms_union == NOT_CALCULATED
+    if args.threshold is not None or args.top_k is not None:
+        atom_types = {}
+        ref_compositions = get_atom_compositions(ref_mols, atom_types)
+        query_compositions = (
+            get_atom_compositions(query_mols, atom_types)
+            if args.query_ligand_sdf
+            else ref_compositions
+        )
+        bounds = mcs_tanimoto_upper_bounds(ref_compositions, query_compositions)
+        if args.threshold is not None:
+            eligible &= bounds >= args.threshold
+            logger.info(
+                f"{eligible.sum()} uncalculated pairs have an MCS Tanimoto bound of at least {args.threshold}"
+            )
+
+    ref_sizes = np.array([mol.NumAtoms() for mol in ref_mols])
+    query_sizes = np.array([mol.NumAtoms() for mol in query_mols])
+
     logger.info("Calculating similarities...")
     # Parallelize the MCS calculation
     cpus = min(args.ncpus, mp.cpu_count())
     logger.info(f"Using {cpus} CPUs for parallelization.")
-    with mp.Pool(cpus) as pool:
-        results = pool.starmap(
-            parallelize, [(ref, queries, logger) for ref in references]
+    if eligible.any():
+        with MoleculePool(ref_mols, query_mols, cpus, logger) as pool:
+            if args.top_k is None:
+                for result in calculate_tiles(
+                    pool,
+                    get_tiles(eligible, args.tile_size),
+                    ref_sizes,
+                    query_sizes,
+                    logger,
+                    args.pair_timeout,
+                ):
+                    record(*result)
+            else:
+                # every round calculates at least one pair of each query it selects, so this ends
+                for n_round in itertools.count(1):
+                    calculated = num_atoms_union >= 0
+                    selected = select_top_k_candidates(
+                        bounds,
+                        np.where(calculated, num_atoms_mcs / num_atoms_union, np.nan),
+                        eligible & (num_atoms_union == NOT_CALCULATED),
+                        args.top_k,
+                    )
+                    if not selected.any():
+                        break
+                    logger.info(
+                        f"Round {n_round} of top-{args.top_k} search: calculating {selected.sum()} pairs"
+                    )
+                    for result in calculate_tiles(
+                        pool,
+                        get_tiles(selected, args.tile_size),
+                        ref_sizes,
+                        query_sizes,
+                        logger,
+                        args.pair_timeout,
+                    ):
+                        record(*result)
+    ledger.close()
+    if cache is not None:
+        cache.close()
+    calculated = num_atoms_union >= 0
+    timed_out_pairs = [
+        [ref_names[i], query_names[j]]
+        for i, j in zip(*np.nonzero(num_atoms_union == MCS_TIMED_OUT))
+    ]
+    logger.info(
+        f"{calculated.sum()} of {calculated.size} pairs calculated, {len(timed_out_pairs)} timed out"
+    )
+    if timed_out_pairs:
+        logger.warning(
+            f"The MCS matrices are incomplete: the search timed out after {args.pair_timeout} s for "
+            f"{len(timed_out_pairs)} pairs, which are NaN in the Tanimoto matrix, listed in its metadata and "
+            f"missing from the long-form CSV: "
+            + ", ".join(f"{ref}/{query}" for ref, query in timed_out_pairs[:20])
+            + (", ..." if len(timed_out_pairs) > 20 else "")
         )
-        results = [result for result in results if result is not None]
+
     # Save results
     logger.info("Saving results...")
-    df = pd.concat(results, ignore_index=True)
-    output_path = output_dir / "mcs_tanimoto.csv"
-    df.to_csv(output_path, index=False)
-    logger.info(f"Results saved to {output_path}")
+    tanimoto = np.full(shape, np.nan)
+    np.divide(num_atoms_mcs, num_atoms_union, out=tanimoto, where=calculated)
+    matrices = SimilarityMatrices(
+        ref_names,
+        query_names,
+        metadata={
+            "script": "calculate_mcs_tanimoto.py",
+            "pair_timeout": args.pair_timeout,
+            "complete": not timed_out_pairs,
+            "timed_out_pairs": timed_out_pairs,
+        },
+    )
+    matrices.add(
+        {
+            "Type": "MCS",
+            "Tanimoto": tanimoto,
+            "N_Atoms_in_MCS": num_atoms_mcs,
+            "N_Atoms_in_Union": num_atoms_union,
+        }
+    )
+    matrices.save(output_dir / MATRIX_DIRNAME)
+    logger.info(f"Similarity matrices saved to {output_dir / MATRIX_DIRNAME}")
+    if args.write_csv:
+        ref_indices, query_indices = np.nonzero(calculated)
+        df = MCSSimilarity.construct_dataframe_from_arrays(
+            Reference_Ligand=np.asarray(ref_names, dtype=object)[ref_indices],
+            Query_Ligand=np.asarray(query_names, dtype=object)[query_indices],
+            Tanimoto=tanimoto[calculated],
+            N_Atoms_in_MCS=num_atoms_mcs[calculated],
+            N_Atoms_in_Union=num_atoms_union[calculated],
+        )
+        output_path = output_dir / "mcs_tanimoto.csv"
+        df.to_csv(output_path, index=False)
+        logger.info(f"Results saved to {output_path}")
 
 
 if __name__ == "__main__":
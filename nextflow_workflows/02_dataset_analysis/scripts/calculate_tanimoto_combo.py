@@ -1,16 +1,36 @@
 """
 Script to calculate the TanimotoCombo between reference and query ligands.
+
+With --cache, pairs are first looked up in a persistent similarity cache, see similarity_cache.py, and only the
+missing ones are calculated and added to it. TanimotoCombo depends on the 3D coordinates, so the molecules are
+keyed by their SMILES together with a hash of their coordinates.
+
+For the non-aligned scores the molecules are prepared for shape and color overlap once, see shape_prep.py, and
+with --shape-prep the prepared molecules are kept next to the ligand file for the next run. The overlap function
+sets up the reference once and scores the prepared fit molecules directly. The aligned scores are calculated by
+OEROCSOverlay on the unprepared molecules, as they always have been, since it prepares its own copies.
 """
 
 from openeye import oeshape, oechem
 from asapdiscovery.data.readers.molfile import MolFileFactory
-from asapdiscovery.data.schema.ligand import Ligand
+import numpy as np
 import pandas as pd
 import argparse
+import functools
 from pathlib import Path
 from asapdiscovery.data.util.logging import FileLogger
 import multiprocessing as mp
 from chemical_similarity_schema import TanimotoComboSimilarity
+from molecule_pool import MoleculePool, get_queries, get_reference, get_worker_logger
+from shape_prep import PREP_SETTINGS, ensure_shape_prep, prep_molecules
+from similarity_cache import CALCULATED, SimilarityCache, get_molecule_key
+from similarity_matrix import MATRIX_DIRNAME, SimilarityMatrices
+
+# how calculate_one_to_many_tanimoto_oe scores a pair, part of the cache parameters
+OVERLAY_METHODS = {
+    True: "OEROCSOverlay",
+    False: "OEOverlapFunc.Overlap",
+}
 
 
 def parse_args():
@@ -32,99 +52,118 @@ def parse_args():
         required=False,
         help="Path to directory containing prepped query ligand sdf. If false, ref-ligand-sdf will be used.",
     )
+    parser.add_argument(
+        "--shape-prep",
+        type=Path,
+        required=False,
+        help="OEB file of the prepared reference molecules, written if missing or stale. If not given, the molecules are prepared in memory.",
+    )
+    parser.add_argument(
+        "--query-shape-prep",
+        type=Path,
+        required=False,
+        help="OEB file of the prepared query molecules, written if missing or stale.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        required=False,
+        help="SQLite file of the persistent similarity cache to read pairs from and add calculated pairs to.",
+    )
+    parser.add_argument(
+        "--write-csv",
+        action="store_true",
+        help="Also write the long-form CSV next to the similarity matrices.",
+    )
     return parser.parse_args()
 
 
 def calculate_one_to_many_tanimoto_oe(
     refmol: oechem.OEMol,
-    ref_name: str,
     fitmols: [oechem.OEMol],
-    fit_names: [str],
     align: bool = False,
 ):
     """
-    Calculate the Tanimoto coefficient between two molecules using OpenEye's shape toolkit.
+    Calculate the Tanimoto coefficient between a reference and a block of fit molecules using OpenEye's shape
+    toolkit.
 
     Parameters
     ----------
-    refmol : Ligand
-        The reference molecule to which the docked molecule is compared.
-    fitmol : Ligand
-        The docked molecule to be compared to the reference molecule.
+    refmol : oechem.OEMol
+        The reference molecule. Prepared with OEOverlapPrep, see shape_prep.py, if align is False.
+    fitmols : list of oechem.OEMol
+        The molecules to be compared to the reference molecule, prepared like the reference. They are not modified.
+    align : bool
+        Whether to find the best overlay of each fit molecule, or to score it in its current pose.
 
     Returns
     -------
-    float
-        The Tanimoto coefficient between the two molecules.
+    tuple of np.ndarray
+        The TanimotoCombo, shape Tanimoto and color Tanimoto between the reference and each fit molecule.
     """
-    similarity_array = []
+    combo, shape, color = [], [], []
 
     if align:
         # OEROCS aligns the molecules before calculating the Tanimoto coefficient
         res = oeshape.OEROCSResult()
-        for i, fitmol in enumerate(fitmols):
+        for fitmol in fitmols:
             oeshape.OEROCSOverlay(res, refmol, fitmol)
-            similarity_array.append(
-                TanimotoComboSimilarity.from_tanimoto_results(
-                    ref=ref_name, query=fit_names[i], results=res, aligned=True
-                )
-            )
-        return similarity_array
+            combo.append(res.GetTanimotoCombo())
+            shape.append(res.GetShapeTanimoto())
+            color.append(res.GetColorTanimoto())
 
     if not align:
-        # Prepare reference molecule for calculation
-        # With default options this will remove any explicit hydrogens present
-        prep = oeshape.OEOverlapPrep()
-        prep.Prep(refmol)
-
-        # Get appropriate function to calculate exact shape
+        # Get appropriate function to calculate exact shape, set up once for the whole block
         shapeFunc = oeshape.OEOverlapFunc()
         shapeFunc.SetupRef(refmol)
 
         res = oeshape.OEOverlapResults()
-        for i, fitmol in enumerate(fitmols):
-            prep.Prep(fitmol)
+        for fitmol in fitmols:
             shapeFunc.Overlap(fitmol, res)
-            similarity_array.append(
-                TanimotoComboSimilarity.from_tanimoto_results(
-                    ref=ref_name, query=fit_names[i], results=res, aligned=False
-                )
-            )
-        return similarity_array
+            combo.append(res.GetTanimotoCombo())
+            shape.append(res.GetShapeTanimoto())
+            color.append(res.GetColorTanimoto())
+
+    return (
+        np.array(combo, dtype=float),
+        np.array(shape, dtype=float),
+        np.array(color, dtype=float),
+    )
 
 
-def parallelize(ref: Ligand, queries: list[Ligand], logger):
+def parallelize(task: tuple, align: bool):
     """
-    Calculate the MCS between a reference ligand and a list of query ligands.
-    :param ref: Reference ligand
-    :param queries: List of query ligands
-    :return: Dataframe with MCS results
+    Calculate the aligned or non-aligned TanimotoCombo between one reference and query molecules held by the
+    worker.
+    :param task: (reference index, query indices)
+    :return: The task and the TanimotoCombo, shape and color Tanimoto arrays
     """
-    logger.info(f"Calculating MCS for {ref.compound_name}...")
-    refmol = ref.to_oemol()
-    query_mols = [query.to_oemol() for query in queries]
-    similarity_array_aligned = calculate_one_to_many_tanimoto_oe(
-        refmol,
-        ref.compound_name,
-        query_mols,
-        [query.compound_name for query in queries],
-        align=True,
+    ref_index, query_indices = task
+    refmol = get_reference(ref_index)
+    get_worker_logger().info(
+        f"Calculating TanimotoCombo for reference {ref_index} ({refmol.GetTitle()}) and {len(query_indices)} queries..."
     )
-    similarity_array_not_aligned = calculate_one_to_many_tanimoto_oe(
-        refmol,
-        ref.compound_name,
-        query_mols,
-        [query.compound_name for query in queries],
-        align=False,
-    )
-    df = pd.concat(
+    queries = get_queries()
+    fitmols = [queries[j] for j in query_indices]
+    return task, calculate_one_to_many_tanimoto_oe(refmol, fitmols, align=align)
+
+
+def get_similarity_dataframe(ref_name: str, query_names: list, scores: dict):
+    return pd.concat(
         [
-            TanimotoComboSimilarity.construct_dataframe(similarity_array_aligned),
-            TanimotoComboSimilarity.construct_dataframe(similarity_array_not_aligned),
+            TanimotoComboSimilarity.construct_dataframe_from_arrays(
+                Reference_Ligand=ref_name,
+                Query_Ligand=query_names,
+                # divided by 2 to get it in the same range as the others, as in TanimotoComboSimilarity.from_tanimoto_results
+                Tanimoto=combo / 2,
+                Tanimoto_Shape=shape,
+                Tanimoto_Color=color,
+                Aligned=align,
+            )
+            for align, (combo, shape, color) in scores.items()
         ],
         ignore_index=True,
     )
-    return df
 
 
 def main():
@@ -143,25 +182,130 @@ def main():
     queries = (
         MolFileFactory(filename=args.query_ligand_sdf).load()
         if args.query_ligand_sdf
-        else references.copy()
+        else references
     )
     logger.info(f"Loaded {len(references)} reference molecules.")
     logger.info(f"Loaded {len(queries)} query molecules.")
 
+    ref_mols = [ref.to_oemol() for ref in references]
+    query_mols = (
+        [query.to_oemol() for query in queries] if args.query_ligand_sdf else ref_mols
+    )
+    query_names = [query.compound_name for query in queries]
+    shape = (len(ref_mols), len(query_mols))
+    aligns = [True, False]
+    value_names = ["TanimotoCombo", "Tanimoto_Shape", "Tanimoto_Color"]
+    scores = {
+        align: {name: np.full(shape, np.nan) for name in value_names}
+        for align in aligns
+    }
+
+    cache = None
+    missing = {align: np.ones(shape, dtype=bool) for align in aligns}
+    if args.cache:
+        cache = SimilarityCache(args.cache)
+        ref_keys = [get_molecule_key(mol, with_coordinates=True) for mol in ref_mols]
+        query_keys = (
+            [get_molecule_key(mol, with_coordinates=True) for mol in query_mols]
+            if args.query_ligand_sdf
+            else ref_keys
+        )
+        cache_parameters = {
+            align: {
+                "aligned": align,
+                "method": OVERLAY_METHODS[align],
+                # OEROCSOverlay prepares the molecules with its own default options
+                "prep_settings": None if align else PREP_SETTINGS,
+                "oeshape_release": oeshape.OEShapeGetRelease(),
+            }
+            for align in aligns
+        }
+        for align in aligns:
+            status, values = cache.lookup(
+                "TanimotoCombo",
+                cache_parameters[align],
+                ref_keys,
+                query_keys,
+                value_names,
+            )
+            found = status == CALCULATED
+            for name in value_names:
+                scores[align][name][found] = values[name][found]
+            missing[align] = ~found
+            logger.info(
+                f"Found {found.sum()} of {found.size} {'aligned' if align else 'non-aligned'} pairs in the cache '{args.cache}'"
+            )
+
     logger.info("Calculating similarities...")
-    # Parallelize the MCS calculation
-    with mp.Pool(mp.cpu_count()) as pool:
-        results = pool.starmap(
-            parallelize, [(ref, queries, logger) for ref in references]
+    for align in aligns:
+        # Parallelize the TanimotoCombo calculation
+        tasks = [
+            (i, np.flatnonzero(missing[align][i]))
+            for i in np.flatnonzero(missing[align].any(axis=1))
+        ]
+        if not tasks:
+            continue
+        if align:
+            ref_inputs, query_inputs = ref_mols, query_mols
+        else:
+            logger.info("Preparing molecules for shape and color overlap...")
+            ref_inputs = (
+                ensure_shape_prep(args.shape_prep, ref_mols, logger)
+                if args.shape_prep
+                else prep_molecules(ref_mols)
+            )
+            if not args.query_ligand_sdf:
+                query_inputs = ref_inputs
+            elif args.query_shape_prep:
+                query_inputs = ensure_shape_prep(
+                    args.query_shape_prep, query_mols, logger
+                )
+            else:
+                query_inputs = prep_molecules(query_mols)
+        with MoleculePool(ref_inputs, query_inputs, mp.cpu_count(), logger) as pool:
+            for (ref_index, query_indices), task_values in pool.imap_unordered(
+                functools.partial(parallelize, align=align), tasks, chunksize=1
+            ):
+                for name, value in zip(value_names, task_values):
+                    scores[align][name][ref_index, query_indices] = value
+                if cache is not None:
+                    cache.store(
+                        "TanimotoCombo",
+                        cache_parameters[align],
+                        [(ref_keys[ref_index], query_keys[j]) for j in query_indices],
+                        dict(zip(value_names, task_values)),
+                    )
+    if cache is not None:
+        cache.close()
+    results = [
+        get_similarity_dataframe(
+            ref.compound_name,
+            query_names,
+            {
+                align: tuple(scores[align][name][i] for name in value_names)
+                for align in aligns
+            },
         )
-        results = [result for result in results if result is not None]
+        for i, ref in enumerate(references)
+    ]
 
     # Save results
     logger.info("Saving results...")
-    df = pd.concat(results, ignore_index=True)
-    output_path = output_dir / "tanimoto_combo.csv"
-    df.to_csv(output_path, index=False)
-    logger.info(f"Results saved to {output_path}")
+    matrices = SimilarityMatrices.from_row_dataframes(
+        results,
+        [ref.compound_name for ref in references],
+        query_names,
+        value_columns=["Tanimoto", "Tanimoto_Shape", "Tanimoto_Color"],
+        parameter_columns=["Aligned"],
+        metadata={"script": "calculate_tanimoto_combo.py"},
+    )
+    matrices.save(output_dir / MATRIX_DIRNAME)
+    logger.info(f"Similarity matrices saved to {output_dir / MATRIX_DIRNAME}")
+    if args.write_csv:
+        df = pd.concat(results, ignore_index=True)
+        output_path = output_dir / "tanimoto_combo.csv"
+        df.to_csv(output_path, index=False)
+        logger.info(f"Results saved to {output_path}")
 
 
 if __name__ == "__main__":
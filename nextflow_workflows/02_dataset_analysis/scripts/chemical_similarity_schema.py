@@ -1,6 +1,8 @@
 from pydantic import BaseModel, Field, confloat, root_validator, ValidationError
 from enum import Enum
+from typing import ClassVar
 import json
+import numpy as np
 import pandas as pd
 
 
@@ -16,6 +18,9 @@ class MoleculeSimilarity(BaseModel):
         ..., description="Tanimoto similarity from 0 to 1"
     )
 
+    # (lower, upper) bounds of the constrained float fields, checked by construct_dataframe_from_arrays
+    column_bounds: ClassVar[dict] = {"Tanimoto": (0, 1)}
+
     def save(self, path):
         with open(path, "w") as f:
             json.dump(self.dict(), f, indent=4)
@@ -34,6 +39,56 @@ class MoleculeSimilarity(BaseModel):
             [similarity.dict() for similarity in similarity_list]
         )
 
+    @classmethod
+    def validate_columns(cls, df: pd.DataFrame):
+        """
+        Check the bounds of the constrained columns of a whole dataframe at once.
+        """
+        for column, (lower, upper) in cls.column_bounds.items():
+            values = df[column].to_numpy(dtype=float)
+            invalid = ~((values >= lower) & (values <= upper))
+            if invalid.any():
+                row = int(np.flatnonzero(invalid)[0])
+                raise ValueError(
+                    f"{invalid.sum()} values of {column} are outside [{lower}, {upper}], "
+                    f"e.g. {values[row]} for {df.Reference_Ligand.iloc[row]} and {df.Query_Ligand.iloc[row]}"
+                )
+
+    @classmethod
+    def construct_dataframe_from_arrays(cls, **columns) -> pd.DataFrame:
+        """
+        Columnar equivalent of construct_dataframe, without building one model per pair.
+        Each column is given as an array with one value per pair or as a single value shared by all pairs.
+        Columns that aren't given take the default of their field.
+        :param columns: Columns named after the fields of the model
+        :return: Dataframe with the same columns and values as construct_dataframe
+        """
+        # model_fields and FieldInfo.is_required in pydantic 2, __fields__ and ModelField.required in pydantic 1
+        fields = getattr(cls, "model_fields", None) or cls.__fields__
+        unknown = set(columns) - set(fields)
+        if unknown:
+            raise ValueError(f"Unknown columns for {cls.__name__}: {sorted(unknown)}")
+        lengths = {len(value) for value in columns.values() if np.ndim(value) > 0}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        n_rows = lengths.pop() if lengths else 1
+
+        data = {}
+        for name, field in fields.items():
+            if name in columns:
+                data[name] = columns[name]
+            elif (
+                field.is_required() if hasattr(field, "is_required") else field.required
+            ):
+                raise ValueError(f"Missing required column {name} for {cls.__name__}")
+            elif hasattr(field, "is_required"):
+                data[name] = field.get_default(call_default_factory=True)
+            else:
+                data[name] = field.get_default()
+        df = pd.DataFrame(data, index=pd.RangeIndex(n_rows))
+        cls.validate_columns(df)
+        return df
+
 
 class ECFPSimilarity(MoleculeSimilarity):
     """
@@ -54,6 +109,14 @@ class ECFPSimilarity(MoleculeSimilarity):
         return_dict.update({"fingerprint": self.Fingerprint})
         return return_dict
 
+    @classmethod
+    def construct_dataframe_from_arrays(cls, **columns) -> pd.DataFrame:
+        df = super().construct_dataframe_from_arrays(**columns)
+        df["fingerprint"] = (
+            "ECFP" + (df.radius * 2).astype(str) + "_" + df.bitsize.astype(str)
+        )
+        return df
+
 
 class MCSSimilarity(MoleculeSimilarity):
     """
@@ -78,6 +141,18 @@ class MCSSimilarity(MoleculeSimilarity):
             ), f"Tanimoto {values['tanimoto']} does not match expected value {expected_tanimoto}"
         return values
 
+    @classmethod
+    def validate_columns(cls, df: pd.DataFrame):
+        super().validate_columns(df)
+        expected = df.N_Atoms_in_MCS.to_numpy() / df.N_Atoms_in_Union.to_numpy()
+        mismatch = np.abs(df.Tanimoto.to_numpy() - expected) >= 0.0001
+        if mismatch.any():
+            row = int(np.flatnonzero(mismatch)[0])
+            raise ValueError(
+                f"{mismatch.sum()} Tanimoto values don't match N_Atoms_in_MCS / N_Atoms_in_Union, "
+                f"e.g. {df.Tanimoto.iloc[row]} instead of {expected[row]}"
+            )
+
 
 class TanimotoComboType(str, Enum):
     """
@@ -99,6 +174,12 @@ class TanimotoComboSimilarity(MoleculeSimilarity):
     Tanimoto_Color: confloat(ge=0, le=1) = Field(..., description="Color Tanimoto")
     Aligned: bool = False
 
+    column_bounds: ClassVar[dict] = {
+        "Tanimoto": (0, 1),
+        "Tanimoto_Shape": (0, 1),
+        "Tanimoto_Color": (0, 1),
+    }
+
     @classmethod
     def from_tanimoto_results(
         cls, ref, query, results, aligned: bool
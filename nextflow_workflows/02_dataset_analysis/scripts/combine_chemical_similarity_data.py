@@ -5,6 +5,7 @@ Takes the previously calculated chemical similarity data and outputs a CSV file
 import pandas as pd
 import argparse
 from pathlib import Path
+from similarity_matrix import load_similarity_data
 
 
 def parse_args():
@@ -12,7 +13,7 @@ def parse_args():
         description="Combine all relevant data for analysis"
     )
 
-    # add any number of csv files
+    # add any number of csv files or directories of similarity matrices
     parser.add_argument("csvs", nargs="+")
     parser.add_argument("--output-dir", type=Path, required=False, default="./")
     return parser.parse_args()
@@ -24,7 +25,7 @@ def main():
     output_dir.mkdir(exist_ok=True, parents=True)
     dfs = []
     for csv in args.csvs:
-        dfs.append(pd.read_csv(csv))
+        dfs.append(load_similarity_data(csv))
     df = pd.concat(dfs)
     df.to_csv(output_dir / "combined_chemical_similarity_data.csv", index=False)
 
@@ -0,0 +1,396 @@
+"""
+Persistent store of unfolded circular fingerprints keyed by canonical isomeric SMILES.
+
+For every molecule the store keeps the features of each radius separately, as bit positions of a fingerprint of
+UNFOLDED_BITS bits. The ECFP fingerprint of radius r and any smaller power-of-two bit size is the union of the
+features of radius 0 to r, folded modulo the bit size, so every (radius, bit size) combination is derived from one
+perception of the molecule. `verify_folding` checks this against freshly generated fingerprints.
+
+The features of each radius are stored in CSR form as two .npy files, the concatenated features and the offsets
+of each molecule, which are memory-mapped when the store is opened so that several jobs can share one store.
+Updates are written to a new generation directory that replaces the previous one by an atomic rename of
+current.json, under an exclusive file lock. Readers take a shared lock while opening the store. A store perceived
+with other settings, e.g. by another OEGraphSim release, is rebuilt rather than extended.
+
+Example usage:
+python fingerprint_store.py --ligand-sdf combined_3d.sdf --store-dir fingerprint_store
+"""
+
+import argparse
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from fingerprint_tanimoto import pack_bit_coordinates
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+UNFOLDED_BITS = 65536
+MAX_RADIUS = 5
+CURRENT_FILENAME = "current.json"
+INDEX_FILENAME = "index.csv"
+
+
+def get_settings(max_radius: int = MAX_RADIUS) -> dict:
+    from openeye import oegraphsim
+
+    return {
+        "unfolded_bits": UNFOLDED_BITS,
+        "max_radius": max_radius,
+        "atom_type": oegraphsim.OEFPAtomType_DefaultCircularAtom,
+        "bond_type": oegraphsim.OEFPBondType_DefaultCircularBond,
+        "graphsim_release": oegraphsim.OEGraphSimGetRelease(),
+    }
+
+
+def get_smiles(mol) -> str:
+    from openeye import oechem
+
+    return oechem.OECreateIsoSmiString(mol)
+
+
+def get_radius_features(mol, radius: int, settings: dict) -> np.ndarray:
+    """
+    Get the features of exactly one radius of a molecule, as bit positions of an unfolded fingerprint.
+    """
+    from openeye import oegraphsim
+
+    fp = oegraphsim.OEFingerPrint()
+    oegraphsim.OEMakeCircularFP(
+        fp,
+        mol,
+        settings["unfolded_bits"],
+        radius,
+        radius,
+        settings["atom_type"],
+        settings["bond_type"],
+    )
+    features = []
+    bit = fp.FirstBit()
+    while bit >= 0:
+        features.append(bit)
+        bit = fp.NextBit(bit)
+    return np.array(features, dtype=np.uint32)
+
+
+def is_compatible(stored: dict, settings: dict) -> bool:
+    """
+    Check that a store perceived with the stored settings can serve fingerprints of the given settings.
+    A store with a larger max_radius is compatible, any other difference, e.g. the OEGraphSim release, is not.
+    """
+    return stored["max_radius"] >= settings["max_radius"] and {
+        key: value for key, value in stored.items() if key != "max_radius"
+    } == {key: value for key, value in settings.items() if key != "max_radius"}
+
+
+def _lock(store_dir: Path, exclusive: bool):
+    store_dir.mkdir(parents=True, exist_ok=True)
+    lock = open(store_dir / ".lock", "w")
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return lock
+
+
+class FingerprintStore:
+    """
+    Unfolded circular fingerprints of a set of molecules, folded to any bit size on demand.
+    """
+
+    def __init__(self, smiles: list, offsets: list, features: list, settings: dict):
+        """
+        :param smiles: Canonical isomeric SMILES of the molecules, in row order
+        :param offsets: Per radius, array of n_molecules + 1 offsets into the features of that radius
+        :param features: Per radius, array of the concatenated features of all molecules
+        :param settings: Fingerprint settings, as returned by get_settings
+        """
+        self.smiles = list(smiles)
+        self.offsets = offsets
+        self.features = features
+        self.settings = settings
+        self._rows = {smi: row for row, smi in enumerate(self.smiles)}
+
+    def __len__(self):
+        return len(self.smiles)
+
+    def __contains__(self, smiles: str):
+        return smiles in self._rows
+
+    @property
+    def max_radius(self) -> int:
+        return self.settings["max_radius"]
+
+    @classmethod
+    def from_molecules(cls, mols: list, max_radius: int = MAX_RADIUS):
+        """
+        Perceive the fingerprints of a list of OEMols, skipping duplicate SMILES.
+        """
+        settings = get_settings(max_radius)
+        unique = {}
+        for mol in mols:
+            unique.setdefault(get_smiles(mol), mol)
+        offsets, features = [], []
+        for radius in range(max_radius + 1):
+            radius_features = [
+                get_radius_features(mol, radius, settings) for mol in unique.values()
+            ]
+            offsets.append(
+                np.concatenate(
+                    [[0], np.cumsum([len(f) for f in radius_features])]
+                ).astype(np.int64)
+            )
+            features.append(
+                np.concatenate(radius_features)
+                if radius_features
+                else np.zeros(0, dtype=np.uint32)
+            )
+        return cls(list(unique), offsets, features, settings)
+
+    @classmethod
+    def load(cls, store_dir: Path, mmap_mode: str = "r"):
+        """
+        Open the current generation of a store, memory-mapping the features.
+        """
+        with _lock(Path(store_dir), exclusive=False):
+            return cls._load(Path(store_dir), mmap_mode)
+
+    @classmethod
+    def _load(cls, store_dir: Path, mmap_mode: str = "r"):
+        with open(store_dir / CURRENT_FILENAME, "r") as f:
+            current = json.load(f)
+        generation = store_dir / current["generation"]
+        smiles = pd.read_csv(
+            generation / INDEX_FILENAME, keep_default_na=False
+        ).SMILES.tolist()
+        # mapped files stay readable after a later update removes them
+        offsets, features = [], []
+        for radius in range(current["settings"]["max_radius"] + 1):
+            offsets.append(
+                np.load(generation / f"radius_{radius}_offsets.npy", mmap_mode)
+            )
+            features.append(
+                np.load(generation / f"radius_{radius}_features.npy", mmap_mode)
+            )
+        return cls(smiles, offsets, features, current["settings"])
+
+    def save(self, store_dir: Path):
+        """
+        Write the store as a new generation of store_dir and make it the current one.
+        The caller is expected to hold the exclusive lock of store_dir.
+        """
+        store_dir = Path(store_dir)
+        name = f"generation-{uuid.uuid4().hex}"
+        generation = store_dir / name
+        generation.mkdir(parents=True)
+        pd.DataFrame({"SMILES": self.smiles}).to_csv(
+            generation / INDEX_FILENAME, index=False
+        )
+        for radius in range(self.max_radius + 1):
+            np.save(generation / f"radius_{radius}_offsets.npy", self.offsets[radius])
+            np.save(generation / f"radius_{radius}_features.npy", self.features[radius])
+        tmp = store_dir / f".{CURRENT_FILENAME}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump({"generation": name, "settings": self.settings}, f, indent=4)
+        os.replace(tmp, store_dir / CURRENT_FILENAME)
+        for old in store_dir.glob("generation-*"):
+            if old.name != name:
+                shutil.rmtree(old, ignore_errors=True)
+
+    def merge(self, other: "FingerprintStore") -> "FingerprintStore":
+        """
+        Append the molecules of another store that aren't in this one.
+        """
+        if other.settings != self.settings:
+            raise ValueError(
+                f"Fingerprint settings differ: {self.settings} and {other.settings}"
+            )
+        new = np.array([smi not in self for smi in other.smiles], dtype=bool)
+        rows = np.flatnonzero(new)
+        offsets, features = [], []
+        for radius in range(self.max_radius + 1):
+            added = [other.get_features(row, radius, radius) for row in rows]
+            offsets.append(
+                np.concatenate(
+                    [
+                        self.offsets[radius],
+                        self.offsets[radius][-1]
+                        + np.cumsum([len(f) for f in added], dtype=np.int64),
+                    ]
+                )
+            )
+            features.append(
+                np.concatenate(
+                    [self.features[radius], *added],
+                ).astype(np.uint32)
+            )
+        smiles = self.smiles + [other.smiles[row] for row in rows]
+        return FingerprintStore(smiles, offsets, features, self.settings)
+
+    def get_features(self, row: int, radius: int, min_radius: int = 0) -> np.ndarray:
+        """
+        Get the unfolded features of radius min_radius to radius of one molecule.
+        """
+        return np.concatenate(
+            [
+                self.features[r][self.offsets[r][row] : self.offsets[r][row + 1]]
+                for r in range(min_radius, radius + 1)
+            ]
+        )
+
+    def get_rows(self, smiles: list) -> np.ndarray:
+        missing = [smi for smi in smiles if smi not in self]
+        if missing:
+            raise KeyError(
+                f"{len(missing)} molecules aren't in the store: {missing[:5]}"
+            )
+        return np.array([self._rows[smi] for smi in smiles], dtype=np.int64)
+
+    def fold(self, smiles: list, radius: int, bit_size: int) -> np.ndarray:
+        """
+        Get the packed ECFP fingerprints of a list of molecules.
+        :param smiles: Canonical isomeric SMILES of the molecules, as returned by get_smiles
+        :param radius: Fingerprint radius, at most max_radius
+        :param bit_size: Fingerprint size, a power of two of at most UNFOLDED_BITS
+        :return: Packed fingerprints in the order of smiles, see fingerprint_tanimoto.pack_fingerprints
+        """
+        if radius > self.max_radius:
+            raise ValueError(
+                f"Radius {radius} is larger than the largest stored radius {self.max_radius}"
+            )
+        if bit_size & (bit_size - 1) or self.settings["unfolded_bits"] % bit_size:
+            raise ValueError(
+                f"Bit size {bit_size} must be a power of two that divides {self.settings['unfolded_bits']}"
+            )
+        rows = self.get_rows(smiles)
+        all_rows, all_bits = [], []
+        for r in range(radius + 1):
+            starts = np.asarray(self.offsets[r])[rows]
+            lengths = np.asarray(self.offsets[r])[rows + 1] - starts
+            # positions of the features of every requested molecule in the concatenated features
+            positions = np.arange(lengths.sum()) + np.repeat(
+                starts - (np.cumsum(lengths) - lengths), lengths
+            )
+            all_rows.append(np.repeat(np.arange(len(rows)), lengths))
+            all_bits.append(np.asarray(self.features[r])[positions] % bit_size)
+        return pack_bit_coordinates(
+            np.concatenate(all_rows), np.concatenate(all_bits), len(rows), bit_size
+        )
+
+
+def ensure_fingerprint_store(
+    store_dir: Path, mols: list, max_radius: int = MAX_RADIUS, logger=None
+) -> FingerprintStore:
+    """
+    Add the molecules that aren't in the store yet and open it.
+    A store perceived with other settings, e.g. an older OEGraphSim release or a smaller radius, is rebuilt from
+    mols, since its features can't be mixed with newly perceived ones.
+    :param store_dir: Store directory, created if it doesn't exist
+    :param mols: OEMols that need to be in the store
+    :param max_radius: Largest radius the store needs to hold
+    :return: The opened store
+    """
+    store_dir = Path(store_dir)
+    settings = get_settings(max_radius)
+    if (store_dir / CURRENT_FILENAME).exists():
+        store = FingerprintStore.load(store_dir)
+        if is_compatible(store.settings, settings) and all(
+            get_smiles(mol) in store for mol in mols
+        ):
+            return store
+
+    with _lock(store_dir, exclusive=True):
+        # another job may have updated the store while we were waiting for the lock
+        store = (
+            FingerprintStore._load(store_dir)
+            if (store_dir / CURRENT_FILENAME).exists()
+            else None
+        )
+        if store is not None and not is_compatible(store.settings, settings):
+            if logger:
+                logger.warning(
+                    f"Rebuilding the fingerprint store in '{store_dir}', its settings {store.settings} "
+                    f"don't match {settings}"
+                )
+            store = None
+        missing = [mol for mol in mols if store is None or get_smiles(mol) not in store]
+        if missing:
+            added = FingerprintStore.from_molecules(
+                missing, store.max_radius if store is not None else max_radius
+            )
+            if logger:
+                logger.info(
+                    f"Adding {len(added)} molecules to the fingerprint store in '{store_dir}'"
+                )
+            store = added if store is None else store.merge(added)
+            store.save(store_dir)
+            return store
+    return FingerprintStore.load(store_dir)
+
+
+def verify_folding(
+    store: FingerprintStore, mols: list, radius: int, bit_size: int
+) -> bool:
+    """
+    Check that the folded fingerprints of molecules are the ones OEMakeCircularFP generates at that bit size.
+    """
+    from openeye import oegraphsim
+
+    folded = np.unpackbits(
+        store.fold([get_smiles(mol) for mol in mols], radius, bit_size).view(np.uint8),
+        axis=1,
+    )
+    for mol, bits in zip(mols, folded):
+        fp = oegraphsim.OEFingerPrint()
+        oegraphsim.OEMakeCircularFP(
+            fp,
+            mol,
+            bit_size,
+            0,
+            radius,
+            store.settings["atom_type"],
+            store.settings["bond_type"],
+        )
+        expected = [i for i in range(bit_size) if fp.IsBitOn(i)]
+        if not np.array_equal(np.flatnonzero(bits), expected):
+            return False
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Add the circular fingerprints of the ligands in an SDF file to a fingerprint store"
+    )
+    parser.add_argument(
+        "--ligand-sdf", type=Path, required=True, help="Path to ligand sdf."
+    )
+    parser.add_argument(
+        "--store-dir", type=Path, required=True, help="Path to the store directory"
+    )
+    parser.add_argument(
+        "--max-radius",
+        type=int,
+        default=MAX_RADIUS,
+        help="Largest radius to store, if the store is new.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    from asapdiscovery.data.readers.molfile import MolFileFactory
+
+    args = parse_args()
+    ligands = MolFileFactory(filename=args.ligand_sdf).load()
+    store = ensure_fingerprint_store(
+        args.store_dir, [ligand.to_oemol() for ligand in ligands], args.max_radius
+    )
+    print(f"Fingerprint store '{args.store_dir}' holds {len(store)} molecules")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Vectorized all-pairs Tanimoto similarity of binary fingerprints.
+
+Fingerprints are packed into uint64 matrices with one row per molecule, so the intersection of two fingerprints is
+a bitwise AND of a few dozen words and its size a popcount. The reference x query matrix is computed in blocks of
+rows and columns, which bounds the size of the intermediate arrays, and the row blocks are spread over threads.
+NumPy releases the GIL inside the ufuncs, so the threads run in parallel.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+WORD_BITS = 64
+
+# number of set bits in every byte, used when np.bitwise_count isn't available (numpy < 2.0)
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Number of set bits in every uint64 word.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    counts = _BYTE_POPCOUNT[words.view(np.uint8)]
+    return counts.reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_bit_coordinates(
+    rows: np.ndarray, bits: np.ndarray, n_molecules: int, bit_size: int
+) -> np.ndarray:
+    """
+    Pack fingerprints given as (molecule, bit position) pairs into a uint64 matrix.
+    :param rows: Molecule of every set bit
+    :param bits: Position of every set bit
+    :param n_molecules: Number of rows of the matrix
+    :param bit_size: Size of the fingerprints, a multiple of 64
+    :return: Array of shape (n_molecules, bit_size // 64)
+    """
+    if bit_size % WORD_BITS:
+        raise ValueError(f"Bit size {bit_size} is not a multiple of {WORD_BITS}")
+    dense = np.zeros((n_molecules, bit_size), dtype=bool)
+    dense[rows, bits] = True
+    # packbits is big-endian within each byte, which doesn't matter as long as all fingerprints are packed alike
+    return np.packbits(dense, axis=1).view(np.uint64)
+
+
+def pack_fingerprints(bit_lists: list, bit_size: int) -> np.ndarray:
+    """
+    Pack fingerprints given as arrays of set bit positions into a uint64 matrix.
+    :param bit_lists: One array of set bit positions per molecule
+    :param bit_size: Size of the fingerprints, a multiple of 64
+    :return: Array of shape (n_molecules, bit_size // 64)
+    """
+    bit_lists = [np.asarray(on_bits, dtype=np.int64) for on_bits in bit_lists]
+    rows = np.repeat(np.arange(len(bit_lists)), [len(b) for b in bit_lists])
+    bits = np.concatenate(bit_lists) if bit_lists else np.zeros(0, dtype=np.int64)
+    return pack_bit_coordinates(rows, bits, len(bit_lists), bit_size)
+
+
+def count_bits(packed: np.ndarray) -> np.ndarray:
+    return popcount(packed).sum(axis=1, dtype=np.int64)
+
+
+def _tanimoto_block(
+    ref: np.ndarray,
+    query: np.ndarray,
+    ref_counts: np.ndarray,
+    query_counts: np.ndarray,
+    out: np.ndarray,
+    column_block: int,
+):
+    for start in range(0, len(query), column_block):
+        stop = min(start + column_block, len(query))
+        intersection = popcount(ref[:, None, :] & query[None, start:stop, :]).sum(
+            axis=2, dtype=np.int64
+        )
+        union = ref_counts[:, None] + query_counts[None, start:stop] - intersection
+        # two empty fingerprints have no similarity
+        np.divide(
+            intersection,
+            union,
+            out=out[:, start:stop],
+            where=union > 0,
+        )
+
+
+def tanimoto_matrix(
+    ref: np.ndarray,
+    query: np.ndarray,
+    n_threads: int = 1,
+    block_size: int = 128,
+    dtype=np.float64,
+) -> np.ndarray:
+    """
+    Tanimoto similarity between every pair of packed reference and query fingerprints.
+    :param ref: Packed reference fingerprints, as returned by pack_fingerprints
+    :param query: Packed query fingerprints of the same bit size
+    :param n_threads: Number of threads to spread the row blocks over
+    :param block_size: Number of rows and columns in each block
+    :param dtype: Floating point type of the result
+    :return: Array of shape (n_ref, n_query)
+    """
+    if ref.shape[1] != query.shape[1]:
+        raise ValueError(
+            f"Fingerprint sizes differ: {ref.shape[1] * WORD_BITS} and {query.shape[1] * WORD_BITS} bits"
+        )
+    ref_counts = count_bits(ref)
+    query_counts = count_bits(query)
+    similarity = np.zeros((len(ref), len(query)), dtype=dtype)
+
+    def run(start):
+        stop = min(start + block_size, len(ref))
+        _tanimoto_block(
+            ref[start:stop],
+            query,
+            ref_counts[start:stop],
+            query_counts,
+            similarity[start:stop],
+            block_size,
+        )
+
+    starts = range(0, len(ref), block_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            # consume the iterator so that exceptions from the threads are raised here
+            list(executor.map(run, starts))
+    else:
+        for start in starts:
+            run(start)
+    return similarity
@@ -5,9 +5,12 @@ This script generates a dictionary of dates for the Fragalysis project.
 from pathlib import Path
 import argparse
 from asapdiscovery.data.util.logging import FileLogger
-from datetime import datetime
-import pandas as pd
 import json
+from fragalysis_metadata import (
+    get_date_dict,
+    get_structure_to_cmpd_dict,
+    load_metadata_table,
+)
 
 
 def get_args():
@@ -25,34 +28,15 @@ def get_args():
         type=Path,
         help="Path to output directory.",
     )
+    parser.add_argument(
+        "--metadata-cache",
+        default=None,
+        type=Path,
+        help="Directory to cache the parsed Fragalysis metadata in.",
+    )
     return parser.parse_args()
 
 
-def date_processor(date_string):
-    if type(date_string) == str and not date_string == "None":
-        try:
-            return datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return datetime.strptime(date_string, "%d/%m/%Y %H:%M")
-    else:
-        return None
-
-
-def process_crystal_data(soaks):
-    ddf = soaks.loc[:, ["Sample Name", "Data Collection Date"]]
-    ddf["Sanitized_Date"] = ddf["Data Collection Date"].apply(date_processor)
-    ddf.columns = ["Structure_Name", "Data_Collection_Date", "Structure_Date"]
-    date_dict = ddf.set_index("Structure_Name").to_dict()["Structure_Date"]
-    date_dict = {k: str(v) for k, v in date_dict.items() if str(v) != "NaT"}
-    structure_to_cmpd_dict = {
-        row["Sample Name"]: row["Compound ID"]
-        for idx, row in soaks.iterrows()
-        if row["Sample Name"] in date_dict
-    }
-
-    return date_dict, structure_to_cmpd_dict
-
-
 def main():
     args = get_args()
     fragalysis_dir = args.fragalysis_dir
@@ -64,15 +48,15 @@ def main():
     if not fragalysis_dir.exists():
         raise FileNotFoundError(f"Fragalysis directory {fragalysis_dir} not found")
 
-    # load soaks first
-    soaks_path = fragalysis_dir / "extra_files" / "Mpro_soaks.csv"
-    soaks = pd.read_csv(soaks_path)
-    date_dict, structure_to_cmpd_dict = process_crystal_data(soaks)
+    metadata = load_metadata_table(fragalysis_dir, args.metadata_cache, logger=logger)
+
+    # soaks first
+    date_dict = get_date_dict(metadata, "soak")
+    structure_to_cmpd_dict = get_structure_to_cmpd_dict(metadata, "soak")
 
-    # now load the rest of the data
-    cocrystals_path = fragalysis_dir / "extra_files" / "Mpro_cocrystallisation.csv"
-    cocrystals = pd.read_csv(cocrystals_path)
-    co_date_dict, co_structure_to_cmpd_dict = process_crystal_data(cocrystals)
+    # now the rest of the data
+    co_date_dict = get_date_dict(metadata, "cocrystal")
+    co_structure_to_cmpd_dict = get_structure_to_cmpd_dict(metadata, "cocrystal")
 
     # confirm no overlap between the two structure datasets
     overlap = set(date_dict.keys()).intersection(set(co_date_dict.keys()))
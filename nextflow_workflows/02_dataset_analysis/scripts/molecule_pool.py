@@ -0,0 +1,122 @@
+"""
+Process pool helpers for one-reference-against-all-queries similarity calculations.
+
+The reference and query molecules are written once to OEB files, and each worker reads them into OEMols in its
+initializer, so tasks only carry the index of a reference and return arrays of scores. Workers log through a
+queue to a listener in the main process, which writes to the main process' log handlers.
+
+Example usage:
+with MoleculePool(ref_mols, query_mols, n_workers, logger) as pool:
+    results = pool.map(calculate_one_to_many, range(len(ref_mols)))
+
+where calculate_one_to_many reads `get_reference(i)`, `get_queries()` and `get_worker_logger()`.
+"""
+
+import logging
+import logging.handlers
+import multiprocessing as mp
+import tempfile
+from pathlib import Path
+
+_worker = {}
+
+
+def write_molecules(mols: list, path: Path):
+    from openeye import oechem
+
+    ofs = oechem.oemolostream(str(path))
+    for mol in mols:
+        oechem.OEWriteMolecule(ofs, mol)
+    ofs.close()
+
+
+def read_molecules(path: Path) -> list:
+    from openeye import oechem
+
+    ifs = oechem.oemolistream(str(path))
+    # GetOEMols reuses the same molecule, so keep copies
+    mols = [oechem.OEMol(mol) for mol in ifs.GetOEMols()]
+    ifs.close()
+    return mols
+
+
+def init_worker(reference_path: Path, query_path: Path, log_queue, logger_name: str):
+    _worker["references"] = read_molecules(reference_path)
+    _worker["queries"] = (
+        read_molecules(query_path)
+        if query_path != reference_path
+        else _worker["references"]
+    )
+    logger = logging.getLogger(f"{logger_name}.worker")
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    _worker["logger"] = logger
+
+
+def get_reference(index: int):
+    """
+    A copy of one reference molecule, which can be modified by the task.
+    """
+    from openeye import oechem
+
+    return oechem.OEMol(_worker["references"][index])
+
+
+def get_queries() -> list:
+    """
+    The query molecules cached in this worker. Tasks that modify them must work on copies.
+    """
+    return _worker["queries"]
+
+
+def get_worker_logger() -> logging.Logger:
+    return _worker["logger"]
+
+
+class MoleculePool:
+    """
+    Process pool whose workers hold the reference and query molecules.
+    """
+
+    def __init__(self, references: list, queries: list, n_workers: int, logger):
+        """
+        :param references: Reference OEMols
+        :param queries: Query OEMols, or the references themselves
+        :param n_workers: Number of worker processes
+        :param logger: Logger of the main process, whose handlers receive the workers' records
+        """
+        self.references = references
+        self.queries = queries
+        self.n_workers = n_workers
+        self.logger = logger
+
+    def __enter__(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        reference_path = Path(self._tmpdir.name) / "references.oeb"
+        write_molecules(self.references, reference_path)
+        query_path = reference_path
+        if self.queries is not self.references:
+            query_path = Path(self._tmpdir.name) / "queries.oeb"
+            write_molecules(self.queries, query_path)
+
+        self._log_queue = mp.Queue()
+        self._listener = logging.handlers.QueueListener(
+            self._log_queue, *self.logger.handlers, respect_handler_level=True
+        )
+        self._listener.start()
+        self._pool = mp.Pool(
+            self.n_workers,
+            initializer=init_worker,
+            initargs=(reference_path, query_path, self._log_queue, self.logger.name),
+        )
+        return self._pool
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+        self._listener.stop()
+        self._tmpdir.cleanup()
@@ -0,0 +1,164 @@
+"""
+Shape and color models of a ligand file, prepared once and kept next to it.
+
+OEOverlapPrep removes the hydrogens of a molecule and adds the color atoms of its pharmacophore features. Every
+TanimotoCombo calculation needs the prepared molecules, so they are written once to an OEB file next to the ligand
+file, e.g. combined_3d.sdf.shape_prep.oeb, which keeps the color atoms. A json header next to it records a hash of
+the input molecules, including their coordinates, the prep settings and the OEShape release, so a stale file is
+rebuilt rather than used. The OEB file is replaced before the header, so a reader never pairs a new header with an
+old file.
+
+Example usage:
+python shape_prep.py --ligand-sdf combined_3d.sdf
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from molecule_pool import read_molecules, write_molecules
+from similarity_cache import get_molecule_key
+
+SHAPE_PREP_SUFFIX = ".shape_prep.oeb"
+HEADER_SUFFIX = ".json"
+# what prep_molecules does to the molecules, so that files and cached scores from another prep aren't reused
+PREP_SETTINGS = {
+    "prep": "OEOverlapPrep",
+    "remove_hydrogens": True,
+    "assign_color": True,
+}
+
+
+def get_shape_prep_path(ligand_path: Path) -> Path:
+    ligand_path = Path(ligand_path)
+    return ligand_path.with_name(ligand_path.name + SHAPE_PREP_SUFFIX)
+
+
+def get_header_path(shape_prep_path: Path) -> Path:
+    shape_prep_path = Path(shape_prep_path)
+    return shape_prep_path.with_name(shape_prep_path.name + HEADER_SUFFIX)
+
+
+def get_input_hash(mols: list) -> str:
+    """
+    Hash the SMILES and coordinates of the molecules, in order.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [get_molecule_key(mol, with_coordinates=True) for mol in mols]
+        ).encode()
+    ).hexdigest()
+
+
+def prep_molecules(mols: list) -> list:
+    """
+    Prepare copies of the molecules for shape and color overlap.
+    """
+    from openeye import oechem, oeshape
+
+    prep = oeshape.OEOverlapPrep()
+    prepped = []
+    for mol in mols:
+        mol = oechem.OEMol(mol)
+        prep.Prep(mol)
+        prepped.append(mol)
+    return prepped
+
+
+def load_shape_prep(shape_prep_path: Path, mols: list):
+    """
+    Read the prepared molecules if the file was made from these molecules by this OEShape release.
+    :return: The prepared molecules in the order of mols, or None if the file is missing or stale
+    """
+    from openeye import oeshape
+
+    shape_prep_path = Path(shape_prep_path)
+    header_path = get_header_path(shape_prep_path)
+    if not (shape_prep_path.exists() and header_path.exists()):
+        return None
+    with open(header_path, "r") as f:
+        header = json.load(f)
+    if (
+        header["oeshape_release"] != oeshape.OEShapeGetRelease()
+        or header.get("prep_settings") != PREP_SETTINGS
+        or header["n_molecules"] != len(mols)
+        or header["input_hash"] != get_input_hash(mols)
+    ):
+        return None
+    prepped = read_molecules(shape_prep_path)
+    if len(prepped) != len(mols):
+        return None
+    return prepped
+
+
+def ensure_shape_prep(shape_prep_path: Path, mols: list, logger=None) -> list:
+    """
+    Read the prepared molecules, preparing and writing them first if the file is missing or stale.
+    :param shape_prep_path: OEB file of the prepared molecules, see get_shape_prep_path
+    :param mols: OEMols in the order of the ligand file
+    :return: The prepared molecules in the order of mols
+    """
+    from openeye import oeshape
+
+    shape_prep_path = Path(shape_prep_path)
+    prepped = load_shape_prep(shape_prep_path, mols)
+    if prepped is not None:
+        return prepped
+
+    if logger:
+        logger.info(f"Preparing {len(mols)} molecules for '{shape_prep_path}'")
+    prepped = prep_molecules(mols)
+    shape_prep_path.parent.mkdir(parents=True, exist_ok=True)
+    # the extension sets the format, so the temporary file still ends in .oeb
+    tmp_path = shape_prep_path.with_name(f"{shape_prep_path.stem}.{os.getpid()}.oeb")
+    write_molecules(prepped, tmp_path)
+    os.replace(tmp_path, shape_prep_path)
+    header_path = get_header_path(shape_prep_path)
+    tmp_header_path = header_path.with_name(f"{header_path.name}.{os.getpid()}")
+    with open(tmp_header_path, "w") as f:
+        json.dump(
+            {
+                "oeshape_release": oeshape.OEShapeGetRelease(),
+                "prep_settings": PREP_SETTINGS,
+                "n_molecules": len(mols),
+                "input_hash": get_input_hash(mols),
+            },
+            f,
+            indent=4,
+        )
+    os.replace(tmp_header_path, header_path)
+    return prepped
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Prepare the shape and color models of the ligands in an SDF file"
+    )
+    parser.add_argument(
+        "--ligand-sdf", type=Path, required=True, help="Path to ligand sdf."
+    )
+    parser.add_argument(
+        "--shape-prep",
+        type=Path,
+        required=False,
+        help="Path to the OEB file of prepared molecules. Defaults to the ligand sdf path with .shape_prep.oeb appended.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    from asapdiscovery.data.readers.molfile import MolFileFactory
+
+    args = parse_args()
+    shape_prep_path = args.shape_prep or get_shape_prep_path(args.ligand_sdf)
+    ligands = MolFileFactory(filename=args.ligand_sdf).load()
+    prepped = ensure_shape_prep(
+        shape_prep_path, [ligand.to_oemol() for ligand in ligands]
+    )
+    print(f"'{shape_prep_path}' holds {len(prepped)} prepared molecules")
+
+
+if __name__ == "__main__":
+    main()
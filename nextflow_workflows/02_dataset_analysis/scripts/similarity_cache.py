@@ -0,0 +1,190 @@
+"""
+Persistent cache of pairwise similarities, kept between dataset refreshes.
+
+Every pair is one row of an SQLite table keyed by the metric, its parameters, and the two molecules, which are
+identified by canonical isomeric SMILES with any explicit hydrogens, plus a hash of the coordinates for 3D metrics
+such as TanimotoCombo. The parameters are stored as sorted json, so they should include anything that changes the
+values, e.g. the toolkit release. A pair can also be stored as timed out together with the timeout it was given, so
+that a search that was given up on isn't tried again unless it is now given longer.
+
+Reads of a whole reference x query matrix are a single join of temporary tables of the reference and query keys
+against the cache, and writes are committed in one transaction per batch of pairs. SQLite's file locks aren't
+reliable on the network filesystems the workflow data usually lives on, so each metric is kept in its own cache
+file, which only one job writes at a time, and the default rollback journal is kept rather than WAL mode.
+
+Example usage:
+cache = SimilarityCache(cache_path)
+status, values = cache.lookup("MCS", parameters, ref_keys, query_keys, ["N_Atoms_in_MCS", "N_Atoms_in_Union"])
+...
+cache.store("MCS", parameters, pairs, {"N_Atoms_in_MCS": mcs, "N_Atoms_in_Union": union})
+"""
+
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+MISSING = -1
+CALCULATED = 0
+TIMED_OUT = 1
+
+
+def get_molecule_key(mol, with_coordinates: bool = False) -> str:
+    """
+    Identify a molecule by its canonical isomeric SMILES, including any explicit hydrogens.
+    :param with_coordinates: Also hash the coordinates, rounded to the precision of an SDF file
+    """
+    from openeye import oechem
+
+    # explicit hydrogens are written as atoms, so that they change the key like they change the atom counts
+    smiles = oechem.OECreateSmiString(
+        mol, oechem.OESMILESFlag_ISOMERIC | oechem.OESMILESFlag_Hydrogens
+    )
+    if not with_coordinates:
+        return smiles
+    coords = mol.GetCoords()
+    coords = np.round(
+        np.array([coords[atom.GetIdx()] for atom in mol.GetAtoms()], dtype=float), 3
+    )
+    # adding 0.0 turns -0.0 into 0.0, which would otherwise hash differently
+    return f"{smiles} {hashlib.sha256((coords + 0.0).tobytes()).hexdigest()[:16]}"
+
+
+def get_parameters_key(parameters: dict) -> str:
+    return json.dumps(parameters, sort_keys=True)
+
+
+class SimilarityCache:
+    """
+    SQLite table of pairwise similarities.
+    """
+
+    def __init__(self, path: Path, timeout: float = 600):
+        """
+        :param path: SQLite file, created if it doesn't exist
+        :param timeout: Seconds to wait for another job's write to finish
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=timeout)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS similarities (
+                    metric TEXT NOT NULL,
+                    parameters TEXT NOT NULL,
+                    molecule_a TEXT NOT NULL,
+                    molecule_b TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    scores TEXT,
+                    PRIMARY KEY (metric, parameters, molecule_a, molecule_b)
+                ) WITHOUT ROWID
+                """)
+
+    def lookup(
+        self,
+        metric: str,
+        parameters: dict,
+        reference_keys: list,
+        query_keys: list,
+        value_names: list,
+        timeout: float = None,
+    ) -> tuple:
+        """
+        Get the cached values of every reference x query pair.
+        :param reference_keys: Molecule key of every reference, see get_molecule_key
+        :param query_keys: Molecule key of every query
+        :param value_names: Values to return, e.g. N_Atoms_in_MCS
+        :param timeout: Seconds a pair may be calculated for now, None if there is no limit. Pairs that timed out
+            with a shorter timeout are MISSING, so that they are tried again.
+        :return: Status of every pair, MISSING, CALCULATED or TIMED_OUT, and a dictionary of value name to
+            (n_references, n_queries) arrays, NaN where the pair wasn't calculated
+        """
+        shape = (len(reference_keys), len(query_keys))
+        status = np.full(shape, MISSING, dtype=np.int8)
+        values = {name: np.full(shape, np.nan) for name in value_names}
+        cursor = self.connection.cursor()
+        try:
+            for table, keys in [
+                ("lookup_references", reference_keys),
+                ("lookup_queries", query_keys),
+            ]:
+                cursor.execute(f"DROP TABLE IF EXISTS temp.{table}")
+                cursor.execute(
+                    f"CREATE TEMP TABLE {table} (position INTEGER, molecule TEXT)"
+                )
+                cursor.execute(
+                    f"CREATE INDEX temp.{table}_molecule ON {table} (molecule)"
+                )
+                cursor.executemany(
+                    f"INSERT INTO temp.{table} VALUES (?, ?)", enumerate(keys)
+                )
+            cursor.execute(
+                """
+                SELECT r.position, q.position, s.status, s.scores
+                FROM similarities AS s
+                JOIN temp.lookup_references AS r ON s.molecule_a = r.molecule
+                JOIN temp.lookup_queries AS q ON s.molecule_b = q.molecule
+                WHERE s.metric = ? AND s.parameters = ?
+                """,
+                (metric, get_parameters_key(parameters)),
+            )
+            for i, j, pair_status, scores in cursor:
+                scores = json.loads(scores) if scores is not None else {}
+                if pair_status == TIMED_OUT:
+                    pair_timeout = scores.get("timeout")
+                    if (
+                        timeout is None
+                        or pair_timeout is None
+                        or pair_timeout < timeout
+                    ):
+                        continue
+                status[i, j] = pair_status
+                if pair_status == CALCULATED:
+                    for name in value_names:
+                        values[name][i, j] = scores[name]
+        finally:
+            cursor.close()
+            # creating the temporary tables opened a transaction
+            self.connection.rollback()
+        return status, values
+
+    def store(
+        self,
+        metric: str,
+        parameters: dict,
+        pairs: list,
+        values: dict,
+        timed_out: np.ndarray = None,
+        timeout: float = None,
+    ):
+        """
+        Write a batch of pairs in one transaction, replacing any previous values.
+        :param pairs: (reference key, query key) of every pair
+        :param values: Dictionary of value name to an array with one value per pair
+        :param timed_out: Pairs to store as timed out, whose values are ignored
+        :param timeout: Seconds the timed out pairs were given
+        """
+        if timed_out is None:
+            timed_out = np.zeros(len(pairs), dtype=bool)
+        names = list(values)
+        columns = [np.asarray(values[name]).tolist() for name in names]
+        parameters_key = get_parameters_key(parameters)
+        rows = []
+        for k, (key_a, key_b) in enumerate(pairs):
+            if timed_out[k]:
+                scores = json.dumps({"timeout": timeout})
+                rows.append((metric, parameters_key, key_a, key_b, TIMED_OUT, scores))
+            else:
+                scores = json.dumps(
+                    {name: column[k] for name, column in zip(names, columns)}
+                )
+                rows.append((metric, parameters_key, key_a, key_b, CALCULATED, scores))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO similarities VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def close(self):
+        self.connection.close()
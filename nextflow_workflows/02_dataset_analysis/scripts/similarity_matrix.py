@@ -0,0 +1,301 @@
+"""
+Dense storage of reference x query similarity matrices.
+
+The long-form similarity CSVs repeat both ligand names on every row. Here each metric and parameter set, e.g. ECFP
+with radius 2 and 2048 bits or aligned TanimotoCombo, is stored as a float32 N x M .npy file with one row per
+reference and one column per query ligand, so rows can be memory-mapped and searched without parsing anything.
+Integer values such as the MCS atom counts are stored as int32 matrices of their own.
+
+A directory of matrices has a metadata.json header with the row and column names and, for every parameter set,
+the long-form columns in order: either a value shared by the whole matrix, such as the radius, or the .npy file
+holding its values. `SimilarityMatrices.to_long_form` rebuilds the rows of the original CSV from it.
+
+Pairs that weren't calculated, e.g. because a similarity bound showed they can't matter, are NaN in the Tanimoto
+matrix. They are left out of the long form and of the searches.
+
+Example usage:
+python similarity_matrix.py to-csv --matrix-dir ecfp_tanimoto/similarity_matrix --output fingerprint_similarities.csv
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+METADATA_FILENAME = "metadata.json"
+MATRIX_DIRNAME = "similarity_matrix"
+
+
+def get_matrix_dtype(values: np.ndarray):
+    if np.issubdtype(values.dtype, np.integer):
+        return np.int32
+    if values.dtype == bool:
+        return bool
+    return np.float32
+
+
+class SimilarityMatrices:
+    """
+    Similarity matrices of one metric between a set of reference and query ligands, for one or more parameter sets.
+    """
+
+    def __init__(self, reference_names: list, query_names: list, metadata: dict = None):
+        """
+        :param reference_names: Name of the reference ligand of every row
+        :param query_names: Name of the query ligand of every column
+        :param metadata: Extra information to keep in the header, e.g. the script that wrote the matrices
+        """
+        self.reference_names = list(reference_names)
+        self.query_names = list(query_names)
+        self.metadata = metadata or {}
+        # one dictionary of long-form columns per parameter set, each a scalar or an N x M array
+        self.entries = []
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.reference_names), len(self.query_names)
+
+    def add(self, columns: dict):
+        """
+        Add the matrices of one parameter set.
+        :param columns: Long-form columns after Reference_Ligand and Query_Ligand, in order.
+            Each is either a value shared by all pairs or an array of shape (n_references, n_queries).
+        """
+        entry = {}
+        for name, value in columns.items():
+            if np.ndim(value) == 0:
+                entry[name] = value.item() if isinstance(value, np.generic) else value
+                continue
+            value = np.asarray(value)
+            if value.shape != self.shape:
+                raise ValueError(
+                    f"Column {name} has shape {value.shape} instead of {self.shape}"
+                )
+            entry[name] = value.astype(get_matrix_dtype(value), copy=False)
+        self.entries.append(entry)
+
+    @classmethod
+    def from_row_dataframes(
+        cls,
+        dfs: list,
+        reference_names: list,
+        query_names: list,
+        value_columns: list,
+        parameter_columns: list = [],
+        metadata: dict = None,
+    ):
+        """
+        Build matrices from long-form dataframes holding the rows of one reference each.
+        Within each parameter set the rows of a dataframe must be in the order of query_names.
+        :param dfs: One dataframe per reference, in the order of reference_names
+        :param value_columns: Columns with a value per pair, e.g. Tanimoto
+        :param parameter_columns: Columns that distinguish the parameter sets, e.g. Aligned.
+            All other columns are taken to be shared by all pairs, e.g. Type.
+        """
+        matrices = cls(reference_names, query_names, metadata)
+        if not dfs:
+            return matrices
+        template = dfs[0]
+        keys = (
+            [
+                key if isinstance(key, tuple) else (key,)
+                for key in template.groupby(parameter_columns, sort=False).groups
+            ]
+            if parameter_columns
+            else [()]
+        )
+        for key in keys:
+            selected = []
+            for df in dfs:
+                mask = np.ones(len(df), dtype=bool)
+                for column, value in zip(parameter_columns, key):
+                    mask &= (df[column] == value).to_numpy()
+                selected.append(df[mask])
+            columns = {}
+            for column in template.columns:
+                if column in ("Reference_Ligand", "Query_Ligand"):
+                    continue
+                if column in value_columns:
+                    columns[column] = np.vstack(
+                        [df[column].to_numpy() for df in selected]
+                    )
+                else:
+                    columns[column] = selected[0][column].iloc[0]
+            matrices.add(columns)
+        return matrices
+
+    def save(self, output_dir: Path):
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for i, entry in enumerate(self.entries):
+            header = {"columns": [], "values": {}, "files": {}}
+            for name, value in entry.items():
+                header["columns"].append(name)
+                if isinstance(value, np.ndarray):
+                    filename = f"matrix_{i}_{name}.npy"
+                    np.save(output_dir / filename, value)
+                    header["files"][name] = filename
+                else:
+                    header["values"][name] = value
+            entries.append(header)
+        with open(output_dir / METADATA_FILENAME, "w") as f:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "shape": list(self.shape),
+                    "metadata": self.metadata,
+                    "reference_names": self.reference_names,
+                    "query_names": self.query_names,
+                    "entries": entries,
+                },
+                f,
+                indent=4,
+            )
+
+    @classmethod
+    def load(cls, matrix_dir: Path, mmap_mode: str = "r"):
+        """
+        Open a directory of matrices, memory-mapping the .npy files.
+        """
+        matrix_dir = Path(matrix_dir)
+        with open(matrix_dir / METADATA_FILENAME, "r") as f:
+            header = json.load(f)
+        if header["format_version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"'{matrix_dir}' has format version {header['format_version']}, "
+                f"only versions up to {FORMAT_VERSION} can be read"
+            )
+        matrices = cls(
+            header["reference_names"], header["query_names"], header["metadata"]
+        )
+        for entry in header["entries"]:
+            matrices.entries.append(
+                {
+                    name: (
+                        np.load(matrix_dir / entry["files"][name], mmap_mode)
+                        if name in entry["files"]
+                        else entry["values"][name]
+                    )
+                    for name in entry["columns"]
+                }
+            )
+        return matrices
+
+    def rename(self, mapping: dict):
+        """
+        Rename ligands in the row and column names, leaving names not in mapping as they are.
+        """
+        self.reference_names = [
+            mapping.get(name, name) for name in self.reference_names
+        ]
+        self.query_names = [mapping.get(name, name) for name in self.query_names]
+
+    def get_entry(self, **parameters) -> dict:
+        """
+        Get the columns of the one parameter set whose shared values match parameters, e.g. radius=2, bitsize=2048.
+        """
+        matches = [
+            entry
+            for entry in self.entries
+            if all(entry.get(name) == value for name, value in parameters.items())
+        ]
+        if len(matches) != 1:
+            raise KeyError(
+                f"{len(matches)} parameter sets match {parameters}, expected exactly one"
+            )
+        return matches[0]
+
+    def get_matrix(self, column: str = "Tanimoto", **parameters) -> np.ndarray:
+        return self.get_entry(**parameters)[column]
+
+    def top_k(
+        self, reference: str, k: int, column: str = "Tanimoto", **parameters
+    ) -> pd.Series:
+        """
+        The k most similar queries of a reference, from its row only.
+        :return: Series of similarities indexed by query name, most similar first
+        """
+        row = np.asarray(
+            self.get_matrix(column, **parameters)[self.reference_names.index(reference)]
+        )
+        calculated = np.flatnonzero(~np.isnan(row))
+        row = row[calculated]
+        k = min(k, len(row))
+        best = np.argpartition(-row, k - 1)[:k] if k > 0 else np.array([], dtype=int)
+        best = best[np.argsort(-row[best], kind="stable")]
+        return pd.Series(
+            row[best], index=np.asarray(self.query_names)[calculated[best]]
+        )
+
+    def above(
+        self, reference: str, threshold: float, column: str = "Tanimoto", **parameters
+    ) -> pd.Series:
+        """
+        The queries of a reference with a similarity of at least threshold, from its row only.
+        """
+        row = np.asarray(
+            self.get_matrix(column, **parameters)[self.reference_names.index(reference)]
+        )
+        selected = np.flatnonzero(row >= threshold)
+        return pd.Series(row[selected], index=np.asarray(self.query_names)[selected])
+
+    def to_long_form(self) -> pd.DataFrame:
+        """
+        Rebuild the long-form rows, one per calculated (reference, query) pair and parameter set.
+        """
+        n_references, n_queries = self.shape
+        references = np.repeat(
+            np.asarray(self.reference_names, dtype=object), n_queries
+        )
+        queries = np.tile(np.asarray(self.query_names, dtype=object), n_references)
+        dfs = []
+        for entry in self.entries:
+            data = {"Reference_Ligand": references, "Query_Ligand": queries}
+            for name, value in entry.items():
+                data[name] = (
+                    np.asarray(value).ravel()
+                    if isinstance(value, np.ndarray)
+                    else value
+                )
+            df = pd.DataFrame(data, index=pd.RangeIndex(len(references)))
+            if isinstance(entry.get("Tanimoto"), np.ndarray):
+                df = df[df["Tanimoto"].notna()]
+            dfs.append(df)
+        return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+
+def load_similarity_data(path: Path) -> pd.DataFrame:
+    """
+    Load long-form similarity data from either a directory of matrices or a CSV file.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return SimilarityMatrices.load(path).to_long_form()
+    return pd.read_csv(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert a directory of similarity matrices to long-form CSV"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_csv = subparsers.add_parser("to-csv")
+    to_csv.add_argument("--matrix-dir", type=Path, required=True)
+    to_csv.add_argument("--output", type=Path, required=True)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "to-csv":
+        df = SimilarityMatrices.load(args.matrix_dir).to_long_form()
+        df.to_csv(args.output, index=False)
+        print(f"Wrote {len(df)} rows to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Append-only ledger of finished (reference, query block) tiles of a similarity matrix.
+
+A tile is one reference and the indices of a block of queries, usually contiguous but any subset of the queries
+when only some pairs need to be calculated.
+
+Every finished tile is written as one json line holding its per-pair values, flushed and fsynced before the next
+one is recorded, so an interrupted job only loses the tiles it was working on. Each run appends to a new
+part-<n>.jsonl file in the ledger directory. When the ledger is reopened, all parts are read to find the finished
+tiles, and a partial last line left by a crash is truncated away.
+
+The ledger directory is keyed by the input molecules and their order, so the indices of a resumed run always
+refer to the same pairs. Tiles record their pairs explicitly, so runs with a different tile size or a different
+selection of pairs reuse each other's results.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+def get_ledger_key(reference_smiles: list, query_smiles: list, settings: dict) -> str:
+    """
+    Hash everything that the tile indices and values depend on.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "references": reference_smiles,
+                "queries": query_smiles,
+                "settings": settings,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+def get_tiles(pending: np.ndarray, tile_size: int) -> list:
+    """
+    Cut the pending pairs of each reference into tiles of at most tile_size queries.
+    :param pending: Boolean (n_references, n_queries) array of the pairs to calculate
+    :return: List of (reference index, query indices) tiles
+    """
+    tiles = []
+    for ref in np.flatnonzero(pending.any(axis=1)):
+        queries = np.flatnonzero(pending[ref])
+        for start in range(0, len(queries), tile_size):
+            tiles.append((int(ref), queries[start : start + tile_size]))
+    return tiles
+
+
+class TileLedger:
+    """
+    Durable record of the finished tiles of one similarity matrix.
+    """
+
+    def __init__(self, ledger_dir: Path):
+        self.ledger_dir = Path(ledger_dir)
+        self.ledger_dir.mkdir(parents=True, exist_ok=True)
+        self.records = []
+        parts = sorted(
+            self.ledger_dir.glob("part-*.jsonl"),
+            key=lambda path: int(path.stem.split("-")[1]),
+        )
+        for path in parts:
+            self._load(path)
+        n_part = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+        self.part_path = self.ledger_dir / f"part-{n_part}.jsonl"
+        # opened on the first append, so runs without new tiles don't leave empty parts
+        self._file = None
+
+    def _load(self, path: Path):
+        valid_bytes = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial line from an interrupted write, everything after it is discarded
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.records.append(record)
+                valid_bytes += len(line)
+        if valid_bytes < path.stat().st_size:
+            os.truncate(path, valid_bytes)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def append(self, tile: tuple, values: dict):
+        """
+        Commit one finished tile.
+        :param tile: (reference index, query indices)
+        :param values: Arrays with one value per query of the tile, e.g. N_Atoms_in_MCS
+        """
+        reference, queries = tile
+        record = {
+            "reference": int(reference),
+            "queries": np.asarray(queries).tolist(),
+            "values": {
+                name: np.asarray(array).tolist() for name, array in values.items()
+            },
+        }
+        if self._file is None:
+            self._file = open(self.part_path, "a")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records.append(record)
+
+    def assemble(
+        self, n_references: int, n_queries: int, name: str, fill_value=np.nan
+    ) -> np.ndarray:
+        """
+        Put the recorded values of one kind back into a matrix.
+        :param fill_value: Value of the pairs that haven't been recorded, which also sets the dtype
+        """
+        matrix = np.full((n_references, n_queries), fill_value)
+        for record in self.records:
+            matrix[record["reference"], record["queries"]] = record["values"][name]
+        return matrix
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
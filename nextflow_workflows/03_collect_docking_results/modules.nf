@@ -34,11 +34,11 @@ process COMBINE_AND_PROCESS_RESULTS {
 
     script:
     """
-    python3 "${params.scripts}"/combine_and_process_results.py \
+    PYTHONPATH="${params.datasetAnalysisScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/combine_and_process_results.py \
     ${dockedLigandRMSDs.join(' ')} \
-    --tc-data "${params.chemicalSimilarityData}/tanimoto_combo/tanimoto_combo.csv" \
-    --ecfp-data "${params.chemicalSimilarityData}/ecfp_tanimoto/fingerprint_similarities.csv" \
-    --mcs-data "${params.chemicalSimilarityData}/mcs_tanimoto/mcs_tanimoto.csv" \
+    --tc-data "${params.chemicalSimilarityData}/tanimoto_combo/similarity_matrix" \
+    --ecfp-data "${params.chemicalSimilarityData}/ecfp_tanimoto/similarity_matrix" \
+    --mcs-data "${params.chemicalSimilarityData}/mcs_tanimoto/similarity_matrix" \
     --date-dict "${params.dateDictPath}" \
     --structure-cmpd-dict "${params.dataPath}/cmpd_date_dict/structure_to_cmpd_dict.json" \
     --scaffold-data "${params.genericScaffoldPath}" \
@@ -13,13 +13,26 @@ from harbor.analysis.utils import FileLogger
 import click
 import numpy as np
 import json
+from similarity_matrix import SimilarityMatrices
 
 
 @click.command()
 @click.argument("pose-data", nargs=-1, type=click.Path(exists=True), required=True)
-@click.option("--tc-data", type=click.Path(exists=True))
-@click.option("--ecfp-data", type=click.Path(exists=True))
-@click.option("--mcs-data", type=click.Path(exists=True))
+@click.option(
+    "--tc-data",
+    type=click.Path(exists=True),
+    help="Long-form csv or directory of similarity matrices",
+)
+@click.option(
+    "--ecfp-data",
+    type=click.Path(exists=True),
+    help="Long-form csv or directory of similarity matrices",
+)
+@click.option(
+    "--mcs-data",
+    type=click.Path(exists=True),
+    help="Long-form csv or directory of similarity matrices",
+)
 @click.option("--scaffold-data", type=click.Path(exists=True))
 @click.option(
     "--date-dict",
@@ -217,13 +230,19 @@ def main(
         deduplicate: bool,
         param_args: list = [],
     ):
-        df = pd.read_csv(df_path)
-        df["Query_Ligand"] = df["Query_Ligand"].apply(
-            lambda x: incorrect_lig_to_correct_lig_dict.get(x, x)
-        )
-        df["Reference_Ligand"] = df["Reference_Ligand"].apply(
-            lambda x: incorrect_lig_to_correct_lig_dict.get(x, x)
-        )
+        if Path(df_path).is_dir():
+            # rename the ligands once in the name index instead of on every row
+            matrices = SimilarityMatrices.load(df_path)
+            matrices.rename(incorrect_lig_to_correct_lig_dict)
+            df = matrices.to_long_form()
+        else:
+            df = pd.read_csv(df_path)
+            df["Query_Ligand"] = df["Query_Ligand"].apply(
+                lambda x: incorrect_lig_to_correct_lig_dict.get(x, x)
+            )
+            df["Reference_Ligand"] = df["Reference_Ligand"].apply(
+                lambda x: incorrect_lig_to_correct_lig_dict.get(x, x)
+            )
         if deduplicate:
             df = df.groupby(common_key_cols + param_args).head(1)
         return df
@@ -12,7 +12,7 @@ process CREATE_EVALUATOR_FACTORY_SETTINGS{
 
     script:
     """
-    python3 "${params.scripts}"/create_evaluator_factory_settings.py
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/create_evaluator_factory_settings.py
     """
 }
 
@@ -36,7 +36,7 @@ process CREATE_EVALUATORS {
 
     script:
     """
-    python3 "${params.scripts}"/create_evaluators.py \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/create_evaluators.py \
     --input-parquet "${docking_results_parquet}" \
     --settings "${settings}" \
     --output "${name}" \
@@ -59,7 +59,7 @@ process CREATE_MULTIPOSE_EVALUATORS {
 
     script:
     """
-    python3 "${params.scripts}"/create_multipose_evaluators.py \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/create_multipose_evaluators.py \
     --output "${name}" \
     """
 }
@@ -80,7 +80,7 @@ process CREATE_EVALUATORS_MODULAR {
 
     script:
     """
-    python3 "${script_path}" \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${script_path}" \
     --output "${name}" \
     --input-parquet "${docking_results_parquet}" \
     """
@@ -110,7 +110,7 @@ process RUN_EVALUATORS {
 
     script:
     """
-    python3 "${params.scripts}"/run_evaluators.py \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/run_evaluators.py \
     evaluator_jsons_* \
     --input-parquet "${docking_results_parquet}" \
     --n-cpus 32
@@ -141,7 +141,7 @@ process RUN_EVALUATORS_LIGHTWEIGHT {
 
     script:
     """
-    python3 "${params.scripts}"/run_evaluators.py \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python3 "${params.scripts}"/run_evaluators.py \
     evaluator_jsons_* \
     --input-parquet "${docking_results_parquet}" \
     --n-cpus 8
@@ -161,7 +161,7 @@ process COMBINE_EVALUATIONS {
 
     script:
     """
-    python "${params.scripts}/combine_evaluation_results.py" \
+    PYTHONPATH="${params.prepScripts}:\${PYTHONPATH:-}" python "${params.scripts}/combine_evaluation_results.py" \
     evaluator_results_* \
     "${name}_combined_results.csv"
     """
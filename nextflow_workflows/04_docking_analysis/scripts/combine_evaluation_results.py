@@ -2,6 +2,7 @@ import pandas as pd
 import glob
 import os
 import click
+from telemetry import profile_main
 
 
 @click.command()
@@ -11,6 +12,7 @@ import click
     type=click.Path(exists=True),
 )
 @click.argument("output-file", type=click.Path())
+@profile_main
 def combine_csv_files(input_csvs, output_file):
     """Combine multiple INPUT_CSVS into a single OUTPUT_FILE."""
     csv_files = list(input_csvs)
@@ -8,6 +8,7 @@ from harbor.analysis.cross_docking import (
     EvaluatorFactory,
     ScaffoldSplitOptions,
 )
+from telemetry import profile_main
 
 
 @click.command()
@@ -19,6 +20,7 @@ from harbor.analysis.cross_docking import (
     default="./",
     help="Path to the output directory where the results will be stored",
 )
+@profile_main
 def main(output):
     output.mkdir(exist_ok=True, parents=True)
 
@@ -13,6 +13,7 @@ from harbor.analysis.cross_docking import (
     ScaffoldSplitOptions,
 )
 from harbor.analysis.utils import FileLogger
+from telemetry import phase, profile_main
 
 
 def save_and_create_evs(
@@ -49,6 +50,7 @@ def save_and_create_evs(
     required=True,
     help="Path to the output directory where the results will be stored",
 )
+@profile_main
 def main(input_parquet, settings, output):
     # load evaluator factory
     evf = EvaluatorFactory.from_yaml_file(settings)
@@ -60,8 +62,10 @@ def main(input_parquet, settings, output):
     ).getLogger()
     logger.info(f"Reading data model from {input_parquet}")
     # load docking model
-    data = DockingDataModel.deserialize(input_parquet)
-    save_and_create_evs(evf, data, evf.name, output, logger)
+    with phase("load"):
+        data = DockingDataModel.deserialize(input_parquet)
+    with phase("compute"):
+        save_and_create_evs(evf, data, evf.name, output, logger)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import click
 from pathlib import Path
 import pandas as pd
 import harbor.analysis.cross_docking as cd
+from telemetry import profile_main
 
 
 @click.command()
@@ -24,6 +25,7 @@ import harbor.analysis.cross_docking as cd
     default=Path("./"),
     help="Path to the output directory where the results will be stored",
 )
+@profile_main
 def main(input_parquet, output):
     name = "scaffold_datesplit_evaluators"
 
@@ -6,6 +6,7 @@ import click
 from pathlib import Path
 import pandas as pd
 import harbor.analysis.cross_docking as cd
+from telemetry import profile_main
 
 
 @click.command()
@@ -23,6 +24,7 @@ import harbor.analysis.cross_docking as cd
     required=True,
     help="Path to the output directory where the results will be stored",
 )
+@profile_main
 def main(output):
     # data = cd.DockingDataModel.deserialize(input_parquet)
     name = "multipose_evaluators"
@@ -2,6 +2,7 @@ from pathlib import Path
 import click
 from harbor.analysis.cross_docking import Evaluator, DockingDataModel, Results
 from harbor.analysis.utils import FileLogger
+from telemetry import phase, profile_main
 
 
 @click.command()
@@ -28,6 +29,7 @@ from harbor.analysis.utils import FileLogger
     default=1,
     help="Number of CPUs to use for parallel processing.",
 )
+@profile_main
 def run_evaluators(evaluator_jsons, input_parquet, output, n_cpus):
     output.mkdir(exist_ok=True, parents=True)
 
@@ -37,22 +39,27 @@ def run_evaluators(evaluator_jsons, input_parquet, output, n_cpus):
         logfile="run_cross_docking_evaluators.log",
     ).getLogger()
 
-    logger.info(f"Reading data model from {input_parquet}")
-    data = DockingDataModel.deserialize(input_parquet)
+    with phase("load"):
+        logger.info(f"Reading data model from {input_parquet}")
+        data = DockingDataModel.deserialize(input_parquet)
 
-    logger.info(f"Reading in {len(evaluator_jsons)} evaluators")
-    evaluators = [Evaluator.from_json_file(evaluator) for evaluator in evaluator_jsons]
+        logger.info(f"Reading in {len(evaluator_jsons)} evaluators")
+        evaluators = [
+            Evaluator.from_json_file(evaluator) for evaluator in evaluator_jsons
+        ]
 
     logger.info(f"Number of evaluators: {len(evaluators)}")
 
-    results = [
-        results
-        for results in Results.calculate_results(data, evaluators, n_cpus=n_cpus)
-    ]
+    with phase("compute"):
+        results = [
+            results
+            for results in Results.calculate_results(data, evaluators, n_cpus=n_cpus)
+        ]
 
-    logger.info(f"Writing results to disk at {output}")
-    results_df = Results.df_from_results(results)
-    results_df.to_csv(output / "results.csv", index=False)
+    with phase("write"):
+        logger.info(f"Writing results to disk at {output}")
+        results_df = Results.df_from_results(results)
+        results_df.to_csv(output / "results.csv", index=False)
 
 
 if __name__ == "__main__":